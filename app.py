@@ -1,39 +1,194 @@
-from flask import Flask, render_template, request, jsonify, send_file, url_for, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_file, url_for, send_from_directory
 import os
+import io
 import subprocess
 import uuid
 import shutil
 import zipfile
 import logging
 import sys
+import select
+import socket
+import atexit
+import signal
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.datastructures import MultiDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 import time
+import threading
+import queue
+import hashlib
+import heapq
+import json
+import sqlite3
+import re
+import random
+import contextvars
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import quote
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-# 配置日志记录
+# 配置日志记录：BOOKFORGE_LOG_LEVEL设置级别（默认INFO），BOOKFORGE_LOG_FORMAT=json时每行输出一个JSON对象。
+# 批次ID、文件名等关联字段由 log_context() 设置，附加到同一上下文中的所有日志上
+_log_context = contextvars.ContextVar('bookforge_log_context', default={})
+
+class _LogContextFilter(logging.Filter):
+    """把当前上下文的关联字段附加到日志记录上"""
+    def filter(self, record):
+        fields = _log_context.get()
+        record.context_fields = fields
+        record.context = ''.join(f' [{key}={value}]' for key, value in fields.items())
+        return True
+
+class _JsonLogFormatter(logging.Formatter):
+    """JSON Lines格式，关联字段作为顶层字段输出"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'context_fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.addFilter(_LogContextFilter())
+if os.environ.get('BOOKFORGE_LOG_FORMAT', 'text').lower() == 'json':
+    _log_handler.setFormatter(_JsonLogFormatter())
+else:
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'))
+# 无效的级别名称退回INFO，不让basicConfig在导入时抛出异常
+_log_level_name = os.environ.get('BOOKFORGE_LOG_LEVEL', 'INFO').strip().upper()
+_log_level = logging.getLevelName(_log_level_name)
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+    level=_log_level if isinstance(_log_level, int) else logging.INFO,
+    handlers=[_log_handler]
 )
 logger = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+    logger.warning("无效的日志级别 BOOKFORGE_LOG_LEVEL=%s，使用INFO", _log_level_name)
+
+@contextmanager
+def log_context(**fields):
+    """在with块内为日志附加关联字段，例如 batch_id、file"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
 
 app = Flask(__name__)
 
 # 配置
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-CONVERTED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'converted')
-DOWNLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
+# 数据目录默认位于项目目录下，可通过环境变量指向其他位置（如基准测试使用的临时目录）
+DATA_FOLDER = os.environ.get('BOOKFORGE_DATA_DIR') or os.path.dirname(os.path.abspath(__file__))
+UPLOAD_FOLDER = os.path.join(DATA_FOLDER, 'uploads')
+CONVERTED_FOLDER = os.path.join(DATA_FOLDER, 'converted')
+DOWNLOAD_FOLDER = os.path.join(DATA_FOLDER, 'downloads')
+CACHE_FOLDER = os.path.join(DATA_FOLDER, 'cache')
 
 # 确保目录存在
-for folder in [UPLOAD_FOLDER, CONVERTED_FOLDER, DOWNLOAD_FOLDER]:
+for folder in [UPLOAD_FOLDER, CONVERTED_FOLDER, DOWNLOAD_FOLDER, CACHE_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['CONVERTED_FOLDER'] = CONVERTED_FOLDER
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
+app.config['CACHE_FOLDER'] = CACHE_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 限制上传文件大小为100MB
+# 流式接收上传时每次从请求体读取的字节数
+app.config['UPLOAD_CHUNK_SIZE'] = 256 * 1024
+# 普通表单字段（输出格式、高级选项）的大小上限和请求中的最大部分数
+app.config['UPLOAD_MAX_FIELD_SIZE'] = 64 * 1024
+app.config['UPLOAD_MAX_PARTS'] = 1000
+# 分块上传：建议的分块大小和单个批次的总大小上限
+app.config['RESUMABLE_CHUNK_SIZE'] = 4 * 1024 * 1024
+app.config['RESUMABLE_MAX_BATCH_BYTES'] = int(os.environ.get('BOOKFORGE_RESUMABLE_MAX_MB', 2048)) * 1024 * 1024
+# 同时运行的ebook-convert进程数量，默认与CPU核心数相同
+app.config['CONVERSION_WORKERS'] = int(os.environ.get('BOOKFORGE_CONVERSION_WORKERS', 0)) or os.cpu_count() or 1
+# 同时处理的批次数量（批次内的文件仍共享上面的转换线程池）
+app.config['JOB_RUNNERS'] = int(os.environ.get('BOOKFORGE_JOB_RUNNERS', 8))
+# 服务端认可的API密钥。X-API-Key请求头没有经过认证，只有列在这里的密钥才按密钥区分客户端，其余请求按IP区分
+app.config['API_KEYS'] = {key.strip() for key in os.environ.get('BOOKFORGE_API_KEYS', '').split(',') if key.strip()}
+# 公平调度中各客户端的权重，格式为 "API密钥或IP地址=权重,..."，未列出的客户端权重为1；密钥需同时列在API_KEYS中
+app.config['CLIENT_WEIGHTS'] = {
+    name.strip(): float(weight)
+    for name, _, weight in (item.partition('=') for item in os.environ.get('BOOKFORGE_CLIENT_WEIGHTS', '').split(','))
+    if name.strip() and weight.strip()
+}
+# 部署在反向代理之后时信任的代理层数，按X-Forwarded-For等请求头还原客户端IP；0表示不信任这些请求头
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('BOOKFORGE_TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES'] > 0:
+    hops = app.config['TRUSTED_PROXIES']
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops, x_port=hops)
+# 已结束的任务状态在内存中保留的时间（秒）
+app.config['JOB_RETENTION_SECONDS'] = 24 * 3600
+# 转换结果缓存的容量上限，超出后按最近最少使用的顺序淘汰；设为0可关闭缓存
+app.config['CONVERSION_CACHE_MAX_BYTES'] = int(os.environ.get('BOOKFORGE_CACHE_MAX_MB', 2048)) * 1024 * 1024
+# 下载方式：stream 在下载时直接生成ZIP数据流；file 先在downloads目录生成ZIP文件
+app.config['ZIP_MODE'] = os.environ.get('BOOKFORGE_ZIP_MODE', 'stream')
+# ZIP压缩策略：auto 仅压缩文本类格式；store 全部存储；deflate 全部压缩
+app.config['ZIP_COMPRESSION'] = os.environ.get('BOOKFORGE_ZIP_COMPRESSION', 'auto')
+app.config['ZIP_STREAM_CHUNK_SIZE'] = 256 * 1024
+# 批次文件在最后一次活动之后保留的时间（秒），到期后由后台清理线程删除
+app.config['BATCH_RETENTION_SECONDS'] = int(os.environ.get('BOOKFORGE_BATCH_RETENTION_HOURS', 24)) * 3600
+# 最后一次下载之后批次文件的保留时间，到期后由后台清理线程删除；0表示下载不影响批次的保留时间
+app.config['DOWNLOADED_RETENTION_SECONDS'] = int(os.environ.get('BOOKFORGE_DOWNLOADED_RETENTION_MINUTES', 60)) * 60
+# 由前端代理发送文件内容：x-accel-redirect（nginx）或 x-sendfile（Apache、lighttpd），留空时由应用自己读取文件发送
+app.config['SENDFILE_MODE'] = os.environ.get('BOOKFORGE_SENDFILE', '').strip().lower()
+# X-Accel-Redirect指向的nginx内部location，该location以alias映射到数据目录
+app.config['SENDFILE_ACCEL_PREFIX'] = os.environ.get('BOOKFORGE_SENDFILE_ACCEL_PREFIX', '/bookforge-data/')
+# 批次状态数据库，多个工作进程共享同一个文件
+app.config['STATE_DB_PATH'] = os.environ.get('BOOKFORGE_STATE_DB') or os.path.join(DATA_FOLDER, 'bookforge.db')
+# 批次队列：local 由接收上传的进程自己转换；sqlite 放入状态数据库中的共享队列，由独立的转换工作进程领取
+app.config['CONVERSION_BROKER'] = os.environ.get('BOOKFORGE_CONVERSION_BROKER', 'local').strip().lower()
+# 工作进程领取批次后的租约时长，崩溃的工作进程持有的批次在租约到期后由其他工作进程重新执行
+app.config['TASK_LEASE_SECONDS'] = int(os.environ.get('BOOKFORGE_TASK_LEASE_SECONDS', 60))
+app.config['TASK_MAX_ATTEMPTS'] = int(os.environ.get('BOOKFORGE_TASK_MAX_ATTEMPTS', 3))
+# 所有批次文件（上传、转换结果、ZIP）的磁盘配额，超出后从最早到期的已结束批次开始删除；0表示不限制
+app.config['BATCH_DISK_QUOTA_BYTES'] = int(os.environ.get('BOOKFORGE_BATCH_QUOTA_MB', 0)) * 1024 * 1024
+# 数据目录至少保留的可用空间；新批次预估所需空间超出剩余部分时拒绝上传
+app.config['ADMISSION_MIN_FREE_BYTES'] = int(os.environ.get('BOOKFORGE_MIN_FREE_MB', 512)) * 1024 * 1024
+# 进行中批次预留空间的总上限；0表示只按磁盘剩余空间判断
+app.config['ADMISSION_MAX_RESERVED_BYTES'] = int(os.environ.get('BOOKFORGE_MAX_RESERVED_MB', 0)) * 1024 * 1024
+# 单个文件的转换超时：历史样本不足时使用默认值，之后按该格式组合的历史耗时和文件大小估算，并限制在上下限之间
+app.config['CONVERSION_TIMEOUT_DEFAULT'] = int(os.environ.get('BOOKFORGE_CONVERSION_TIMEOUT', 300))
+app.config['CONVERSION_TIMEOUT_MIN'] = 60
+app.config['CONVERSION_TIMEOUT_MAX'] = int(os.environ.get('BOOKFORGE_CONVERSION_TIMEOUT_MAX', 1800))
+# 订阅进度推送的客户端全部断开后，等待多少秒仍未重连则取消批次；0表示不自动取消
+app.config['DISCONNECT_CANCEL_SECONDS'] = int(os.environ.get('BOOKFORGE_DISCONNECT_CANCEL_SECONDS', 30))
+# 同时保持的进度推送连接数上限，每个连接占用一个请求线程；默认为gunicorn请求线程数的一半，超出时客户端改为轮询
+app.config['SSE_MAX_STREAMS'] = int(os.environ.get('BOOKFORGE_SSE_MAX_STREAMS', 0)) or \
+    max(1, int(os.environ.get('BOOKFORGE_WEB_THREADS', 8)) // 2)
+# 单个转换进程的资源限制，0表示不限制：地址空间（MB）、CPU时间（秒）和打开的文件数。
+# 输出PDF时Calibre使用的Qt WebEngine会预留大量虚拟内存，启用地址空间限制时不宜低于4096MB
+app.config['CONVERSION_MAX_MEMORY_BYTES'] = int(os.environ.get('BOOKFORGE_CONVERSION_MAX_MEMORY_MB', 0)) * 1024 * 1024
+app.config['CONVERSION_MAX_CPU_SECONDS'] = int(os.environ.get('BOOKFORGE_CONVERSION_MAX_CPU_SECONDS', 0))
+app.config['CONVERSION_MAX_OPEN_FILES'] = int(os.environ.get('BOOKFORGE_CONVERSION_MAX_OPEN_FILES', 1024))
+# 转换进程相对于服务进程降低的CPU优先级（nice值），以及IO调度类别（idle、best-effort[:0-7]，留空不调整）
+app.config['CONVERSION_NICE'] = int(os.environ.get('BOOKFORGE_CONVERSION_NICE', 10))
+app.config['CONVERSION_IONICE'] = os.environ.get('BOOKFORGE_CONVERSION_IONICE', 'best-effort:7').strip().lower()
+# 转换失败时完整记录Calibre错误输出的比例（0~1），以及记录的最大字符数；其余失败只记录最后一行
+app.config['LOG_STDERR_SAMPLE_RATE'] = float(os.environ.get('BOOKFORGE_LOG_STDERR_SAMPLE', 0.1))
+app.config['LOG_STDERR_MAX_CHARS'] = 8192
+# 一次上传转换为多个格式时先统一转换成的中间格式，留空表示每个格式都直接由原始文件转换
+app.config['FANOUT_INTERMEDIATE'] = os.environ.get('BOOKFORGE_FANOUT_INTERMEDIATE', 'epub').strip().lower()
+# Calibre执行方式：oneshot 每个文件启动一次ebook-convert；warm 复用常驻的Calibre进程
+app.config['CALIBRE_ENGINE'] = os.environ.get('BOOKFORGE_CALIBRE_ENGINE', 'oneshot')
+# 常驻进程完成多少次转换后重启，以及常驻内存比启动时增长多少后重启
+app.config['CALIBRE_WORKER_MAX_JOBS'] = int(os.environ.get('BOOKFORGE_CALIBRE_WORKER_MAX_JOBS', 50))
+app.config['CALIBRE_WORKER_MAX_RSS_GROWTH'] = int(os.environ.get('BOOKFORGE_CALIBRE_WORKER_MAX_RSS_GROWTH_MB', 512)) * 1024 * 1024
 
 # 支持的格式
 ALLOWED_INPUT_EXTENSIONS = {
@@ -46,6 +201,9 @@ ALLOWED_OUTPUT_FORMATS = {
     'rtf', 'fb2'
 }
 
+# 本身已经压缩过的输出格式，打包时再次deflate几乎不能减小体积
+PRECOMPRESSED_FORMATS = {'epub', 'azw3', 'mobi', 'docx', 'pdf'}
+
 def allowed_file(filename, allowed_extensions):
     """检查文件是否有允许的扩展名"""
     if '.' not in filename:
@@ -58,184 +216,2593 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static', 'img'),
                                'favicon.ico', mimetype='image/x-icon')
 
-def check_calibre_installed():
-    """检查Calibre是否已安装"""
-    try:
-        result = subprocess.run(['ebook-convert', '--version'], 
-                               capture_output=True, 
-                               text=True, 
-                               encoding='utf-8', 
-                               errors='replace')
-        if result.returncode == 0:
-            version = result.stdout.strip() if result.stdout else 'Unknown version'
-            logger.info(f"Calibre已安装: {version}")
-            return True
-        else:
-            logger.error("ebook-convert命令返回错误代码")
+# 运行指标：各阶段耗时直方图（按阶段、输入/输出格式和文件大小分组）以及队列、工作线程等瞬时值，
+# 以Prometheus文本格式在 /metrics 输出。记录一次观测只需一次计时和一次加锁的字典更新
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = ((1024 * 1024, 'lt_1mb'), (10 * 1024 * 1024, '1mb_10mb'), (50 * 1024 * 1024, '10mb_50mb'))
+_metrics_lock = threading.Lock()
+_stage_histograms = {}  # (stage, input_format, output_format, size_bucket) -> [各桶计数..., 总和, 次数]
+_counters = {}  # (name, labels) -> 值
+_active_conversions = 0
+_sse_streams = 0
+
+def size_bucket(size):
+    if size is None:
+        return ''
+    for limit, label in SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return 'ge_50mb'
+
+def observe_stage(stage, seconds, input_format='', output_format='', size_label=''):
+    key = (stage, input_format, output_format, size_label)
+    with _metrics_lock:
+        histogram = _stage_histograms.get(key)
+        if histogram is None:
+            histogram = _stage_histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+@contextmanager
+def stage_timer(stage, **labels):
+    """记录代码块耗时，labels可包含input_format、output_format、size_label"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, **labels)
+
+def increment_counter(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    # 只转义标签值，反斜杠最先处理，避免重复转义
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+def render_metrics():
+    """生成Prometheus文本格式的指标"""
+    lines = [
+        '# HELP bookforge_stage_duration_seconds Time spent in each processing stage.',
+        '# TYPE bookforge_stage_duration_seconds histogram'
+    ]
+    with _metrics_lock:
+        histograms = {key: list(values) for key, values in _stage_histograms.items()}
+        counters = dict(_counters)
+        active_conversions = _active_conversions
+        sse_streams = _sse_streams
+    
+    for (stage, input_format, output_format, size_label), values in sorted(histograms.items()):
+        labels = [('stage', stage), ('input_format', input_format),
+                  ('output_format', output_format), ('size_bucket', size_label)]
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, values):
+            cumulative += count
+            lines.append(f'bookforge_stage_duration_seconds_bucket{_format_labels(labels + [("le", bound)])} {cumulative}')
+        lines.append(f'bookforge_stage_duration_seconds_bucket{_format_labels(labels + [("le", "+Inf")])} {values[-1]}')
+        lines.append(f'bookforge_stage_duration_seconds_sum{_format_labels(labels)} {values[-2]}')
+        lines.append(f'bookforge_stage_duration_seconds_count{_format_labels(labels)} {values[-1]}')
+    
+    counter_names = sorted({name for name, _ in counters})
+    for name in counter_names:
+        lines.append(f'# TYPE {name} counter')
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    
+    with _jobs_lock:
+        job_states = [job['status'] for job in JOBS.values()]
+    cache = conversion_cache_stats()
+    batch_count, batch_bytes = batch_disk_usage()
+    admission = admission_status()
+    # 批次由转换工作进程执行时本进程没有转换线程，不为了指标去创建调度器
+    if get_task_broker().in_process:
+        scheduler = get_conversion_scheduler().snapshot()
+    else:
+        scheduler = {'waiting': 0, 'clients': 0}
+    gauges = [
+        ('bookforge_job_queue_depth', 'Batches waiting for a job runner.', get_task_broker().depth()),
+        ('bookforge_jobs_running', 'Batches currently being converted.', job_states.count('running')),
+        ('bookforge_active_conversions', 'ebook-convert runs in progress.', active_conversions),
+        ('bookforge_progress_streams', 'Open server-sent event progress streams.', sse_streams),
+        ('bookforge_conversion_tasks_waiting', 'Files waiting for a conversion worker.', scheduler['waiting']),
+        ('bookforge_scheduler_clients', 'Clients with files waiting for a conversion worker.', scheduler['clients']),
+        ('bookforge_conversion_workers', 'Size of the conversion worker pool.', app.config['CONVERSION_WORKERS']),
+        ('bookforge_calibre_idle_workers', 'Idle persistent Calibre workers.', _warm_workers.qsize()),
+        ('bookforge_cache_entries', 'Entries in the conversion result cache.', cache['entries']),
+        ('bookforge_cache_bytes', 'Bytes used by the conversion result cache.', cache['bytes']),
+        ('bookforge_batches_tracked', 'Batches in the lifecycle index.', batch_count),
+        ('bookforge_batch_bytes', 'Disk bytes held by tracked batches.', batch_bytes),
+        ('bookforge_admission_reserved_bytes', 'Disk bytes reserved by in-flight batches.', admission['reserved_bytes']),
+        ('bookforge_disk_free_bytes', 'Free bytes on the data volume.', admission['disk_free_bytes'])
+    ]
+    for name, help_text, value in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    for name in ('hits', 'misses', 'evictions'):
+        lines.append(f'# TYPE bookforge_cache_{name}_total counter')
+        lines.append(f'bookforge_cache_{name}_total {cache[name]}')
+    
+    return '\n'.join(lines) + '\n'
+
+class _FairScheduler:
+    """转换线程的公平调度器，所有请求共用，从而限制整个进程的并发转换数量
+    
+    每个客户端有自己的等待队列，空闲的转换线程总是从虚拟时间最小的客户端取任务，
+    取走一个文件后该客户端的虚拟时间增加 1/权重，因此多个批次的文件交替执行，
+    大批次不会独占转换线程；同一客户端的队列中输入文件小的优先。
+    """
+    
+    def __init__(self, workers):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._queues = {}  # 客户端 -> [(输入大小, 序号, Future, 任务函数)] 小顶堆
+        self._vtime = {}  # 客户端 -> 虚拟时间
+        self._clock = 0.0  # 最近一次分派任务时的虚拟时间
+        self._seq = 0
+        self._running = 0
+        self._avg_seconds = None  # 单个文件转换耗时的指数加权平均
+        for index in range(workers):
+            threading.Thread(target=self._worker, name=f'convert-{index}', daemon=True).start()
+    
+    def submit(self, client, size, fn):
+        future = Future()
+        with self._cond:
+            queue_ = self._queues.get(client)
+            if queue_ is None:
+                queue_ = self._queues[client] = []
+                # 重新有任务的客户端从当前虚拟时间开始，空闲期间不积累额度
+                self._vtime[client] = max(self._vtime.get(client, 0.0), self._clock)
+            self._seq += 1
+            # 在提交方的上下文中执行任务，日志保留批次ID等关联字段
+            heapq.heappush(queue_, (size, self._seq, future, functools.partial(contextvars.copy_context().run, fn)))
+            self._cond.notify()
+        return future
+    
+    def _take(self):
+        """取出下一个任务，调用方需持有 self._cond"""
+        client = min(self._queues, key=lambda c: self._vtime[c])
+        queue_ = self._queues[client]
+        _, _, future, fn = heapq.heappop(queue_)
+        if not queue_:
+            del self._queues[client]
+        self._clock = self._vtime[client]
+        weight = app.config['CLIENT_WEIGHTS'].get(str(client).split(':', 1)[-1], 1.0)
+        self._vtime[client] += 1.0 / max(weight, 0.01)
+        # 没有等待任务且不再领先的客户端不需要保留虚拟时间
+        for idle in [c for c, t in self._vtime.items() if c not in self._queues and t <= self._clock]:
+            del self._vtime[idle]
+        return future, fn
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                future, fn = self._take()
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    start = time.perf_counter()
+                    try:
+                        future.set_result(fn())
+                    except BaseException as e:
+                        future.set_exception(e)
+                    elapsed = time.perf_counter() - start
+                    with self._cond:
+                        self._avg_seconds = elapsed if self._avg_seconds is None else \
+                            self._avg_seconds * 0.9 + elapsed * 0.1
+            finally:
+                with self._cond:
+                    self._running -= 1
+    
+    def estimate_wait(self, client, count=0):
+        """粗略估算某个客户端再提交count个文件后，其所有文件转换完成还需要的秒数；没有历史耗时时返回None"""
+        with self._cond:
+            if self._avg_seconds is None:
+                return None
+            own = len(self._queues.get(client, ())) + count
+            # 轮转调度下，其他客户端在此期间最多各自插入own个文件
+            ahead = sum(min(len(q), own) for c, q in self._queues.items() if c != client)
+            return round((own + ahead + self._running) * self._avg_seconds / self.workers, 1)
+    
+    def snapshot(self):
+        with self._cond:
+            return {'waiting': sum(len(q) for q in self._queues.values()),
+                    'clients': len(self._queues),
+                    'running': self._running,
+                    'avg_seconds': self._avg_seconds}
+
+_conversion_scheduler = None
+_conversion_scheduler_lock = threading.Lock()
+
+def get_conversion_scheduler():
+    """获取转换调度器，首次使用时按配置的并发数创建转换线程"""
+    global _conversion_scheduler
+    with _conversion_scheduler_lock:
+        if _conversion_scheduler is None:
+            workers = max(1, app.config['CONVERSION_WORKERS'])
+            logger.info(f"创建转换线程，并发数: {workers}")
+            _conversion_scheduler = _FairScheduler(workers)
+        return _conversion_scheduler
+
+def scheduling_client():
+    """当前请求在公平调度中所属的客户端：X-API-Key是服务端认可的密钥时按密钥区分，否则按客户端IP
+    
+    未经认可的密钥按IP处理，避免客户端伪造带权重的密钥，或每次换一个密钥绕过公平调度
+    """
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in app.config['API_KEYS']:
+        return f'key:{api_key}'
+    return f'ip:{request.remote_addr}'
+
+def run_conversion_tasks(convert_one, tasks, on_progress=None, client=None, sizes=None):
+    """将单文件转换任务交给公平调度器，并按提交顺序返回结果
+    
+    client为任务所属的客户端，sizes为各任务的输入大小，同一客户端内小文件优先执行。
+    on_progress(index, status, result) 会在每个文件开始转换和转换结束时被调用
+    """
+    if not tasks:
+        return []
+    
+    def run(index, task):
+        global _active_conversions
+        if on_progress:
+            on_progress(index, 'converting', None)
+        with _metrics_lock:
+            _active_conversions += 1
+        try:
+            result = convert_one(task)
+        finally:
+            with _metrics_lock:
+                _active_conversions -= 1
+        increment_counter('bookforge_files_converted_total', status=result['status'])
+        if on_progress:
+            on_progress(index, result['status'], result)
+        return result
+    
+    scheduler = get_conversion_scheduler()
+    futures = [scheduler.submit(client, sizes[index] if sizes else 0,
+                                lambda index=index, task=task: run(index, task))
+               for index, task in enumerate(tasks)]
+    return [future.result() for future in futures]
+
+# 批次状态存储：批次、文件、状态、输出路径、大小和耗时写入SQLite，
+# 进程重启后或由其他工作进程处理的请求也能按批次ID查到任务，不再依赖探测文件是否存在
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'uploading',
+    status TEXT,
+    output_formats TEXT,
+    options TEXT,
+    client TEXT,
+    download_url TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL,
+    upload_bytes INTEGER NOT NULL DEFAULT 0,
+    converted_bytes INTEGER NOT NULL DEFAULT 0,
+    zip_bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    upload_failures TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS batches_state_expires ON batches (state, expires_at);
+CREATE INDEX IF NOT EXISTS batches_finished ON batches (finished_at);
+CREATE TABLE IF NOT EXISTS files (
+    batch_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    original_name TEXT,
+    output_format TEXT,
+    status TEXT,
+    progress INTEGER,
+    converted_name TEXT,
+    converted_path TEXT,
+    error TEXT,
+    cpu_seconds REAL,
+    peak_rss_bytes INTEGER,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (batch_id, position)
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    batch_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (lease_expires, enqueued_at);
+"""
+# 以JSON保存的列
+_STATE_JSON_COLUMNS = {'output_formats', 'options', 'upload_failures', 'result'}
+_state_local = threading.local()
+_state_schema_ready = set()
+_state_schema_lock = threading.Lock()
+
+def state_db():
+    """当前线程的数据库连接；fork出的子进程不复用父进程的连接"""
+    conn = getattr(_state_local, 'conn', None)
+    if conn is not None and _state_local.pid == os.getpid():
+        return conn
+    path = app.config['STATE_DB_PATH']
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL模式下读写互不阻塞，多个进程可以同时访问；WAL依赖同一台机器上的共享内存，不能放在NFS等网络文件系统上
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with _state_schema_lock:
+        if (os.getpid(), path) not in _state_schema_ready:
+            conn.executescript(_STATE_SCHEMA)
+            _state_schema_ready.add((os.getpid(), path))
+    _state_local.conn = conn
+    _state_local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def state_transaction():
+    """在一个写事务中执行多条语句，立即获取写锁，避免多进程并发升级锁时死锁"""
+    conn = state_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def _state_values(fields):
+    return [json.dumps(value, ensure_ascii=False) if key in _STATE_JSON_COLUMNS and value is not None else value
+            for key, value in fields.items()]
+
+def _upsert_batch(conn, batch_id, fields):
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' for _ in fields)
+    updates = ', '.join(f'{key} = excluded.{key}' for key in fields)
+    conn.execute(f'INSERT INTO batches (batch_id, {columns}) VALUES (?, {placeholders}) '
+                 f'ON CONFLICT (batch_id) DO UPDATE SET {updates}',
+                 [batch_id] + _state_values(fields))
+
+def store_batch(batch_id, **fields):
+    """写入批次的一个或多个字段，批次不存在时新建"""
+    with state_transaction() as conn:
+        _upsert_batch(conn, batch_id, fields)
+
+def store_job(job, converted_files=()):
+    """把任务的状态和全部文件写入存储，converted_files 提供转换结果的存储路径"""
+    with _jobs_lock:
+        fields = {key: job[key] for key in ('status', 'output_formats', 'options', 'client', 'download_url',
+                                            'created_at', 'started_at', 'finished_at', 'error',
+                                            'upload_failures', 'result')}
+        files = [dict(entry) for entry in job['files']]
+    paths = [f.get('converted_path') for f in converted_files]
+    with state_transaction() as conn:
+        _upsert_batch(conn, job['batch_id'], fields)
+        conn.executemany(
+            'INSERT OR REPLACE INTO files (batch_id, position, original_name, output_format, status, progress, '
+            'converted_name, converted_path, error, cpu_seconds, peak_rss_bytes, started_at, finished_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+            '(SELECT started_at FROM files WHERE batch_id = ? AND position = ?), '
+            '(SELECT finished_at FROM files WHERE batch_id = ? AND position = ?))',
+            [(job['batch_id'], position, entry['original_name'], entry['output_format'], entry['status'],
+              entry.get('progress'), entry.get('converted_name'), paths[position] if position < len(paths) else None,
+              entry.get('error'), entry.get('cpu_seconds'), entry.get('peak_rss_bytes'),
+              job['batch_id'], position, job['batch_id'], position)
+             for position, entry in enumerate(files)])
+
+def store_job_file(batch_id, position, entry, converted_path=None):
+    """文件状态变化时更新单个文件，同时记录开始和结束转换的时间"""
+    now = time.time()
+    finished = entry['status'] in ('success', 'failed', 'cancelled')
+    with state_transaction() as conn:
+        conn.execute(
+            'UPDATE files SET status = ?, progress = ?, converted_name = ?, converted_path = COALESCE(?, converted_path), '
+            'error = ?, cpu_seconds = ?, peak_rss_bytes = ?, '
+            'started_at = COALESCE(started_at, ?), finished_at = CASE WHEN ? THEN ? ELSE finished_at END '
+            'WHERE batch_id = ? AND position = ?',
+            (entry['status'], entry.get('progress'), entry.get('converted_name'), converted_path,
+             entry.get('error'), entry.get('cpu_seconds'), entry.get('peak_rss_bytes'),
+             None if entry['status'] == 'queued' else now, finished, now, batch_id, position))
+
+def _row_dict(row):
+    data = dict(row)
+    for key in _STATE_JSON_COLUMNS & data.keys():
+        if data[key] is not None:
+            data[key] = json.loads(data[key])
+    return data
+
+def load_batch(batch_id):
+    """读取批次记录，不存在时返回None"""
+    row = state_db().execute('SELECT * FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+    return _row_dict(row) if row is not None else None
+
+def load_batch_file(batch_id, position):
+    row = state_db().execute('SELECT * FROM files WHERE batch_id = ? AND position = ?', (batch_id, position)).fetchone()
+    return dict(row) if row is not None else None
+
+def load_batch_files(batch_id):
+    return [dict(row) for row in state_db().execute(
+        'SELECT * FROM files WHERE batch_id = ? ORDER BY position', (batch_id,))]
+
+def load_job(batch_id):
+    """从存储中还原任务记录，用于本进程内存中没有的批次（其他进程创建或进程重启前创建）"""
+    batch = load_batch(batch_id)
+    if batch is None or batch['status'] is None:
+        return None
+    files = []
+    for row in load_batch_files(batch_id):
+        entry = {'original_name': row['original_name'], 'output_format': row['output_format'],
+                 'status': row['status'], 'progress': row['progress']}
+        entry.update({key: row[key] for key in ('converted_name', 'error', 'cpu_seconds', 'peak_rss_bytes')
+                      if row[key] is not None})
+        files.append(entry)
+    output_formats = batch['output_formats'] or []
+    return {
+        'batch_id': batch_id,
+        'status': batch['status'],
+        'state': batch['state'],
+        'output_format': output_formats[0] if output_formats else None,
+        'output_formats': output_formats,
+        'options': batch['options'],
+        'client': batch['client'],
+        'created_at': batch['created_at'],
+        'started_at': batch['started_at'],
+        'finished_at': batch['finished_at'],
+        'download_url': batch['download_url'],
+        'input_files': [],
+        'upload_failures': batch['upload_failures'] or [],
+        'files': files,
+        'result': batch['result'],
+        'error': batch['error'],
+        'cancelled': batch['status'] == 'cancelled',
+        'watchers': 0
+    }
+
+def finish_stored_batch(batch_id, status, error=None):
+    """结束不在本进程中执行的批次，未完成的文件标记为相同的状态"""
+    now = time.time()
+    with state_transaction() as conn:
+        conn.execute('UPDATE batches SET status = ?, error = ?, finished_at = ? WHERE batch_id = ?',
+                     (status, error, now, batch_id))
+        conn.execute("UPDATE files SET status = ?, error = ?, finished_at = ? "
+                     "WHERE batch_id = ? AND status IN ('queued', 'converting')", (status, error, now, batch_id))
+
+def find_job(batch_id):
+    """先查本进程的任务表，没有时从存储中读取"""
+    return get_job(batch_id) or load_job(batch_id)
+
+def prune_stored_batches():
+    """删除文件已清理且超过任务保留时间的批次记录"""
+    expire_before = time.time() - app.config['JOB_RETENTION_SECONDS']
+    with state_transaction() as conn:
+        stale = [row[0] for row in conn.execute(
+            "SELECT batch_id FROM batches WHERE state IN ('removed', 'cleaned') AND finished_at < ?",
+            (expire_before,))]
+        conn.executemany('DELETE FROM files WHERE batch_id = ?', [(b,) for b in stale])
+        conn.executemany('DELETE FROM batches WHERE batch_id = ?', [(b,) for b in stale])
+    return len(stale)
+
+def recover_stored_batches():
+    """启动时把上次运行中断的批次标记为失败，返回仍保留文件的批次记录；共享队列中的批次会由工作进程继续执行"""
+    now = time.time()
+    with state_transaction() as conn:
+        interrupted = conn.execute(
+            "UPDATE batches SET status = 'failed', error = ?, finished_at = ?, state = 'failed' "
+            "WHERE status IN ('queued', 'running') AND batch_id NOT IN (SELECT batch_id FROM tasks)",
+            ('服务重启，转换中断', now)).rowcount
+        conn.execute("UPDATE files SET status = 'failed', error = ? WHERE status IN ('queued', 'converting') "
+                     "AND batch_id IN (SELECT batch_id FROM batches WHERE error = ? AND finished_at = ?)",
+                     ('服务重启，转换中断', '服务重启，转换中断', now))
+        # 上传未完成的批次同样无法继续
+        conn.execute("UPDATE batches SET state = 'failed' WHERE state IN ('uploading', 'queued', 'running') "
+                     "AND batch_id NOT IN (SELECT batch_id FROM tasks)")
+    if interrupted:
+        logger.warning(f"{interrupted} 个批次因服务重启中断，已标记为失败")
+    return [_row_dict(row) for row in state_db().execute(
+        "SELECT * FROM batches WHERE state != 'removed' ORDER BY expires_at")]
+
+# 后台批次任务：上传接口只负责保存文件并入队，由后台调度线程执行转换和打包
+JOBS = {}
+_jobs_lock = threading.Lock()
+# 任务状态发生变化时通知等待中的进度推送连接
+_job_events = threading.Condition(_jobs_lock)
+_job_runner_threads = []
+# 进程准备退出时置为False，不再接收新批次，已入队的批次继续处理完
+_accepting_jobs = True
+
+def create_job(batch_id, valid_files, failed_uploads, output_formats, options=None, client=None, download_url=None):
+    """创建批次任务记录，options为None表示普通转换；工作进程从共享队列还原任务时传入入队时的client和download_url"""
+    return {
+        'batch_id': batch_id,
+        'status': 'queued',
+        # 第一个输出格式，兼容只有一个输出格式时的接口
+        'output_format': output_formats[0],
+        'output_formats': list(output_formats),
+        'options': options,
+        # 公平调度按客户端轮转分配转换线程
+        'client': client or scheduling_client(),
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        # 下载地址需要请求上下文才能生成，因此在入队时确定
+        'download_url': download_url or url_for('download_file', batch_id=batch_id),
+        'input_files': valid_files,
+        'upload_failures': failed_uploads,
+        # 按 输出格式×文件 排列，与转换结果一一对应
+        'files': [{'original_name': f['filename'], 'output_format': fmt, 'status': 'queued', 'progress': 0}
+                  for fmt in output_formats for f in valid_files],
+        'result': None,
+        'error': None,
+        'cancelled': False,
+        # 正在订阅进度推送的连接数，全部断开一段时间后自动取消批次
+        'watchers': 0,
+        # 客户端最近一次查询状态或结果的时间，轮询中的批次不会因进度推送断开而被取消
+        'last_seen': time.time()
+    }
+
+def enqueue_job(job):
+    """登记任务并放入后台队列"""
+    broker = get_task_broker()
+    with _jobs_lock:
+        _prune_finished_jobs()
+        if broker.in_process:
+            JOBS[job['batch_id']] = job
+    store_job(job)
+    prune_stored_batches()
+    update_batch(job['batch_id'], state='queued',
+                 upload_bytes=sum(f.get('size') or 0 for f in job['input_files']))
+    # 输入文件已经落盘，预留空间只需覆盖转换结果
+    update_reservation(job['batch_id'], estimate_output_bytes(job['input_files'], job['output_formats']))
+    broker.put(job)
+    if broker.in_process:
+        _ensure_job_runners()
+    logger.info("批次 %s 已入队，包含 %s 个文件", job['batch_id'], len(job['input_files']))
+
+def get_job(batch_id):
+    with _jobs_lock:
+        return JOBS.get(batch_id)
+
+def _prune_finished_jobs():
+    """移除过期的已结束任务，调用方需持有 _jobs_lock"""
+    expire_before = time.time() - app.config['JOB_RETENTION_SECONDS']
+    for batch_id in [b for b, j in JOBS.items() if j['finished_at'] and j['finished_at'] < expire_before]:
+        del JOBS[batch_id]
+
+def _ensure_job_runners():
+    """按需启动后台调度线程"""
+    with _jobs_lock:
+        _job_runner_threads[:] = [t for t in _job_runner_threads if t.is_alive()]
+        while len(_job_runner_threads) < max(1, app.config['JOB_RUNNERS']):
+            thread = threading.Thread(target=_job_runner_loop,
+                                      name=f'job-runner-{len(_job_runner_threads)}',
+                                      daemon=True)
+            thread.start()
+            _job_runner_threads.append(thread)
+
+def stop_accepting_jobs():
+    """进程收到退出信号时调用，之后新的上传和转换请求返回503"""
+    global _accepting_jobs
+    _accepting_jobs = False
+
+def drain_jobs(timeout=None):
+    """停止接收新批次并等待已入队和进行中的批次处理完，返回是否全部完成"""
+    stop_accepting_jobs()
+    deadline = time.time() + timeout if timeout is not None else None
+    broker = get_task_broker()
+    while broker.pending():
+        if deadline is not None and time.time() >= deadline:
+            logger.warning(f"等待批次处理完成超时，仍有 {broker.pending()} 个批次未完成")
             return False
-    except FileNotFoundError:
-        logger.error("Calibre未安装或ebook-convert不在PATH中")
+        time.sleep(0.5)
+    logger.info("所有批次已处理完成")
+    return True
+
+# 进程退出前需要拒绝的新批次入口
+DRAIN_REJECTED_ENDPOINTS = {'upload_files', 'advanced_conversion',
+                            'init_resumable_upload', 'finalize_resumable_upload'}
+
+@app.before_request
+def reject_new_jobs_while_draining():
+    if not _accepting_jobs and request.endpoint in DRAIN_REJECTED_ENDPOINTS:
+        response = jsonify({'error': '服务正在重启，请稍后重试'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+# 批次队列：local 为进程内的队列，接收上传的进程自己执行转换；
+# sqlite 把批次放入状态数据库中的共享队列，由 conversion_worker.py 启动的工作进程领取执行，
+# 转换进程可以与Web前端分开扩展，但必须与Web前端在同一台机器上（状态数据库使用WAL模式）
+class LocalTaskBroker:
+    """进程内的批次队列"""
+    in_process = True
+    
+    def __init__(self):
+        self._queue = queue.Queue()
+    
+    def put(self, job):
+        self._queue.put(job['batch_id'])
+    
+    def take(self, timeout=None):
+        """取出下一个待执行的批次，超时或批次已被取消时返回None"""
+        try:
+            batch_id = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        job = get_job(batch_id)
+        if job is None or job['status'] != 'queued':
+            self._queue.task_done()
+            return None
+        return job
+    
+    def done(self, job):
+        self._queue.task_done()
+    
+    def cancel(self, batch_id):
+        # 本进程的批次由 cancel_job 直接取消
         return False
+    
+    def depth(self):
+        return self._queue.qsize()
+    
+    def pending(self):
+        """已入队但尚未处理完的批次数"""
+        return self._queue.unfinished_tasks
+
+class SqliteTaskBroker:
+    """状态数据库中的共享批次队列
+    
+    工作进程领取批次时获得租约，执行期间由心跳线程定期续约；工作进程崩溃后租约到期，
+    批次由其他工作进程重新执行，超过最大执行次数后标记为失败。
+    取消转换中的批次时只设置标记，由持有租约的工作进程在续约时发现并结束转换。
+    """
+    in_process = False
+    
+    def __init__(self, lease_seconds, max_attempts, poll_interval=1.0):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._held = {}
+        self._lock = threading.Lock()
+        self._heartbeat = None
+    
+    def put(self, job):
+        payload = {key: job[key] for key in ('input_files', 'upload_failures', 'output_formats', 'options',
+                                             'client', 'download_url', 'created_at')}
+        with state_transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO tasks (batch_id, payload, enqueued_at) VALUES (?, ?, ?)',
+                         (job['batch_id'], json.dumps(payload, ensure_ascii=False), time.time()))
+    
+    def take(self, timeout=None):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            job = self._lease()
+            if job is not None or time.time() >= deadline:
+                return job
+            time.sleep(self.poll_interval)
+    
+    def _lease(self):
+        now = time.time()
+        with state_transaction() as conn:
+            row = conn.execute('SELECT * FROM tasks WHERE lease_expires IS NULL OR lease_expires < ? '
+                               'ORDER BY enqueued_at LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            abandoned = row['cancel_requested'] or row['attempts'] >= self.max_attempts
+            if abandoned:
+                conn.execute('DELETE FROM tasks WHERE batch_id = ?', (row['batch_id'],))
+            else:
+                conn.execute('UPDATE tasks SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 '
+                             'WHERE batch_id = ?', (self.owner, now + self.lease_seconds, row['batch_id']))
+        batch_id = row['batch_id']
+        if abandoned:
+            # 取消标记仍在说明持有租约的工作进程没来得及处理就退出了
+            if row['cancel_requested']:
+                finish_stored_batch(batch_id, 'cancelled')
+                cleanup_batch_files(batch_id)
+            else:
+                logger.error(f"批次 {batch_id} 已执行 {row['attempts']} 次均未完成，不再重试")
+                finish_stored_batch(batch_id, 'failed', '转换进程多次异常退出，已放弃该批次')
+                update_batch(batch_id, state='failed')
+                increment_counter('bookforge_task_abandoned_total')
+            return None
+        if row['attempts']:
+            logger.warning(f"批次 {batch_id} 的上一次执行未完成（{row['lease_owner']} 的租约已过期），"
+                           f"开始第 {row['attempts'] + 1} 次执行")
+            increment_counter('bookforge_task_retries_total')
+        
+        payload = json.loads(row['payload'])
+        job = create_job(batch_id, payload['input_files'], payload['upload_failures'], payload['output_formats'],
+                         payload['options'], client=payload['client'], download_url=payload['download_url'])
+        job['created_at'] = payload['created_at']
+        with _jobs_lock:
+            JOBS[batch_id] = job
+        with self._lock:
+            self._held[batch_id] = job
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='task-lease-heartbeat',
+                                                   daemon=True)
+                self._heartbeat.start()
+        return job
+    
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                held = list(self._held)
+            for batch_id in held:
+                try:
+                    with state_transaction() as conn:
+                        renewed = conn.execute('UPDATE tasks SET lease_expires = ? WHERE batch_id = ? AND lease_owner = ?',
+                                               (time.time() + self.lease_seconds, batch_id, self.owner)).rowcount
+                        row = conn.execute('SELECT cancel_requested FROM tasks WHERE batch_id = ?',
+                                           (batch_id,)).fetchone()
+                except sqlite3.Error:
+                    logger.exception(f"批次 {batch_id} 续约失败")
+                    continue
+                if not renewed:
+                    # 续约间隔过长（例如进程被暂停）时批次可能已被其他工作进程重新领取，两边的结果相同
+                    logger.warning(f"批次 {batch_id} 的租约已被其他工作进程接管")
+                elif row['cancel_requested'] and cancel_job(batch_id):
+                    increment_counter('bookforge_jobs_cancelled_total', reason='request')
+    
+    def done(self, job):
+        batch_id = job['batch_id']
+        with self._lock:
+            self._held.pop(batch_id, None)
+        with state_transaction() as conn:
+            conn.execute('DELETE FROM tasks WHERE batch_id = ? AND lease_owner = ?', (batch_id, self.owner))
+        # 结果已写入存储，工作进程不再保留任务记录
+        with _jobs_lock:
+            JOBS.pop(batch_id, None)
+    
+    def cancel(self, batch_id):
+        """取消其他进程中的批次：尚未领取的直接结束，已领取的设置取消标记"""
+        with state_transaction() as conn:
+            row = conn.execute('SELECT lease_expires FROM tasks WHERE batch_id = ?', (batch_id,)).fetchone()
+            if row is None:
+                return False
+            queued = row['lease_expires'] is None
+            if queued:
+                conn.execute('DELETE FROM tasks WHERE batch_id = ?', (batch_id,))
+            else:
+                conn.execute('UPDATE tasks SET cancel_requested = 1 WHERE batch_id = ?', (batch_id,))
+        if queued:
+            finish_stored_batch(batch_id, 'cancelled')
+            cleanup_batch_files(batch_id)
+            release_reservation(batch_id)
+        return True
+    
+    def depth(self):
+        return state_db().execute('SELECT COUNT(*) FROM tasks WHERE lease_expires IS NULL OR lease_expires < ?',
+                                  (time.time(),)).fetchone()[0]
+    
+    def pending(self):
+        with self._lock:
+            return len(self._held)
+
+TASK_BROKERS = {'local': LocalTaskBroker,
+                'sqlite': lambda: SqliteTaskBroker(app.config['TASK_LEASE_SECONDS'], app.config['TASK_MAX_ATTEMPTS'])}
+_task_broker = None
+_task_broker_lock = threading.Lock()
+
+def get_task_broker():
+    """获取配置的批次队列，首次使用时创建"""
+    global _task_broker
+    with _task_broker_lock:
+        if _task_broker is None:
+            name = app.config['CONVERSION_BROKER']
+            if name not in TASK_BROKERS:
+                raise ValueError(f'未知的批次队列类型: {name}')
+            _task_broker = TASK_BROKERS[name]()
+        return _task_broker
+
+def _job_runner_loop():
+    broker = get_task_broker()
+    while True:
+        if not _accepting_jobs and not broker.in_process:
+            # 工作进程准备退出，共享队列中的批次留给其他工作进程
+            time.sleep(1)
+            continue
+        try:
+            job = broker.take(timeout=5)
+        except Exception:
+            logger.exception("领取批次失败")
+            time.sleep(5)
+            continue
+        if job is None:
+            continue
+        try:
+            with log_context(batch_id=job['batch_id']):
+                run_batch_job(job)
+        except Exception:
+            logger.exception("执行批次任务时发生异常: %s", job['batch_id'])
+        finally:
+            broker.done(job)
+
+def run_conversion_worker(graceful_timeout=None):
+    """conversion_worker.py 的入口：从共享队列领取批次并转换，收到SIGTERM或SIGINT后等待进行中的批次完成再退出"""
+    broker = get_task_broker()
+    if broker.in_process:
+        raise SystemExit('BOOKFORGE_CONVERSION_BROKER 为 local 时由Web进程自己执行转换，不需要单独的工作进程')
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    if not check_calibre_installed():
+        logger.warning("Calibre未安装或ebook-convert不在PATH中，转换将会失败")
+    _ensure_job_runners()
+    logger.info(f"转换工作进程 {broker.owner} 已启动，同时处理 {app.config['JOB_RUNNERS']} 个批次")
+    while not stop.wait(1):
+        pass
+    logger.info("转换工作进程准备退出，停止领取新批次")
+    drain_jobs(timeout=graceful_timeout)
+
+def parse_output_formats(values):
+    """解析输出格式列表，支持重复字段和逗号分隔两种写法，保持顺序并去重；为空或含有不支持的格式时返回None"""
+    formats = []
+    for value in values:
+        for fmt in str(value).split(','):
+            fmt = fmt.strip().lower()
+            if not fmt:
+                continue
+            if fmt not in ALLOWED_OUTPUT_FORMATS:
+                return None
+            if fmt not in formats:
+                formats.append(fmt)
+    return formats or None
+
+def fanout_intermediate(input_files, output_formats, options):
+    """决定多格式输出时是否先转换为中间格式，不需要时返回None"""
+    intermediate = app.config['FANOUT_INTERMEDIATE']
+    if intermediate not in ALLOWED_OUTPUT_FORMATS or len(output_formats) < 2:
+        return None
+    if all(_input_format(f['filename']) == intermediate for f in input_files):
+        return None
+    # 中间结果能直接作为其中一个输出格式时不增加转换次数；否则至少要有两个格式从中复用解析结果
+    if intermediate in output_formats and options is None:
+        return intermediate
+    if len([fmt for fmt in output_formats if fmt != intermediate]) >= 2:
+        return intermediate
+    return None
+
+def convert_batch(job, on_progress):
+    """按任务的输出格式列表转换整个批次，结果按 输出格式×文件 的顺序排列
+    
+    多个输出格式时原始文件先统一转换为中间格式（默认EPUB），Calibre只解析一次原始文件，
+    其余格式都由中间格式生成；各输出格式的转换一起提交到线程池并行执行。
+    """
+    batch_id = job['batch_id']
+    input_files = job['input_files']
+    formats = job['output_formats']
+    options = job['options']
+    count = len(input_files)
+    cancelled = lambda: job['cancelled']
+    results = [None] * (len(formats) * count)
+    # 每个文件生成各输出格式时使用的输入，经过中间格式的文件会替换为中间结果
+    sources = list(input_files)
+    via = set()
+    hidden = []  # 不属于输出格式的中间结果，转换结束后删除
+    applied = set()  # 至少对一个文件生效的高级选项
+    
+    intermediate = fanout_intermediate(input_files, formats, options)
+    if intermediate:
+        indices = [i for i, f in enumerate(input_files) if _input_format(f['filename']) != intermediate]
+        # 中间格式本身也是输出格式且没有高级选项时，中间结果直接作为该格式的输出
+        reuse = intermediate in formats and options is None
+        position = formats.index(intermediate) if reuse else None
+        
+        def intermediate_progress(index, status, result):
+            i = indices[index]
+            if reuse:
+                on_progress(position * count + i, status, result)
+            elif status == 'converting':
+                # 中间格式的转换计为该文件各输出格式进度的前一半
+                percent = (result or {}).get('progress')
+                for p in range(len(formats)):
+                    on_progress(p * count + i, status, None if percent is None else {'progress': percent // 2})
+        
+        # 输入选项作用于原始文件的解析，只能在转换为中间格式时传入
+        intermediate_options = input_conversion_options(options) if options else None
+        pipeline = ConversionPipeline(batch_id, intermediate, intermediate_options or None,
+                                      on_progress=intermediate_progress, cancelled=cancelled, client=job['client'])
+        intermediate_results = pipeline.convert([input_files[i] for i in indices])
+        applied |= pipeline.applied_options()
+        for i, result in zip(indices, intermediate_results):
+            if reuse:
+                results[position * count + i] = result
+            if result['status'] == 'success':
+                via.add(i)
+                if not reuse:
+                    hidden.append(result['converted_path'])
+                sources[i] = {
+                    'filename': input_files[i]['filename'],
+                    'path': result['converted_path'],
+                    'size': os.path.getsize(result['converted_path']),
+                    'sha256': input_files[i].get('sha256'),
+                    'source_format': _input_format(input_files[i]['filename'])
+                }
+                continue
+            # 中间格式转换失败时，该文件的所有输出格式都以同样的原因失败
+            for p, fmt in enumerate(formats):
+                if results[p * count + i] is None:
+                    results[p * count + i] = dict(result, output_format=fmt)
+                    on_progress(p * count + i, result['status'], results[p * count + i])
+    
+    def stage_progress(slot, status, result):
+        if result is not None and 'progress' in result and slot % count in via:
+            result = dict(result, progress=50 + result['progress'] // 2)
+        on_progress(slot, status, result)
+    
+    pipelines = []
+    planned = []
+    tasks = []
+    try:
+        for p, fmt in enumerate(formats):
+            pending = [i for i in range(count) if results[p * count + i] is None]
+            if not pending:
+                continue
+            pipeline = ConversionPipeline(batch_id, fmt, options, on_progress=stage_progress, cancelled=cancelled)
+            pipelines.append(pipeline)
+            contexts = pipeline.plan([sources[i] for i in pending])
+            for i, ctx in zip(pending, contexts):
+                # 以任务文件列表中的位置作为序号上报进度
+                ctx['index'] = p * count + i
+            planned.extend(contexts)
+            tasks.extend((pipeline, ctx) for ctx in pipeline.group_duplicates(contexts))
+        
+        run_conversion_tasks(lambda task: task[0].process(task[1]), tasks,
+                             lambda index, status, result: stage_progress(tasks[index][1]['index'], status, result),
+                             client=job['client'],
+                             sizes=[ctx['file'].get('size') or 0 for _, ctx in tasks])
+        for ctx in planned:
+            results[ctx['index']] = ctx['outcome']
+    finally:
+        for pipeline in pipelines:
+            pipeline.cleanup()
+            applied |= pipeline.applied_options()
+        if options:
+            # 每个批次只记录一次，不按文件重复
+            dropped = sorted(set(options) - applied)
+            if dropped:
+                logger.warning("忽略不支持的转换选项: %s", ', '.join(dropped))
+        for path in hidden:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return results
+
+def run_batch_job(job):
+    """在后台线程中转换整个批次并打包ZIP"""
+    batch_id = job['batch_id']
+    with _jobs_lock:
+        if job['cancelled']:
+            return
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        _job_events.notify_all()
+    store_job(job)
+    update_batch(batch_id, state='running')
+    
+    def on_progress(index, status, result):
+        with _jobs_lock:
+            entry = job['files'][index]
+            changed = entry['status'] != status
+            entry['status'] = status
+            if status == 'success':
+                entry['progress'] = 100
+            if result is not None:
+                for key in ('converted_name', 'error', 'progress', 'cpu_seconds', 'peak_rss_bytes'):
+                    if key in result:
+                        entry[key] = result[key]
+            _job_events.notify_all()
+            snapshot = dict(entry)
+        # 只在文件状态变化时写入存储，转换百分比的更新只保存在内存中
+        if changed:
+            store_job_file(batch_id, index, snapshot, result.get('converted_path') if result else None)
+    
+    try:
+        converted_files = convert_batch(job, on_progress)
+        
+        if job['cancelled']:
+            with _jobs_lock:
+                job['status'] = 'cancelled'
+                job['finished_at'] = time.time()
+                _job_events.notify_all()
+            store_job(job, converted_files)
+            cleanup_batch_files(batch_id)
+            logger.info("批次 %s 已取消", batch_id)
+            return
+        
+        # 流式下载模式在下载时才生成ZIP
+        zip_bytes = 0
+        if app.config['ZIP_MODE'] != 'stream':
+            zip_bytes = os.path.getsize(create_zip_file(converted_files, batch_id))
+        update_batch(batch_id, state='converted', zip_bytes=zip_bytes,
+                     converted_bytes=sum(os.path.getsize(f['converted_path'])
+                                         for f in converted_files if f['status'] == 'success'))
+        for index, converted in enumerate(converted_files):
+            if converted['status'] == 'success':
+                converted['download_url'] = f"{job['download_url']}/files/{index}"
+            input_file = job['input_files'][index % len(job['input_files'])]
+            if converted['status'] == 'success' and input_file.get('size'):
+                record_expansion(input_file['filename'], converted['output_format'], input_file['size'],
+                                 os.path.getsize(converted['converted_path']))
+        
+        result = {
+            'success': True,
+            'message': f'成功转换 {len([f for f in converted_files if f["status"] == "success"])} 个文件',
+            'download_url': job['download_url'],
+            'files': job['upload_failures'] + converted_files,
+            # 整个批次的转换进程累计CPU时间和单个进程的最大峰值内存
+            'cpu_seconds': round(sum(f.get('cpu_seconds', 0) for f in converted_files), 3),
+            'peak_rss_bytes': max([f.get('peak_rss_bytes', 0) for f in converted_files] or [0])
+        }
+        with _jobs_lock:
+            job['result'] = result
+            job['status'] = 'completed'
+            job['finished_at'] = time.time()
+            _job_events.notify_all()
+        store_job(job, converted_files)
+        logger.info("批次 %s 处理完成，CPU时间 %s 秒，峰值内存 %s MB",
+                    batch_id, result['cpu_seconds'], result['peak_rss_bytes'] // (1024 * 1024))
+    except Exception as e:
+        logger.exception("批次 %s 处理失败", batch_id)
+        with _jobs_lock:
+            job['error'] = str(e)
+            job['status'] = 'failed'
+            job['finished_at'] = time.time()
+            _job_events.notify_all()
+        store_job(job)
+        update_batch(batch_id, state='failed')
+    finally:
+        release_reservation(batch_id)
+        forget_batch_processes(batch_id)
+
+def cancel_job(batch_id):
+    """取消排队或转换中的批次，结束其正在运行的ebook-convert进程组；返回是否发起了取消"""
+    with _jobs_lock:
+        job = JOBS.get(batch_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return False
+        job['cancelled'] = True
+        queued = job['status'] == 'queued'
+        if queued:
+            # 尚未开始的批次直接结束，后台线程取到时会跳过
+            job['status'] = 'cancelled'
+            job['finished_at'] = time.time()
+            for entry in job['files']:
+                entry['status'] = 'cancelled'
+        _job_events.notify_all()
+    
+    logger.info("取消批次: %s", batch_id)
+    if queued:
+        store_job(job)
+        cleanup_batch_files(batch_id)
+        release_reservation(batch_id)
+    else:
+        cancel_batch_processes(batch_id)
+    return True
+
+def job_accepted_response(job):
+    """上传接口的统一响应：任务已入队"""
+    return jsonify({
+        'success': True,
+        'batch_id': job['batch_id'],
+        'status': job['status'],
+        'message': f'已接收 {len(job["input_files"])} 个文件，正在排队转换',
+        'status_url': url_for('job_status', batch_id=job['batch_id']),
+        'result_url': url_for('job_result', batch_id=job['batch_id']),
+        'progress_url': url_for('progress_stream', batch_id=job['batch_id']),
+        'estimated_wait_seconds': estimate_job_wait(job),
+        'files': job['upload_failures'] + [dict(f) for f in job['files']]
+    }), 202
+
+def estimate_job_wait(job):
+    """估算批次还需要多少秒完成转换，尚未开始的批次按全部文件计算
+    
+    批次由转换工作进程执行时本进程没有调度器可供估算，返回None
+    """
+    if not get_task_broker().in_process:
+        return None
+    pending = len(job['files']) if job['status'] == 'queued' else 0
+    return get_conversion_scheduler().estimate_wait(job['client'], pending)
+
+# Calibre能力注册表：进程启动时探测一次（版本、路径、可用的输入/输出插件，各输出格式和输入插件的选项），
+# 之后只有ebook-convert文件的修改时间变化（升级或替换）时才会重新探测
+_calibre_registry = None
+_calibre_registry_lock = threading.Lock()
+
+# ebook-convert -h 输出中的选项行，例如 "  --paper-size=PAPER_SIZE" 或 "  -h, --help"
+_HELP_OPTION_RE = re.compile(r'^\s{2}(?:-\w, )?--([a-z0-9][a-z0-9-]*)(?:=(\S+))?\s*(.*)$')
+# 分组标题，例如 "OUTPUT OPTIONS:"
+_HELP_SECTION_RE = re.compile(r'^([A-Z][A-Z /-]+):\s*$')
+
+def _run_calibre(path, args, timeout=60):
+    return subprocess.run([path] + args,
+                          capture_output=True,
+                          text=True,
+                          encoding='utf-8',
+                          errors='replace',
+                          timeout=timeout)
+
+def parse_calibre_help(help_text):
+    """解析 ebook-convert -h 的输出，返回选项列表 [{name, section, value, help}]"""
+    options = []
+    section = None
+    current = None
+    for line in help_text.splitlines():
+        section_match = _HELP_SECTION_RE.match(line)
+        if section_match:
+            section = section_match.group(1).strip().lower()
+            current = None
+            continue
+        option_match = _HELP_OPTION_RE.match(line)
+        if option_match:
+            name = option_match.group(1)
+            if name in ('help', 'version'):
+                current = None
+                continue
+            current = {
+                'name': name.replace('-', '_'),
+                'section': section,
+                'value': option_match.group(2),
+                'help': option_match.group(3).strip()
+            }
+            options.append(current)
+        elif current is not None and line.strip():
+            current['help'] = f"{current['help']} {line.strip()}".strip()
+        else:
+            current = None
+    return options
+
+def _probe_conversion_help(path, input_format, output_format):
+    """以 ebook-convert x.<输入> x.<输出> -h 探测插件，插件不存在时返回None"""
+    try:
+        result = _run_calibre(path, [f'input.{input_format}', f'output.{output_format}', '-h'])
+    except Exception as e:
+        logger.error(f"探测Calibre插件失败: {input_format} -> {output_format}: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+def build_calibre_registry():
+    """探测Calibre的安装信息和插件能力"""
+    path = shutil.which('ebook-convert')
+    registry = {
+        'installed': False,
+        'path': path or 'ebook-convert',
+        'mtime': None,
+        'version': None,
+        'input_formats': set(),
+        'output_formats': set(),
+        'format_options': {},
+        'input_options': {}
+    }
+    if path is None:
+        logger.error("Calibre未安装或ebook-convert不在PATH中")
+        return registry
+    
+    registry['mtime'] = os.stat(path).st_mtime
+    try:
+        with stage_timer('calibre_probe'):
+            result = _run_calibre(path, ['--version'])
     except Exception as e:
         logger.error(f"检查Calibre安装时出错: {e}")
+        return registry
+    if result.returncode != 0:
+        logger.error("ebook-convert命令返回错误代码")
+        return registry
+    
+    lines = result.stdout.strip().splitlines()
+    registry['version'] = lines[0] if lines else 'Unknown version'
+    registry['installed'] = True
+    
+    # 各格式的探测互不依赖，并行执行以缩短启动时间
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        output_probes = {fmt: executor.submit(_probe_conversion_help, path, 'epub', fmt)
+                         for fmt in ALLOWED_OUTPUT_FORMATS}
+        input_probes = {fmt: executor.submit(_probe_conversion_help, path, fmt, 'epub')
+                        for fmt in ALLOWED_INPUT_EXTENSIONS}
+        for fmt, future in output_probes.items():
+            help_text = future.result()
+            if help_text is not None:
+                registry['output_formats'].add(fmt)
+                # 输入选项属于探测时使用的EPUB输入插件，与输出格式无关
+                registry['format_options'][fmt] = [option for option in parse_calibre_help(help_text)
+                                                   if option['section'] != 'input options']
+        for fmt, future in input_probes.items():
+            help_text = future.result()
+            if help_text is not None:
+                registry['input_formats'].add(fmt)
+                registry['input_options'][fmt] = [option for option in parse_calibre_help(help_text)
+                                                  if option['section'] == 'input options']
+    
+    logger.info(f"Calibre已安装: {registry['version']} ({path})，"
+                f"支持输入格式 {len(registry['input_formats'])} 种，输出格式 {len(registry['output_formats'])} 种")
+    return registry
+
+def get_calibre_registry():
+    """获取Calibre能力注册表，ebook-convert被替换时自动重新探测"""
+    global _calibre_registry
+    with _calibre_registry_lock:
+        registry = _calibre_registry
+        if registry is not None:
+            try:
+                current_mtime = os.stat(registry['path']).st_mtime if registry['mtime'] is not None else None
+            except OSError:
+                current_mtime = None
+            if current_mtime == registry['mtime']:
+                return registry
+            logger.info("检测到ebook-convert发生变化，重新探测Calibre")
+        _calibre_registry = build_calibre_registry()
+        return _calibre_registry
+
+def get_calibre_path():
+    return get_calibre_registry()['path']
+
+def get_calibre_version():
+    """Calibre版本字符串，用于区分不同版本的转换结果"""
+    return get_calibre_registry()['version'] or 'unknown'
+
+# 常驻Calibre进程池：每个进程通过 calibre-debug 加载一次Calibre，之后经管道逐个接收转换请求，
+# 省去每个文件重新启动Calibre解释器、加载插件的开销。进程数量受转换线程池的并发数限制
+CALIBRE_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibre_worker.py')
+_warm_workers = queue.LifoQueue()  # 空闲的常驻进程，后进先出以便多余的进程自然闲置
+_warm_engine_lock = threading.Lock()
+_warm_engine_retry_at = 0  # 常驻进程启动失败后，在此时间之前直接使用一次性进程
+
+def get_calibre_debug_path():
+    """查找与ebook-convert同一安装目录下的calibre-debug"""
+    calibre_path = get_calibre_path()
+    if calibre_path:
+        name = 'calibre-debug.exe' if calibre_path.lower().endswith('.exe') else 'calibre-debug'
+        candidate = os.path.join(os.path.dirname(calibre_path), name)
+        if os.path.isfile(candidate):
+            return candidate
+    return shutil.which('calibre-debug')
+
+def _read_worker_reply(process, timeout):
+    """读取常驻进程的一行应答，超时返回None"""
+    ready, _, _ = select.select([process.stdout], [], [], timeout)
+    if not ready:
+        return None
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError(f"Calibre常驻进程已退出，退出码: {process.poll()}")
+    return json.loads(line)
+
+def _start_warm_worker():
+    """启动一个常驻Calibre进程，等待其加载完成"""
+    debug_path = get_calibre_debug_path()
+    if not debug_path:
+        raise RuntimeError("未找到calibre-debug")
+    process = subprocess.Popen(sandboxed_command([debug_path, '-e', CALIBRE_WORKER_SCRIPT]),
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               text=True,
+                               encoding='utf-8',
+                               errors='replace',
+                               bufsize=1,
+                               env=os.environ.copy(),
+                               start_new_session=True)
+    apply_process_limits(process.pid, limit_cpu=False)
+    try:
+        ready = _read_worker_reply(process, timeout=60)
+    except Exception:
+        ready = None
+    if not ready or not ready.get('ready'):
+        process.kill()
+        process.wait()
+        raise RuntimeError("Calibre常驻进程启动失败")
+    logger.info("已启动Calibre常驻进程: pid=%s", process.pid)
+    return {'process': process, 'jobs': 0, 'base_rss': ready.get('rss', 0), 'rss': ready.get('rss', 0),
+            'cpu': ready.get('cpu', 0)}
+
+def _stop_warm_worker(worker, reason):
+    """关闭常驻进程：先关闭输入让其自行退出，超时再强制结束"""
+    process = worker['process']
+    logger.info("停止Calibre常驻进程: pid=%s，原因: %s，已完成 %s 次转换", process.pid, reason, worker['jobs'])
+    increment_counter('bookforge_calibre_worker_exits_total', reason=reason)
+    try:
+        process.stdin.close()
+        process.wait(timeout=5)
+    except Exception:
+        process.kill()
+        process.wait()
+
+def _acquire_warm_worker():
+    """取一个空闲的常驻进程，没有时新启动一个；启动失败返回None"""
+    global _warm_engine_retry_at
+    while True:
+        try:
+            worker = _warm_workers.get_nowait()
+        except queue.Empty:
+            break
+        if worker['process'].poll() is None:
+            return worker
+        _stop_warm_worker(worker, 'exited')
+    
+    if time.time() < _warm_engine_retry_at:
+        return None
+    try:
+        return _start_warm_worker()
+    except Exception as e:
+        logger.warning("无法启动Calibre常驻进程，暂时改用一次性进程: %s", e)
+        with _warm_engine_lock:
+            _warm_engine_retry_at = time.time() + 300
+        return None
+
+def _release_warm_worker(worker, healthy):
+    """归还常驻进程，达到转换次数或内存增长上限时回收"""
+    if not healthy:
+        _stop_warm_worker(worker, 'error')
+    elif worker['jobs'] >= app.config['CALIBRE_WORKER_MAX_JOBS']:
+        _stop_warm_worker(worker, 'max_jobs')
+    elif worker['rss'] - worker['base_rss'] > app.config['CALIBRE_WORKER_MAX_RSS_GROWTH']:
+        _stop_warm_worker(worker, 'memory')
+    else:
+        _warm_workers.put(worker)
+
+def _run_on_warm_worker(cmd, timeout, batch_id=None):
+    """在常驻进程中执行一次转换，没有可用的常驻进程时返回None"""
+    worker = _acquire_warm_worker()
+    if worker is None:
+        return None
+    healthy = False
+    process = worker['process']
+    _register_process(batch_id, process)
+    try:
+        process.stdin.write(json.dumps({'args': cmd[1:]}) + '\n')
+        process.stdin.flush()
+        reply = _read_worker_reply(process, timeout)
+        if reply is None:
+            # 超时的转换可能仍在进行，只能结束整个常驻进程
+            kill_process_group(process)
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        worker['jobs'] += 1
+        worker['rss'] = reply.get('rss', 0)
+        # 常驻进程只能报告累计的CPU时间和转换结束时的常驻内存
+        usage = {'cpu_seconds': round(reply.get('cpu', 0) - worker['cpu'], 3), 'peak_rss_bytes': worker['rss']}
+        worker['cpu'] = reply.get('cpu', 0)
+        healthy = True
+        result = subprocess.CompletedProcess(cmd, reply['returncode'], reply['stdout'], reply['stderr'])
+        result.usage = usage
+        return result
+    finally:
+        _unregister_process(batch_id, process)
+        _release_warm_worker(worker, healthy)
+
+def shutdown_warm_workers():
+    """关闭所有空闲的常驻进程"""
+    while True:
+        try:
+            worker = _warm_workers.get_nowait()
+        except queue.Empty:
+            return
+        _stop_warm_worker(worker, 'shutdown')
+
+atexit.register(shutdown_warm_workers)
+
+class ConversionCancelled(Exception):
+    """所属批次已被取消"""
+
+# 正在运行的ebook-convert进程（一次性进程或正在执行转换的常驻进程），按批次登记，取消批次时结束整个进程组
+_batch_processes = {}  # batch_id -> set(Popen)
+_cancelled_batches = set()
+_batch_processes_lock = threading.Lock()
+
+def kill_process_group(process):
+    """结束进程及其启动的子进程（Calibre会为部分格式再启动工作进程）"""
+    try:
+        if os.name != 'nt':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _register_process(batch_id, process):
+    if batch_id is None:
+        return
+    with _batch_processes_lock:
+        _batch_processes.setdefault(batch_id, set()).add(process)
+        cancelled = batch_id in _cancelled_batches
+    if cancelled:
+        kill_process_group(process)
+
+def _unregister_process(batch_id, process):
+    with _batch_processes_lock:
+        processes = _batch_processes.get(batch_id)
+        if processes is not None:
+            processes.discard(process)
+            if not processes:
+                del _batch_processes[batch_id]
+
+def is_batch_cancelled(batch_id):
+    with _batch_processes_lock:
+        return batch_id in _cancelled_batches
+
+def cancel_batch_processes(batch_id):
+    """标记批次已取消并结束其正在运行的进程组"""
+    with _batch_processes_lock:
+        _cancelled_batches.add(batch_id)
+        processes = list(_batch_processes.get(batch_id, ()))
+    for process in processes:
+        logger.info("结束批次 %s 的转换进程: pid=%s", batch_id, process.pid)
+        kill_process_group(process)
+
+def forget_batch_processes(batch_id):
+    with _batch_processes_lock:
+        _cancelled_batches.discard(batch_id)
+        _batch_processes.pop(batch_id, None)
+
+# 转换进程的资源隔离：每个ebook-convert运行在单独的进程组中，启动后立即设置rlimit和nice值，
+# Calibre之后再启动的子进程会继承这些限制。不使用preexec_fn，避免在多线程的服务进程中fork后执行Python代码
+_IONICE_CLASSES = {'best-effort': '2', 'idle': '3'}
+
+def sandboxed_command(cmd):
+    """按配置在命令前加上ionice，ionice通过exec启动目标程序，进程ID不变"""
+    io_class, _, level = app.config['CONVERSION_IONICE'].partition(':')
+    if os.name == 'nt' or io_class not in _IONICE_CLASSES:
+        return list(cmd)
+    ionice = shutil.which('ionice')
+    if ionice is None:
+        return list(cmd)
+    prefix = [ionice, '-c', _IONICE_CLASSES[io_class]]
+    if level and io_class == 'best-effort':
+        prefix += ['-n', level]
+    return prefix + list(cmd)
+
+def apply_process_limits(pid, limit_cpu=True):
+    """为刚启动的转换进程设置资源限制和CPU优先级，常驻进程不限制累计的CPU时间"""
+    if resource is None:
+        return
+    limits = []
+    if app.config['CONVERSION_MAX_MEMORY_BYTES']:
+        limits.append((resource.RLIMIT_AS, app.config['CONVERSION_MAX_MEMORY_BYTES'], 0))
+    if limit_cpu and app.config['CONVERSION_MAX_CPU_SECONDS']:
+        # 超出软限制时收到SIGXCPU，留出几秒再由硬限制强制结束
+        limits.append((resource.RLIMIT_CPU, app.config['CONVERSION_MAX_CPU_SECONDS'], 5))
+    if app.config['CONVERSION_MAX_OPEN_FILES']:
+        limits.append((resource.RLIMIT_NOFILE, app.config['CONVERSION_MAX_OPEN_FILES'], 0))
+    try:
+        if limits and hasattr(resource, 'prlimit'):
+            for which, soft, grace in limits:
+                hard = soft + grace
+                # 普通用户不能调高硬限制
+                current_hard = resource.prlimit(pid, which)[1]
+                if current_hard != resource.RLIM_INFINITY:
+                    soft, hard = min(soft, current_hard), min(hard, current_hard)
+                resource.prlimit(pid, which, (soft, hard))
+        if app.config['CONVERSION_NICE']:
+            os.setpriority(os.PRIO_PROCESS, pid,
+                           os.getpriority(os.PRIO_PROCESS, 0) + app.config['CONVERSION_NICE'])
+    except (OSError, ValueError) as e:
+        # 进程已经退出或没有权限时不影响转换本身
+        logger.warning("设置转换进程的资源限制失败: pid=%s, %s", pid, e)
+
+def _wait_with_usage(process):
+    """等待进程结束，返回(退出码, 资源占用)；资源占用包含已回收的子进程，不支持wait4的平台上为None"""
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # Linux上ru_maxrss以KB为单位，macOS上以字节为单位
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return process.returncode, {'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+                                'peak_rss_bytes': rusage.ru_maxrss * scale}
+
+# Calibre输出中的进度行，例如 "34% Running transforms on e-book..."
+_CALIBRE_PROGRESS_RE = re.compile(r'^\s*(\d{1,3})%\s')
+
+def _run_oneshot(cmd, timeout, on_progress=None, batch_id=None):
+    """启动一次ebook-convert，逐行读取输出并解析进度百分比，标准输出只保留最后若干行"""
+    env = os.environ.copy()  # 使用隔离的环境变量
+    env['PYTHONUNBUFFERED'] = '1'  # 让Calibre的进度输出按行到达
+    process = subprocess.Popen(sandboxed_command(cmd),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True,
+                               encoding='utf-8',
+                               errors='replace',
+                               bufsize=1,
+                               env=env,
+                               start_new_session=True)  # 单独的进程组，超时或取消时连同子进程一起结束
+    apply_process_limits(process.pid)
+    _register_process(batch_id, process)
+    # 标准错误同样只保留最后若干行，错误信息取自末尾
+    stderr_lines = deque(maxlen=200)
+    stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+    stderr_reader.start()
+    timed_out = threading.Event()
+    
+    def kill_on_timeout():
+        timed_out.set()
+        kill_process_group(process)
+    
+    timer = threading.Timer(timeout, kill_on_timeout)
+    timer.start()
+    stdout_tail = deque(maxlen=200)
+    last_percent = None
+    try:
+        for line in process.stdout:
+            stdout_tail.append(line)
+            match = _CALIBRE_PROGRESS_RE.match(line)
+            if match and on_progress is not None:
+                percent = min(100, int(match.group(1)))
+                if percent != last_percent:
+                    last_percent = percent
+                    on_progress(percent)
+        returncode, usage = _wait_with_usage(process)
+        stderr_reader.join()
+    finally:
+        timer.cancel()
+        _unregister_process(batch_id, process)
+        if process.poll() is None:
+            kill_process_group(process)
+            process.wait()
+    
+    if batch_id is not None and is_batch_cancelled(batch_id):
+        raise ConversionCancelled()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=''.join(stdout_tail), stderr=''.join(stderr_lines))
+    result = subprocess.CompletedProcess(cmd, returncode, ''.join(stdout_tail), ''.join(stderr_lines))
+    result.usage = usage
+    return result
+
+def run_ebook_convert(cmd, timeout=300, on_progress=None, batch_id=None):
+    """执行一次ebook-convert转换，返回包含returncode/stdout/stderr的结果
+    
+    启用warm模式时优先交给常驻进程，常驻进程不可用或异常退出时改用一次性进程重新执行。
+    on_progress(percent) 在一次性进程输出新的进度百分比时调用；常驻进程只在结束时返回结果。
+    指定batch_id时进程登记在该批次下，批次被取消时结束进程并抛出ConversionCancelled。
+    """
+    if app.config['CALIBRE_ENGINE'] == 'warm' and os.name != 'nt':
+        try:
+            result = _run_on_warm_worker(cmd, timeout, batch_id)
+            if result is not None:
+                return result
+        except subprocess.TimeoutExpired:
+            raise
+        except Exception as e:
+            if batch_id is not None and is_batch_cancelled(batch_id):
+                raise ConversionCancelled()
+            logger.warning("Calibre常驻进程执行失败，改用一次性进程: %s", e)
+        increment_counter('bookforge_calibre_oneshot_fallbacks_total')
+    
+    return _run_oneshot(cmd, timeout, on_progress, batch_id)
+
+# 转换结果缓存：以(输入内容SHA-256, 输出格式, 转换选项, Calibre版本)为键，
+# 缓存文件以硬链接（或reflink）的方式放入批次目录，命中时不产生数据拷贝
+_cache_index = OrderedDict()  # key -> (path, size)，按最近使用顺序排列
+_cache_lock = threading.Lock()
+_cache_loaded = False
+_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+FICLONE = 0x40049409  # Linux ioctl：创建共享数据块的文件副本(reflink)
+
+def conversion_cache_enabled():
+    return app.config['CONVERSION_CACHE_MAX_BYTES'] > 0
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_cache_key(content_hash, input_format, output_format, options=None):
+    """生成缓存键，选项按命令行中实际生效的形式归一化
+    
+    Calibre按扩展名选择输入插件，因此输入格式也是键的一部分
+    """
+    normalized_options = sorted(
+        (key.replace('-', '_'), str(value).strip())
+        for key, value in (options or {}).items() if value
+    )
+    material = json.dumps([content_hash, input_format, output_format, normalized_options, get_calibre_version()])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _cache_path(key, output_format):
+    return os.path.join(app.config['CACHE_FOLDER'], key[:2], f"{key}.{output_format}")
+
+def _load_cache_index():
+    """启动后首次使用时扫描缓存目录，按修改时间（即最近使用时间）重建LRU顺序，调用方需持有 _cache_lock"""
+    global _cache_loaded
+    if _cache_loaded:
+        return
+    entries = []
+    for root, _, filenames in os.walk(app.config['CACHE_FOLDER']):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, os.path.splitext(filename)[0], path, stat.st_size))
+    for _, key, path, size in sorted(entries):
+        _cache_index[key] = (path, size)
+    _cache_loaded = True
+    logger.info(f"已加载转换缓存索引，共 {len(_cache_index)} 个条目")
+
+def link_or_copy(src, dst):
+    """优先用硬链接放置文件，其次尝试reflink，最后才复制数据"""
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return 'reflink'
+    except (OSError, ImportError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def cache_lookup(key, output_file):
+    """缓存命中时把结果放到 output_file 并返回 True"""
+    with _cache_lock:
+        _load_cache_index()
+        entry = _cache_index.get(key)
+        if entry is None:
+            _cache_stats['misses'] += 1
+            return False
+        _cache_index.move_to_end(key)
+        _cache_stats['hits'] += 1
+    path = entry[0]
+    try:
+        method = link_or_copy(path, output_file)
+        # 更新修改时间，重启后仍能保持LRU顺序
+        os.utime(path)
+        logger.debug("转换缓存命中: %s (%s)", key, method)
+        return True
+    except OSError as e:
+        logger.warning("读取转换缓存失败，将重新转换: %s", e)
+        with _cache_lock:
+            _cache_index.pop(key, None)
         return False
 
+def cache_store(key, output_format, output_file):
+    """把转换结果登记到缓存，并在超出容量时淘汰最久未使用的条目"""
+    path = _cache_path(key, output_format)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            link_or_copy(output_file, temp_path)
+            os.replace(temp_path, path)
+        size = os.path.getsize(path)
+    except OSError as e:
+        logger.warning("写入转换缓存失败: %s", e)
+        return
+    
+    evicted = []
+    with _cache_lock:
+        _load_cache_index()
+        _cache_index[key] = (path, size)
+        _cache_index.move_to_end(key)
+        _cache_stats['stores'] += 1
+        total = sum(entry_size for _, entry_size in _cache_index.values())
+        while total > app.config['CONVERSION_CACHE_MAX_BYTES'] and len(_cache_index) > 1:
+            _, (old_path, old_size) = _cache_index.popitem(last=False)
+            evicted.append(old_path)
+            total -= old_size
+            _cache_stats['evictions'] += 1
+    
+    for old_path in evicted:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    if evicted:
+        logger.info("转换缓存已淘汰 %s 个条目", len(evicted))
+
+def conversion_cache_stats():
+    with _cache_lock:
+        _load_cache_index()
+        stats = dict(_cache_stats)
+        stats['entries'] = len(_cache_index)
+        stats['bytes'] = sum(size for _, size in _cache_index.values())
+    stats['max_bytes'] = app.config['CONVERSION_CACHE_MAX_BYTES']
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def check_calibre_installed():
+    """检查Calibre是否已安装，同时建立Calibre能力注册表"""
+    return get_calibre_registry()['installed']
+
 @app.route('/')
 def index():
     return render_template('index.html', output_formats=ALLOWED_OUTPUT_FORMATS)
 
+def unique_storage_name(original_filename, original_ext, batch_folder):
+    """普通转换：为存储生成唯一文件名，原始文件名只用于后续处理"""
+    return f"{uuid.uuid4().hex}.{original_ext}"
+
+def safe_storage_name(original_filename, original_ext, batch_folder):
+    """高级转换：生成安全的文件名，但保留原始扩展名"""
+    name_part = secure_filename(os.path.splitext(original_filename)[0])
+    
+    # 确保文件名不为空
+    if not name_part:
+        name_part = "unnamed_file"
+    
+    # 同名文件不能互相覆盖
+    safe_filename = f"{name_part}.{original_ext}"
+    counter = 1
+    while os.path.exists(os.path.join(batch_folder, safe_filename)):
+        safe_filename = f"{name_part}_{counter}.{original_ext}"
+        counter += 1
+    return safe_filename
+
+def _open_upload_part(original_filename, batch_folder, storage_name):
+    """处理文件部分的头信息：校验扩展名并打开目标文件，不合格的文件只读过、不落盘"""
+    part = {'info': None, 'file': None, 'hash': None, 'size': 0}
+    if not original_filename:
+        return part
+    logger.debug("处理上传文件: %s", original_filename)
+    
+    # 检查文件是否有扩展名
+    if '.' not in original_filename:
+        part['info'] = {
+            'filename': original_filename,
+            'status': 'failed',
+            'error': '文件必须有扩展名'
+        }
+        return part
+    
+    # 检查扩展名是否在允许列表中
+    if not allowed_file(original_filename, ALLOWED_INPUT_EXTENSIONS):
+        part['info'] = {
+            'filename': original_filename,
+            'status': 'failed',
+            'error': f'不支持的文件格式。支持的格式：{", ".join(ALLOWED_INPUT_EXTENSIONS)}'
+        }
+        return part
+    
+    # 提取原始扩展名
+    original_ext = original_filename.rsplit('.', 1)[1].lower()
+    stored_filename = storage_name(original_filename, original_ext, batch_folder)
+    file_path = os.path.join(batch_folder, stored_filename)
+    logger.debug("存储文件名: %s", stored_filename)
+    
+    part['info'] = {
+        'filename': original_filename,  # 使用原始文件名
+        'path': file_path,
+        'status': 'uploaded'
+    }
+    part['file'] = open(file_path, 'wb')
+    part['hash'] = hashlib.sha256()
+    return part
+
+# 上传预检：按文件头的魔数识别真实格式，并做廉价的结构检查（ZIP中央目录、PDF结尾标记、MOBI/PDB记录表）。
+# 损坏的文件在上传阶段直接拒绝，扩展名与内容不符的文件改用实际格式交给Calibre，都不会占用转换线程
+TEXT_INPUT_FORMATS = {'txt', 'html', 'rtf', 'fb2'}
+# 同一种Palm数据库容器的扩展名
+PDB_INPUT_FORMATS = {'mobi', 'azw', 'azw3', 'prc'}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+class PreflightError(ValueError):
+    """文件已损坏或内容与扩展名不符"""
+
+def _inspect_zip(path):
+    """读取ZIP中央目录区分EPUB/DOCX/ODT/CBZ，中央目录缺失说明文件不完整"""
+    try:
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+            mimetype = zf.read('mimetype')[:64].decode('ascii', 'replace').strip() if 'mimetype' in names else ''
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError) as e:
+        raise PreflightError(f'ZIP结构已损坏或文件不完整: {e}')
+    if mimetype == 'application/epub+zip' or 'META-INF/container.xml' in names:
+        return 'epub'
+    if mimetype == 'application/vnd.oasis.opendocument.text':
+        return 'odt'
+    if 'word/document.xml' in names:
+        return 'docx'
+    if any(name.lower().endswith(IMAGE_EXTENSIONS) for name in names):
+        return 'cbz'
+    return 'zip'
+
+def _check_pdf_trailer(path, size):
+    """PDF的结尾标记位于最后1024字节内，缺失通常是下载或上传被截断"""
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - 1024))
+        if b'%%EOF' not in f.read():
+            raise PreflightError('PDF文件不完整（缺少结尾标记）')
+
+def _check_pdb_records(path, head, size):
+    """检查PDB记录表：记录偏移量必须递增且位于文件范围内"""
+    count = int.from_bytes(head[76:78], 'big')
+    if count == 0 or 78 + 8 * count > size:
+        raise PreflightError('MOBI/PDB文件头已损坏')
+    with open(path, 'rb') as f:
+        f.seek(78)
+        table = f.read(8 * count)
+    offsets = [int.from_bytes(table[i * 8:i * 8 + 4], 'big') for i in range(count)]
+    if offsets[0] < 78 + 8 * count or offsets[-1] >= size or any(b < a for a, b in zip(offsets, offsets[1:])):
+        raise PreflightError('MOBI/PDB文件不完整')
+
+def sniff_format(path, declared=None):
+    """按文件头识别格式并检查结构，文件损坏时抛出PreflightError
+    
+    除输入格式外还可能返回 'zip'（无法细分的ZIP压缩包）或 'binary'（无法识别的二进制文件）。
+    PDF阅读器允许 %PDF- 标记前有少量垃圾字节，只有扩展名本身是.pdf时才接受这种偏移，
+    否则正文中提到 "%PDF-1.4" 的文本文件会被误判为PDF
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(4096)
+    if not head:
+        raise PreflightError('文件为空')
+    if head.startswith(b'%PDF-') or (declared == 'pdf' and b'%PDF-' in head[:1024]):
+        _check_pdf_trailer(path, size)
+        return 'pdf'
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return _inspect_zip(path)
+    if head.startswith(b'Rar!\x1a\x07'):
+        return 'cbr'
+    if head.startswith(b'ITOLITLS'):
+        return 'lit'
+    if len(head) >= 78 and head[60:68] in (b'BOOKMOBI', b'TEXtREAd'):
+        _check_pdb_records(path, head, size)
+        return 'mobi' if head[60:68] == b'BOOKMOBI' else 'prc'
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'txt'  # UTF-16文本
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'{\\rtf'):
+        return 'rtf'
+    lowered = text[:1024].lower()
+    if b'<fictionbook' in lowered:
+        return 'fb2'
+    if lowered.startswith(b'<!doctype html') or b'<html' in lowered:
+        return 'html'
+    if b'\x00' in head:
+        return 'binary'
+    return 'txt'
+
+def preflight_format(declared, detected):
+    """根据扩展名和识别结果决定交给Calibre的输入格式，内容与扩展名明显不符时抛出PreflightError"""
+    if detected == declared:
+        return declared
+    if declared in PDB_INPUT_FORMATS and detected in PDB_INPUT_FORMATS:
+        return declared
+    if declared in TEXT_INPUT_FORMATS and (detected in TEXT_INPUT_FORMATS or detected == 'binary'):
+        # 文本类格式之间交给Calibre自行处理，GBK、无BOM的UTF-16等编码的文本也可能被识别为二进制
+        return declared
+    if detected in ALLOWED_INPUT_EXTENSIONS and detected not in TEXT_INPUT_FORMATS:
+        return detected
+    raise PreflightError(f'文件内容与扩展名.{declared}不符')
+
+def preflight_upload(info):
+    """上传完成后预检文件：扩展名与内容不符时改用实际格式，无法转换的文件删除并标记为失败"""
+    declared = _input_format(info['filename'])
+    try:
+        with stage_timer('preflight'):
+            input_format = preflight_format(declared, sniff_format(info['path'], declared))
+    except (PreflightError, OSError) as e:
+        logger.warning("预检未通过: %s，%s", info['filename'], e)
+        increment_counter('bookforge_preflight_total', result='rejected')
+        try:
+            os.remove(info['path'])
+        except OSError:
+            pass
+        for key in ('path', 'sha256', 'size'):
+            info.pop(key, None)
+        info.update(status='failed', error=f'文件无法转换: {e}')
+        return
+    
+    if input_format == declared:
+        increment_counter('bookforge_preflight_total', result='passed')
+        return
+    # Calibre按扩展名选择输入插件，改用识别出的扩展名存储
+    base = os.path.splitext(info['path'])[0]
+    path = f"{base}.{input_format}"
+    if os.path.exists(path):
+        path = f"{base}_{uuid.uuid4().hex[:8]}.{input_format}"
+    os.rename(info['path'], path)
+    info['path'] = path
+    info['detected_format'] = input_format
+    logger.info("文件 %s 的实际格式为 %s，按该格式转换", info['filename'], input_format)
+    increment_counter('bookforge_preflight_total', result='rerouted')
+
+def ingest_multipart_upload(batch_folder, storage_name):
+    """流式解析multipart请求体
+    
+    文件按固定大小的分块直接写入批次目录，同时计算SHA-256，
+    不经过Werkzeug的临时文件，也不需要再调用file.save复制一次。
+    返回 (表单字段, 文件信息列表, 是否包含files[]字段)
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return {}, [], False
+    
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_parts=app.config['UPLOAD_MAX_PARTS'])
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    fields = MultiDict()
+    file_info = []
+    has_file_part = False
+    field_name = None
+    field_chunks = []
+    part = None
+    
+    try:
+        while True:
+            data = request.stream.read(chunk_size)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    field_name, field_chunks, part = event.name, [], None
+                elif isinstance(event, File):
+                    has_file_part = has_file_part or event.name == 'files[]'
+                    field_name = None
+                    part = _open_upload_part(event.filename, batch_folder, storage_name)
+                elif isinstance(event, Data):
+                    if part is None:
+                        field_chunks.append(event.data)
+                        if sum(len(chunk) for chunk in field_chunks) > app.config['UPLOAD_MAX_FIELD_SIZE']:
+                            raise RequestEntityTooLarge()
+                    elif part['file'] is not None:
+                        part['file'].write(event.data)
+                        part['hash'].update(event.data)
+                        part['size'] += len(event.data)
+                    
+                    if not event.more_data:
+                        if part is None:
+                            fields.add(field_name, b''.join(field_chunks).decode('utf-8', 'replace'))
+                        else:
+                            if part['file'] is not None:
+                                part['file'].close()
+                                part['info']['sha256'] = part['hash'].hexdigest()
+                                part['info']['size'] = part['size']
+                                preflight_upload(part['info'])
+                            if part['info'] is not None:
+                                file_info.append(part['info'])
+                            part = None
+                event = decoder.next_event()
+            if not data:
+                break
+    finally:
+        if part is not None and part['file'] is not None:
+            part['file'].close()
+    
+    return fields, file_info, has_file_part
+
+# 准入控制：每个进行中的批次按“输入大小 + 预估输出大小”预留磁盘空间，
+# 新批次的预留加上已有预留超出数据目录的剩余空间时拒绝上传，避免磁盘写满后所有转换一起失败
+_reservations = {}  # batch_id -> 预留字节数
+_admission_lock = threading.Lock()
+# 各输出格式相对输入大小的初始膨胀系数，运行中按实际转换结果修正
+DEFAULT_EXPANSION_RATIOS = {
+    'pdf': 4.0, 'rtf': 3.0, 'html': 2.0, 'mobi': 2.0, 'docx': 1.5,
+    'epub': 1.5, 'azw3': 1.5, 'fb2': 1.5, 'txt': 1.0
+}
+_expansion_ratios = {}  # (输入格式, 输出格式) -> 指数加权平均的实际膨胀系数
+
+def _input_format(filename):
+    return os.path.splitext(filename)[1].lstrip('.').lower()
+
+def expansion_ratio(input_format, output_format):
+    """预估输出大小与输入大小之比；未知输出格式时取最大的系数"""
+    if output_format is None:
+        return max(DEFAULT_EXPANSION_RATIOS.values())
+    default = DEFAULT_EXPANSION_RATIOS.get(output_format, 2.0)
+    with _admission_lock:
+        return _expansion_ratios.get((input_format, output_format), default)
+
+def record_expansion(filename, output_format, input_size, output_size):
+    """用一次实际的转换结果修正该格式组合的膨胀系数"""
+    key = (_input_format(filename), output_format)
+    ratio = output_size / input_size
+    with _admission_lock:
+        previous = _expansion_ratios.get(key)
+        _expansion_ratios[key] = ratio if previous is None else previous * 0.8 + ratio * 0.2
+
+def estimate_output_bytes(input_files, output_formats):
+    """预估一个批次的转换结果（及ZIP文件）占用的空间"""
+    total = sum((f.get('size') or 0) * expansion_ratio(_input_format(f['filename']), output_format)
+                for output_format in output_formats for f in input_files)
+    if app.config['ZIP_MODE'] != 'stream':
+        total *= 2  # 文件模式下转换结果还会在downloads目录中再打包一份
+    return int(total)
+
+def admit_batch(batch_id, input_bytes, output_formats=None, filenames=()):
+    """为新批次预留磁盘空间，空间不足时返回413/429/503响应，否则返回None；output_formats为None表示输出格式未知"""
+    ratio = sum(max([expansion_ratio(_input_format(name), output_format) for name in filenames] or
+                    [expansion_ratio(None, output_format)])
+                for output_format in (output_formats or [None]))
+    needed = int(input_bytes * (1 + ratio * (2 if app.config['ZIP_MODE'] != 'stream' else 1)))
+    free = shutil.disk_usage(DATA_FOLDER).free - app.config['ADMISSION_MIN_FREE_BYTES']
+    max_reserved = app.config['ADMISSION_MAX_RESERVED_BYTES']
+    with _admission_lock:
+        reserved = sum(_reservations.values())
+        if needed <= free - reserved and (not max_reserved or reserved + needed <= max_reserved):
+            _reservations[batch_id] = needed
+            return None
+    
+    if max_reserved and needed > max_reserved:
+        # 单个批次就超过了预留上限，重试也不会成功
+        status, retry_after, reason = 413, None, 'reservation_cap'
+        message = '批次超过服务器允许的上限，请减少文件数量或大小'
+    elif needed > free:
+        # 即使进行中的批次全部完成也放不下，只能等待清理或扩容
+        status, retry_after, reason = 503, 300, 'disk_full'
+        message = '服务器磁盘空间不足，请稍后再试'
+    else:
+        status, retry_after, reason = 429, 30, 'busy'
+        message = '服务器正在处理其他文件，请稍后再试'
+    logger.warning(f"拒绝上传({reason}): 需要 {needed} 字节，剩余 {free} 字节，已预留 {reserved} 字节")
+    increment_counter('bookforge_uploads_rejected_total', reason=reason)
+    response = jsonify({'error': message, 'reason': reason, 'required_bytes': needed})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def update_reservation(batch_id, nbytes):
+    with _admission_lock:
+        if batch_id in _reservations:
+            _reservations[batch_id] = nbytes
+
+def release_reservation(batch_id):
+    with _admission_lock:
+        _reservations.pop(batch_id, None)
+
+def admission_status():
+    usage = shutil.disk_usage(DATA_FOLDER)
+    with _admission_lock:
+        reserved = sum(_reservations.values())
+        batches = len(_reservations)
+        ratios = {f'{i}->{o}': round(r, 3) for (i, o), r in sorted(_expansion_ratios.items())}
+    min_free = app.config['ADMISSION_MIN_FREE_BYTES']
+    return {
+        'disk_total_bytes': usage.total,
+        'disk_free_bytes': usage.free,
+        'min_free_bytes': min_free,
+        'reserved_bytes': reserved,
+        'reserved_batches': batches,
+        'max_reserved_bytes': app.config['ADMISSION_MAX_RESERVED_BYTES'],
+        'available_bytes': max(0, usage.free - min_free - reserved),
+        'expansion_ratios': ratios
+    }
+
+def _reject_upload(batch_id, payload):
+    """拒绝上传请求，并清理已经写入的批次目录"""
+    cleanup_batch_files(batch_id)
+    return jsonify(payload), 400
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
-    if 'files[]' not in request.files:
-        return jsonify({'error': '找不到文件数据'}), 400
+    # 为这批文件创建一个唯一的ID
+    batch_id = str(uuid.uuid4())
+    # 输出格式位于请求体中，先按请求体大小和最大的膨胀系数预留空间
+    rejected = admit_batch(batch_id, request.content_length or app.config['MAX_CONTENT_LENGTH'])
+    if rejected is not None:
+        return rejected
+    batch_folder = os.path.join(app.config['UPLOAD_FOLDER'], batch_id)
+    os.makedirs(batch_folder, exist_ok=True)
+    os.makedirs(os.path.join(app.config['CONVERTED_FOLDER'], batch_id), exist_ok=True)
+    register_batch(batch_id)
+    
+    # 边接收边写入，表单中输出格式字段位于文件之后，需解析完请求体才能校验
+    try:
+        with stage_timer('upload_ingest'):
+            form, file_info, has_file_part = ingest_multipart_upload(batch_folder, unique_storage_name)
+    except ValueError as e:
+        return _reject_upload(batch_id, {'error': f'无法解析上传数据: {e}'})
+    except Exception:
+        cleanup_batch_files(batch_id)
+        raise
+    
+    if not has_file_part:
+        return _reject_upload(batch_id, {'error': '找不到文件数据'})
     
-    files = request.files.getlist('files[]')
-    output_format = request.form.get('output_format')
+    # 可以重复output_format字段或用逗号分隔，一次转换为多个格式
+    output_formats = parse_output_formats(form.getlist('output_format') + form.getlist('output_formats'))
     
-    if not output_format or output_format not in ALLOWED_OUTPUT_FORMATS:
+    if not output_formats:
+        return _reject_upload(batch_id, {'error': '无效的输出格式'})
+    
+    if not file_info:
+        return _reject_upload(batch_id, {'error': '未选择任何文件'})
+    
+    # 如果有部分文件上传失败，也继续处理
+    valid_files = [f for f in file_info if f['status'] == 'uploaded']
+    if not valid_files:
+        return _reject_upload(batch_id, {'error': '所有文件上传均无效', 'files': file_info})
+    
+    # 转换和打包交给后台任务，请求只负责接收文件
+    failed_uploads = [f for f in file_info if f['status'] == 'failed']
+    job = create_job(batch_id, valid_files, failed_uploads, output_formats)
+    enqueue_job(job)
+    
+    return job_accepted_response(job)
+
+# 可续传的分块上传：init登记文件 -> 按偏移量PUT分块（可并行、可重传） -> finalize入队转换
+# 每个请求只携带一个分块，因此批次总大小不再受 MAX_CONTENT_LENGTH 限制
+UPLOAD_SESSIONS = {}
+_upload_sessions_lock = threading.Lock()
+
+def _merge_range(ranges, start, end):
+    """把[start, end)合并进已接收的区间列表"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def _received_bytes(upload_file):
+    return sum(end - start for start, end in upload_file['ranges'])
+
+def _upload_session_snapshot(session):
+    """上传会话的对外状态，调用方需持有 _upload_sessions_lock"""
+    return {
+        'batch_id': session['batch_id'],
+        'chunk_size': app.config['RESUMABLE_CHUNK_SIZE'],
+        'files': [{
+            'file_id': f['file_id'],
+            'filename': f['filename'],
+            'size': f['size'],
+            'received': _received_bytes(f),
+            'ranges': [list(r) for r in f['ranges']]
+        } for f in session['files']],
+        'failed_files': session['failed_uploads']
+    }
+
+def _prune_upload_sessions():
+    """移除长时间没有活动的上传会话并返回其批次ID，调用方需持有 _upload_sessions_lock，
+    释放锁之后再对返回的批次调用 remove_batch_files"""
+    expire_before = time.time() - app.config['JOB_RETENTION_SECONDS']
+    stale = [b for b, s in UPLOAD_SESSIONS.items() if s['updated_at'] < expire_before]
+    for batch_id in stale:
+        del UPLOAD_SESSIONS[batch_id]
+    return stale
+
+@app.route('/uploads/init', methods=['POST'])
+def init_resumable_upload():
+    """登记一个分块上传批次，请求体: {output_format, output_formats, advanced, options, files: [{name, size}]}"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = {}
+    files = payload.get('files') or []
+    advanced = bool(payload.get('advanced'))
+    
+    format_values = []
+    for key in ('output_format', 'output_formats'):
+        value = payload.get(key)
+        format_values.extend(value if isinstance(value, list) else [value] if value else [])
+    output_formats = parse_output_formats(format_values)
+    if not output_formats:
         return jsonify({'error': '无效的输出格式'}), 400
+    if not files:
+        return jsonify({'error': '未选择任何文件'}), 400
+    if not isinstance(files, list) or not all(isinstance(f, dict) for f in files):
+        # 每个文件必须是 {name, size} 对象
+        return jsonify({'error': '文件大小无效'}), 400
+    try:
+        sizes = [int(f.get('size', -1)) for f in files]
+    except (TypeError, ValueError):
+        sizes = [-1]
+    if any(size < 0 for size in sizes):
+        return jsonify({'error': '文件大小无效'}), 400
+    if sum(sizes) > app.config['RESUMABLE_MAX_BATCH_BYTES']:
+        return jsonify({'error': '上传文件总大小超出限制'}), 413
+    
+    # 为这批文件创建一个唯一的ID
+    batch_id = str(uuid.uuid4())
+    rejected = admit_batch(batch_id, sum(sizes), output_formats, [str(f.get('name') or '') for f in files])
+    if rejected is not None:
+        return rejected
+    batch_folder = os.path.join(app.config['UPLOAD_FOLDER'], batch_id)
+    os.makedirs(batch_folder, exist_ok=True)
+    os.makedirs(os.path.join(app.config['CONVERTED_FOLDER'], batch_id), exist_ok=True)
+    register_batch(batch_id)
+    
+    storage_name = safe_storage_name if advanced else unique_storage_name
+    session_files = []
+    failed_uploads = []
+    for entry, size in zip(files, sizes):
+        part = _open_upload_part(str(entry.get('name') or ''), batch_folder, storage_name)
+        if part['info'] is None:
+            continue
+        if part['file'] is None:
+            failed_uploads.append(part['info'])
+            continue
+        # 预先分配文件长度，各分块按偏移量写入
+        part['file'].truncate(size)
+        part['file'].close()
+        session_files.append({
+            'file_id': uuid.uuid4().hex,
+            'filename': part['info']['filename'],
+            'path': part['info']['path'],
+            'size': size,
+            'ranges': [[0, 0]] if size == 0 else []
+        })
+    
+    if not session_files:
+        cleanup_batch_files(batch_id)
+        return jsonify({'error': '所有文件上传均无效', 'files': failed_uploads}), 400
+    
+    options = None
+    if advanced:
+        options = payload.get('options')
+        options = {str(k): str(v) for k, v in options.items()} if isinstance(options, dict) else {}
+    
+    session = {
+        'batch_id': batch_id,
+        'output_formats': output_formats,
+        'options': options,
+        'files': session_files,
+        'failed_uploads': failed_uploads,
+        'created_at': time.time(),
+        'updated_at': time.time()
+    }
+    with _upload_sessions_lock:
+        stale = _prune_upload_sessions()
+        UPLOAD_SESSIONS[batch_id] = session
+        snapshot = _upload_session_snapshot(session)
+    # 放弃的上传会话：删除预先分配的文件，释放预留的磁盘空间
+    for stale_batch_id in stale:
+        remove_batch_files(stale_batch_id)
+    logger.info(f"创建分块上传批次 {batch_id}，包含 {len(session_files)} 个文件")
+    return jsonify(snapshot), 201
+
+@app.route('/uploads/<batch_id>', methods=['GET'])
+def resumable_upload_status(batch_id):
+    """查询已接收的区间，客户端据此只重传缺失的分块"""
+    with _upload_sessions_lock:
+        session = UPLOAD_SESSIONS.get(batch_id)
+        if session is None:
+            return jsonify({'error': '上传批次不存在'}), 404
+        return jsonify(_upload_session_snapshot(session))
+
+@app.route('/uploads/<batch_id>/files/<file_id>', methods=['PUT'])
+def put_upload_chunk(batch_id, file_id):
+    """写入一个分块，偏移量由查询参数offset指定，请求体为原始字节"""
+    with _upload_sessions_lock:
+        session = UPLOAD_SESSIONS.get(batch_id)
+        upload_file = None
+        if session is not None:
+            upload_file = next((f for f in session['files'] if f['file_id'] == file_id), None)
+    if upload_file is None:
+        return jsonify({'error': '上传文件不存在'}), 404
+    
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or offset < 0 or length is None:
+        return jsonify({'error': '缺少offset或Content-Length'}), 400
+    if offset + length > upload_file['size']:
+        return jsonify({'error': '分块超出文件范围'}), 416
+    
+    # 只记录实际写入的字节，连接中断时客户端重传缺失部分即可
+    written = 0
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    try:
+        with stage_timer('upload_chunk'), open(upload_file['path'], 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                data = request.stream.read(min(chunk_size, length - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+    except FileNotFoundError:
+        # 批次文件已到期被清理，会话失效，客户端需要重新登记上传
+        with _upload_sessions_lock:
+            UPLOAD_SESSIONS.pop(batch_id, None)
+        return jsonify({'error': '上传批次已过期，请重新上传'}), 410
+    finally:
+        if written:
+            with _upload_sessions_lock:
+                upload_file['ranges'] = _merge_range(upload_file['ranges'], offset, offset + written)
+                session['updated_at'] = time.time()
+    
+    if written < length:
+        return jsonify({'error': '分块数据不完整', 'received': written}), 400
+    with _upload_sessions_lock:
+        received = _received_bytes(upload_file)
+    return jsonify({'file_id': file_id, 'received': received, 'size': upload_file['size']})
+
+@app.route('/uploads/<batch_id>/finalize', methods=['POST'])
+def finalize_resumable_upload(batch_id):
+    """所有分块到齐后计算文件哈希并把批次交给后台任务"""
+    with _upload_sessions_lock:
+        session = UPLOAD_SESSIONS.get(batch_id)
+        if session is None:
+            return jsonify({'error': '上传批次不存在'}), 404
+        incomplete = [f['filename'] for f in session['files'] if _received_bytes(f) < f['size']]
+        if incomplete:
+            return jsonify({'error': '仍有文件未上传完成', 'incomplete': incomplete,
+                            **_upload_session_snapshot(session)}), 409
+        # 从会话表中移除，防止重复提交
+        del UPLOAD_SESSIONS[batch_id]
+    
+    valid_files = []
+    failed_uploads = list(session['failed_uploads'])
+    for upload_file in session['files']:
+        info = {
+            'filename': upload_file['filename'],
+            'path': upload_file['path'],
+            'status': 'uploaded',
+            'size': upload_file['size']
+        }
+        preflight_upload(info)
+        if info['status'] != 'uploaded':
+            failed_uploads.append(info)
+            continue
+        with stage_timer('upload_hash'):
+            info['sha256'] = hash_file(info['path'])
+        valid_files.append(info)
+    
+    if not valid_files:
+        cleanup_batch_files(batch_id)
+        return jsonify({'error': '所有文件上传均无效', 'files': failed_uploads}), 400
+    
+    job = create_job(batch_id, valid_files, failed_uploads, session['output_formats'], session['options'])
+    enqueue_job(job)
+    
+    return job_accepted_response(job)
+
+# 转换流程的阶段钩子，签名为 hook(stage, ctx, seconds)，每个文件的每个阶段结束后调用
+CONVERSION_STAGE_HOOKS = []
+
+# 各格式组合的历史转换耗时：(输入格式, 输出格式) -> {'samples': 样本数, 'seconds_per_mb': 指数加权平均}
+_duration_stats = {}
+_duration_stats_lock = threading.Lock()
+
+def conversion_timeout(input_format, output_format, size):
+    """按历史耗时估算单个文件的超时时间（秒），样本不足时使用默认值"""
+    with _duration_stats_lock:
+        stats = _duration_stats.get((input_format, output_format))
+        stats = dict(stats) if stats else None
+    if stats is None or stats['samples'] < 3:
+        return app.config['CONVERSION_TIMEOUT_DEFAULT']
+    # 小文件的耗时主要是Calibre的启动开销，不足1MB按1MB估算
+    expected = stats['seconds_per_mb'] * max(size / (1024 * 1024), 1)
+    return min(app.config['CONVERSION_TIMEOUT_MAX'], max(app.config['CONVERSION_TIMEOUT_MIN'], expected * 4 + 30))
+
+def record_conversion_duration(input_format, output_format, size, seconds):
+    """记录一次成功转换的耗时"""
+    key = (input_format, output_format)
+    rate = seconds / max(size / (1024 * 1024), 1)
+    with _duration_stats_lock:
+        stats = _duration_stats.get(key)
+        if stats is None:
+            _duration_stats[key] = {'samples': 1, 'seconds_per_mb': rate}
+        else:
+            stats['samples'] += 1
+            stats['seconds_per_mb'] = stats['seconds_per_mb'] * 0.8 + rate * 0.2
+
+def supported_conversion_options(input_format, output_format):
+    """Calibre在该格式组合下支持的选项名：输入插件的输入选项加上输出格式的其他选项，
+    注册表中没有该输出格式的信息时返回None"""
+    registry = get_calibre_registry()
+    output_options = registry['format_options'].get(output_format)
+    if output_options is None:
+        return None
+    input_options = registry['input_options'].get(input_format, [])
+    return {option['name'] for option in output_options + input_options}
+
+def input_conversion_options(options):
+    """选项中属于输入插件的部分，多格式输出经过中间格式时只在原始文件转换为中间格式时生效"""
+    names = {option['name'] for input_options in get_calibre_registry()['input_options'].values()
+             for option in input_options}
+    return {key: value for key, value in options.items() if key in names}
+
+def filter_conversion_options(options, input_format, output_format):
+    """只保留Calibre在该格式组合下支持的选项，避免表单中的其他字段被当作命令行参数传入"""
+    supported = supported_conversion_options(input_format, output_format)
+    return {key: value for key, value in options.items()
+            if re.match(r'^[a-z][a-z0-9_]*$', key) and (supported is None or key in supported)}
+
+class ConversionPipeline:
+    """一个批次的转换流程，普通转换和高级转换共用
+    
+    每个文件依次经过 validate -> prepare -> run -> verify -> publish 五个阶段，
+    阶段方法读写该文件的上下文字典，返回结果条目时流程提前结束（校验失败、命中缓存或转换失败）。
+    """
+    STAGES = ('validate', 'prepare', 'run', 'verify', 'publish')
+    
+    def __init__(self, batch_id, output_format, options=None, on_progress=None, hooks=None, cancelled=None,
+                 client=None):
+        self.batch_id = batch_id
+        self.output_format = output_format
+        # options为None表示普通转换，其他情况按每个文件的输入格式过滤后使用
+        self.options = options
+        self.file_options = {}  # 输入格式 -> 过滤后的选项
+        self.on_progress = on_progress
+        self.hooks = list(CONVERSION_STAGE_HOOKS if hooks is None else hooks)
+        # 返回True时尚未开始的阶段不再执行
+        self.cancelled = cancelled or (lambda: False)
+        # 公平调度中所属的客户端
+        self.client = client
+        # Calibre路径来自启动时建立的注册表，不再每个批次重新探测
+        self.calibre_path = get_calibre_path()
+        self.output_folder = os.path.join(app.config['CONVERTED_FOLDER'], batch_id)
+        self.temp_dirs = []
     
-    if not files or files[0].filename == '':
-        return jsonify({'error': '未选择任何文件'}), 400
+    def convert(self, file_info):
+        """转换整个批次，结果与输入顺序一致"""
+        tasks = self.plan(file_info)
+        unique = self.group_duplicates(tasks)
+        try:
+            # 并行执行转换，重复的文件随领头文件一起完成，结果保持与输入相同的顺序
+            run_conversion_tasks(self.process, unique, self.task_progress(unique), client=self.client,
+                                 sizes=[task['file'].get('size') or 0 for task in unique])
+            return [task['outcome'] for task in tasks]
+        finally:
+            self.cleanup()
     
-    # 为这批文件创建一个唯一的ID
-    batch_id = str(uuid.uuid4())
-    batch_folder = os.path.join(app.config['UPLOAD_FOLDER'], batch_id)
-    os.makedirs(batch_folder, exist_ok=True)
-    os.makedirs(os.path.join(app.config['CONVERTED_FOLDER'], batch_id), exist_ok=True)
+    def task_progress(self, tasks):
+        """把提交列表中的位置换算为任务序号后上报进度"""
+        if self.on_progress is None:
+            return None
+        return lambda position, status, result: self.on_progress(tasks[position]['index'], status, result)
     
-    file_info = []
+    def group_duplicates(self, tasks):
+        """按输入内容（SHA-256）分组，同一批次中内容相同的文件只转换一次，返回需要提交转换的任务"""
+        leaders = {}
+        unique = []
+        for ctx in tasks:
+            file = ctx['file']
+            key = (file.get('sha256'), os.path.splitext(file['path'])[1].lower(), file.get('source_format'))
+            leader = leaders.get(key) if key[0] else None
+            if leader is None:
+                leaders[key] = ctx
+                ctx['duplicates'] = []
+                unique.append(ctx)
+            else:
+                leader['duplicates'].append(ctx)
+        return unique
     
-    for file in files:
-        if file and file.filename:
-            # 保存原始文件名，不进行安全处理以保留格式
-            original_filename = file.filename
-            logger.debug(f"处理上传文件: {original_filename}")
-            
-            # 检查文件是否有扩展名
-            if '.' not in original_filename:
-                file_info.append({
-                    'filename': original_filename,
-                    'status': 'failed',
-                    'error': '文件必须有扩展名'
-                })
-                continue
-                
-            # 检查扩展名是否在允许列表中
-            if not allowed_file(original_filename, ALLOWED_INPUT_EXTENSIONS):
-                file_info.append({
-                    'filename': original_filename,
-                    'status': 'failed',
-                    'error': f'不支持的文件格式。支持的格式：{", ".join(ALLOWED_INPUT_EXTENSIONS)}'
-                })
-                continue
-                
-            # 提取原始扩展名
-            original_ext = original_filename.rsplit('.', 1)[1].lower()
+    def plan(self, file_info):
+        """先按上传顺序分配输出文件名，保证并行转换时命名结果与顺序执行一致"""
+        # 用于跟踪已创建的输出文件名，避免冲突
+        used_output_names = set()
+        tasks = []
+        for index, file in enumerate(file_info):
+            original_filename = file['filename']
             
-            # 为存储生成唯一文件名，但保留原始文件名用于后续处理
-            unique_filename = f"{uuid.uuid4().hex}.{original_ext}"
-            file_path = os.path.join(batch_folder, unique_filename)
+            # 保留原始文件名，仅改变扩展名
+            original_name_without_ext = os.path.splitext(original_filename)[0]
+            output_name = f"{original_name_without_ext}.{self.output_format}"
             
-            # 记录详细信息用于调试
-            logger.debug(f"原始文件名: {original_filename}")
-            logger.debug(f"存储文件名: {unique_filename}")
-            logger.debug(f"保存路径: {file_path}")
+            # 确保输出文件名唯一，但尽量保留原始名称
+            counter = 1
+            while output_name in used_output_names:
+                output_name = f"{original_name_without_ext}_{counter}.{self.output_format}"
+                counter += 1
+            used_output_names.add(output_name)
             
-            # 保存文件
-            file.save(file_path)
-            file_info.append({
-                'filename': original_filename,  # 使用原始文件名
-                'path': file_path,
-                'status': 'uploaded'
+            # 为存储生成唯一文件名，但记录原始输出名
+            storage_name = f"{uuid.uuid4().hex}.{self.output_format}"
+            tasks.append({
+                'index': index,
+                'file': file,
+                'original_filename': original_filename,
+                'input_file': file['path'],
+                'output_name': output_name,
+                'storage_name': storage_name,
+                'output_file': os.path.join(self.output_folder, storage_name)
             })
+        return tasks
     
-    if not file_info:
-        return jsonify({'error': '没有有效的文件上传'}), 400
-    
-    # 如果有部分文件上传失败，也继续处理
-    valid_files = [f for f in file_info if f['status'] == 'uploaded']
-    if not valid_files:
-        return jsonify({'error': '所有文件上传均无效', 'files': file_info}), 400
-    
-    # 开始转换过程
-    converted_files = convert_files(valid_files, output_format, batch_id)
-    
-    # 合并上传失败和转换结果
-    failed_uploads = [f for f in file_info if f['status'] == 'failed']
-    all_results = failed_uploads + converted_files
+    def process(self, ctx):
+        """在工作线程中依次执行各阶段，返回该文件的结果条目"""
+        with log_context(file=ctx['original_filename'], output_format=self.output_format):
+            ctx['outcome'] = self.run_stages(ctx)
+        for duplicate in ctx.get('duplicates', ()):
+            with log_context(file=duplicate['original_filename'], output_format=self.output_format):
+                duplicate['outcome'] = self.reuse(duplicate, ctx['outcome'])
+            if self.on_progress is not None:
+                self.on_progress(duplicate['index'], duplicate['outcome']['status'], duplicate['outcome'])
+        return ctx['outcome']
     
-    # 创建ZIP文件
-    zip_path = create_zip_file(converted_files, batch_id)
+    def reuse(self, ctx, outcome):
+        """复用同一批次中内容相同的文件的转换结果，输出文件以硬链接生成"""
+        if outcome['status'] != 'success':
+            return dict(self.failed(ctx, outcome.get('error')), status=outcome['status'])
+        try:
+            link_or_copy(outcome['converted_path'], ctx['output_file'])
+        except OSError as e:
+            logger.error("复用转换结果失败: %s", e)
+            return self.failed(ctx, f'复用转换结果失败: {e}')
+        logger.info("内容与 %s 相同，复用转换结果: %s -> %s",
+                    outcome['original_name'], ctx['original_filename'], ctx['output_name'])
+        increment_counter('bookforge_duplicate_files_total')
+        return self.succeeded(ctx)
     
-    return jsonify({
-        'success': True,
-        'message': f'成功转换 {len([f for f in converted_files if f["status"] == "success"])} 个文件',
-        'download_url': url_for('download_file', batch_id=batch_id),
-        'files': all_results
-    })
-
-def convert_files(file_info, output_format, batch_id):
-    converted_files = []
-    # 用于跟踪已创建的输出文件名，避免冲突
-    used_output_names = set()
+    def run_stages(self, ctx):
+        try:
+            for stage in self.STAGES:
+                if self.cancelled():
+                    raise ConversionCancelled()
+                start = time.perf_counter()
+                result = getattr(self, stage)(ctx)
+                elapsed = time.perf_counter() - start
+                for hook in self.hooks:
+                    try:
+                        hook(stage, ctx, elapsed)
+                    except Exception:
+                        logger.exception("转换阶段钩子执行失败: %s", stage)
+                if result is not None:
+                    # 记录该文件转换进程的CPU时间和峰值内存
+                    result.update(ctx.get('usage') or {})
+                    return result
+        except ConversionCancelled:
+            return {
+                'original_name': ctx['original_filename'],
+                'output_format': self.output_format,
+                'status': 'cancelled',
+                'error': '转换已取消'
+            }
+        except subprocess.TimeoutExpired:
+            logger.error("转换超时: %s", ctx['original_filename'])
+            return self.failed(ctx, '转换操作超时')
+        except Exception as e:
+            logger.exception("处理文件时发生异常: %s", ctx['original_filename'])
+            return self.failed(ctx, str(e))
     
-    # 首先检查Calibre是否安装
-    calibre_path = 'ebook-convert'
-    try:
-        check_result = subprocess.run([calibre_path, '--version'], 
-                                     capture_output=True, 
-                                     text=True, 
-                                     encoding='utf-8', 
-                                     errors='replace')
-        logger.info(f"Calibre版本: {check_result.stdout.strip() if check_result.returncode == 0 else '未检测到'}")
-    except Exception as e:
-        logger.error(f"检查Calibre安装失败: {str(e)}")
+    def failed(self, ctx, error):
+        return {
+            'original_name': ctx['original_filename'],
+            'output_format': self.output_format,
+            'status': 'failed',
+            'error': error
+        }
     
-    # 标记是否需要清理临时文件
-    temp_files_to_remove = []
+    def succeeded(self, ctx):
+        return {
+            'original_name': ctx['original_filename'],
+            'converted_name': ctx['output_name'],  # 使用用户可读的原始名称
+            'converted_path': ctx['output_file'],  # 实际存储路径使用唯一ID
+            'output_format': self.output_format,
+            'status': 'success'
+        }
     
-    for file in file_info:
-        input_file = file['path']
-        original_filename = file['filename']
-        
-        # 保留原始文件名，仅改变扩展名
-        original_name_without_ext = os.path.splitext(original_filename)[0]
-        base_output_name = f"{original_name_without_ext}.{output_format}"
+    def validate(self, ctx):
+        """检查输入文件，确保其带有Calibre能识别的扩展名"""
+        input_file = ctx['input_file']
+        original_filename = ctx['original_filename']
         
-        # 确保输出文件名唯一，但尽量保留原始名称
-        output_name = base_output_name
-        counter = 1
-        while output_name in used_output_names:
-            output_name = f"{original_name_without_ext}_{counter}.{output_format}"
-            counter += 1
-        
-        # 添加到已使用名称集合
-        used_output_names.add(output_name)
-        
-        # 构建完整输出路径 - 为存储生成唯一文件名，但记录原始输出名
-        unique_output_filename = f"{uuid.uuid4().hex}.{output_format}"
-        output_file = os.path.join(app.config['CONVERTED_FOLDER'], batch_id, unique_output_filename)
-        
-        # 详细记录文件信息，用于调试
-        logger.debug(f"处理文件: {original_filename}")
-        logger.debug(f"输入文件路径: {input_file}")
-        logger.debug(f"输入文件是否存在: {os.path.exists(input_file)}")
-        logger.debug(f"输入文件大小: {os.path.getsize(input_file) if os.path.exists(input_file) else 'N/A'}")
-        logger.debug(f"输入文件扩展名: {os.path.splitext(input_file)[1]}")
-        logger.debug(f"原始输出文件名: {output_name}")
-        logger.debug(f"存储输出文件名: {unique_output_filename}")
-        logger.debug(f"输出文件路径: {output_file}")
+        # 详细记录文件信息，用于调试；只在启用DEBUG级别时才访问文件系统
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("处理文件: %s，输入路径: %s，大小: %s，输出文件名: %s，输出路径: %s",
+                         original_filename, input_file,
+                         os.path.getsize(input_file) if os.path.exists(input_file) else 'N/A',
+                         ctx['output_name'], ctx['output_file'])
         
         # 检查文件是否存在
         if not os.path.exists(input_file):
-            logger.error(f"文件不存在: {input_file}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '找不到上传的文件'
-            })
-            continue
+            logger.error("文件不存在: %s", input_file)
+            return self.failed(ctx, '找不到上传的文件')
         
         # 确保输入文件有正确的扩展名
         file_ext = os.path.splitext(input_file)[1].lower()
@@ -243,238 +2810,664 @@ def convert_files(file_info, output_format, batch_id):
             # 文件没有扩展名，尝试从原始文件名推断扩展名
             if '.' in original_filename:
                 orig_ext = original_filename.rsplit('.', 1)[1].lower()
-                if orig_ext in ALLOWED_INPUT_EXTENSIONS:
-                    new_input_file = f"{input_file}.{orig_ext}"
-                    logger.debug(f"文件缺少扩展名，重命名为: {new_input_file}")
-                    try:
-                        os.rename(input_file, new_input_file)
-                        input_file = new_input_file
-                        # 增加重命名成功的日志
-                        logger.info(f"文件已成功重命名: {input_file}")
-                    except Exception as e:
-                        logger.error(f"重命名文件失败: {str(e)}")
-                        converted_files.append({
-                            'original_name': original_filename,
-                            'status': 'failed',
-                            'error': f'文件重命名失败: {str(e)}'
-                        })
-                        continue
-                else:
-                    logger.warning(f"原始文件扩展名不被支持: {orig_ext}")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': f'不支持的文件格式：{orig_ext}'
-                    })
-                    continue
+                if orig_ext not in ALLOWED_INPUT_EXTENSIONS:
+                    logger.warning("原始文件扩展名不被支持: %s", orig_ext)
+                    return self.failed(ctx, f'不支持的文件格式：{orig_ext}')
+                new_input_file = f"{input_file}.{orig_ext}"
+                logger.debug("文件缺少扩展名，重命名为: %s", new_input_file)
+                try:
+                    os.rename(input_file, new_input_file)
+                    input_file = new_input_file
+                    logger.info("文件已成功重命名: %s", input_file)
+                except Exception as e:
+                    logger.error("重命名文件失败: %s", e)
+                    return self.failed(ctx, f'文件重命名失败: {str(e)}')
             else:
-                # 如果无法确定扩展名，尝试添加默认扩展名
-                default_ext = 'txt'  # 使用默认扩展名
+                # 无法从文件名确定扩展名时按文件头识别，识别不出的格式不交给Calibre
+                try:
+                    default_ext = sniff_format(input_file)
+                except PreflightError as e:
+                    return self.failed(ctx, f'文件无法转换: {e}')
+                if default_ext not in ALLOWED_INPUT_EXTENSIONS:
+                    return self.failed(ctx, '无法识别文件格式')
                 new_input_file = f"{input_file}.{default_ext}"
-                logger.warning(f"文件没有扩展名，添加默认扩展名: {default_ext}")
+                logger.warning("文件没有扩展名，按文件内容添加扩展名: %s", default_ext)
                 try:
                     os.rename(input_file, new_input_file)
                     input_file = new_input_file
-                    logger.info(f"文件已添加默认扩展名: {input_file}")
+                    logger.info("文件已添加默认扩展名: %s", input_file)
                 except Exception as e:
-                    logger.error(f"添加默认扩展名失败: {str(e)}")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': f'添加文件扩展名失败: {str(e)}'
-                    })
-                    continue
+                    logger.error("添加默认扩展名失败: %s", e)
+                    return self.failed(ctx, f'添加文件扩展名失败: {str(e)}')
         
         # 额外检查 - 确保文件路径中包含扩展名
         if '.' not in os.path.basename(input_file):
-            logger.error(f"文件路径不包含扩展名: {input_file}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '文件必须有扩展名'
-            })
-            continue
+            logger.error("文件路径不包含扩展名: %s", input_file)
+            return self.failed(ctx, '文件必须有扩展名')
         
-        try:
-            # 创建每个文件专用的临时目录以避免并发问题
-            temp_dir = os.path.join(app.config['CONVERTED_FOLDER'], batch_id, f"temp_{uuid.uuid4().hex}")
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_files_to_remove.append(temp_dir)
+        ctx['input_file'] = input_file
+        # 同一个输入会被多个输出格式复用，重命名后的路径写回文件信息
+        ctx['file']['path'] = input_file
+        ctx['input_format'] = os.path.splitext(input_file)[1].lstrip('.').lower()
+        # 按格式和文件大小分组记录各阶段耗时
+        ctx['input_size'] = ctx['file'].get('size') or os.path.getsize(input_file)
+        ctx['stage_labels'] = {
+            'input_format': ctx['input_format'],
+            'output_format': self.output_format,
+            'size_label': size_bucket(ctx['input_size'])
+        }
+    
+    def options_for(self, input_format):
+        """该输入格式的文件实际使用的转换选项，每种输入格式只过滤一次；input_format为None时不含输入选项"""
+        if self.options is None:
+            return None
+        options = self.file_options.get(input_format)
+        if options is None:
+            options = self.file_options[input_format] = filter_conversion_options(
+                self.options, input_format, self.output_format)
+        return options
+    
+    def applied_options(self):
+        """至少对一个文件生效的选项名"""
+        return {key for options in self.file_options.values() for key in options}
+    
+    def prepare(self, ctx):
+        """查询转换缓存，未命中时准备临时输出目录和ebook-convert命令"""
+        ctx['cache_key'] = None
+        # 由中间格式生成时输入选项已在解析原始文件时生效，不能再作用于中间结果
+        ctx['options'] = self.options_for(None if ctx['file'].get('source_format') else ctx['input_format'])
+        if conversion_cache_enabled():
+            try:
+                with stage_timer('cache_lookup', **ctx['stage_labels']):
+                    content_hash = ctx['file'].get('sha256') or hash_file(ctx['input_file'])
+                    input_format = f".{ctx['input_format']}"
+                    if ctx['file'].get('source_format'):
+                        # 由中间格式生成时内容哈希来自原始文件，缓存键中同时记录原始格式
+                        input_format = f".{ctx['file']['source_format']}>{input_format}"
+                    ctx['cache_key'] = make_cache_key(content_hash, input_format, self.output_format, ctx['options'])
+                    if cache_lookup(ctx['cache_key'], ctx['output_file']):
+                        logger.info("使用缓存结果: %s -> %s", ctx['original_filename'], ctx['output_name'])
+                        return self.succeeded(ctx)
+            except OSError as e:
+                logger.warning("查询转换缓存失败: %s", e)
+                ctx['cache_key'] = None
+        
+        # 创建每个文件专用的临时目录以避免并发问题
+        temp_dir = os.path.join(self.output_folder, f"temp_{uuid.uuid4().hex}")
+        os.makedirs(temp_dir, exist_ok=True)
+        self.temp_dirs.append(temp_dir)
+        ctx['temp_output_file'] = os.path.join(temp_dir, ctx['storage_name'])
+        
+        cmd = [self.calibre_path, ctx['input_file'], ctx['temp_output_file']]
+        for key, value in (ctx['options'] or {}).items():
+            if value:  # 只添加有值的选项
+                cmd.append(f'--{key.replace("_", "-")}={value}')
+        ctx['cmd'] = cmd
+    
+    def run(self, ctx):
+        """调用Calibre的ebook-convert命令"""
+        timeout = conversion_timeout(ctx['input_format'], self.output_format, ctx['input_size'])
+        logger.debug("执行命令: %s，超时: %.0f秒", ctx['cmd'], timeout)
+        start = time.perf_counter()
+        with stage_timer('calibre_run', **ctx['stage_labels']):
+            ctx['result'] = run_ebook_convert(ctx['cmd'], timeout=timeout, batch_id=self.batch_id,
+                                              on_progress=lambda percent: self.report_progress(ctx, percent))
+        usage = getattr(ctx['result'], 'usage', None)
+        if usage:
+            ctx['usage'] = usage
+            increment_counter('bookforge_calibre_cpu_seconds_total', usage['cpu_seconds'],
+                              output_format=self.output_format)
+        if ctx['result'].returncode == 0:
+            record_conversion_duration(ctx['input_format'], self.output_format, ctx['input_size'],
+                                       time.perf_counter() - start)
+    
+    def report_progress(self, ctx, percent):
+        if self.on_progress is not None:
+            self.on_progress(ctx['index'], 'converting', {'progress': percent})
+    
+    def verify(self, ctx):
+        """检查转换结果，失败时提取主要的错误信息"""
+        result = ctx['result']
+        if result.returncode == 0 and os.path.exists(ctx['temp_output_file']):
+            if os.path.getsize(ctx['temp_output_file']) > 0:
+                return None
+            logger.error("转换失败: 输出文件大小为零")
+            return self.failed(ctx, '转换后的文件大小为零')
+        
+        limit_error = self.limit_exceeded(result)
+        if limit_error:
+            logger.error("转换失败: %s，%s", ctx['original_filename'], limit_error)
+            return self.failed(ctx, limit_error)
+        
+        error_msg = result.stderr if result.stderr else '未知错误'
+        # 按比例采样记录完整的错误输出，避免大量失败时日志本身成为负担
+        if result.stderr and random.random() < app.config['LOG_STDERR_SAMPLE_RATE']:
+            logger.error("Calibre错误输出:\n%s", result.stderr[-app.config['LOG_STDERR_MAX_CHARS']:])
+        
+        # 简化错误消息，取最后一行作为主要错误
+        if error_msg and len(error_msg) > 100:
+            error_lines = error_msg.strip().split('\n')
+            if error_lines:
+                error_msg = error_lines[-1]
+        logger.error("转换失败: %s，%s", ctx['original_filename'], error_msg)
+        return self.failed(ctx, error_msg)
+    
+    def limit_exceeded(self, result):
+        """判断转换进程是否因为超出资源限制而结束，返回错误信息"""
+        if resource is None:
+            return None
+        if app.config['CONVERSION_MAX_CPU_SECONDS']:
+            usage = getattr(result, 'usage', None) or {}
+            # 忽略SIGXCPU的进程会在硬限制处被SIGKILL结束
+            if result.returncode == -signal.SIGXCPU or (
+                    result.returncode == -signal.SIGKILL and
+                    usage.get('cpu_seconds', 0) >= app.config['CONVERSION_MAX_CPU_SECONDS']):
+                increment_counter('bookforge_conversion_limit_kills_total', limit='cpu')
+                return '转换超出CPU时间限制'
+        if app.config['CONVERSION_MAX_MEMORY_BYTES'] and 'MemoryError' in (result.stderr or ''):
+            increment_counter('bookforge_conversion_limit_kills_total', limit='memory')
+            return '转换超出内存限制'
+        return None
+    
+    def publish(self, ctx):
+        """将临时文件移动到批次目录并写入缓存"""
+        with stage_timer('publish', **ctx['stage_labels']):
+            shutil.move(ctx['temp_output_file'], ctx['output_file'])
+        logger.info("成功转换: %s -> %s", ctx['original_filename'], ctx['output_name'])
+        if ctx['cache_key']:
+            cache_store(ctx['cache_key'], self.output_format, ctx['output_file'])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("输出文件大小: %d 字节", os.path.getsize(ctx['output_file']))
+        return self.succeeded(ctx)
+    
+    def cleanup(self):
+        """清理临时目录"""
+        for temp_dir in self.temp_dirs:
+            try:
+                if os.path.exists(temp_dir):
+                    shutil.rmtree(temp_dir)
+            except Exception as e:
+                logger.error("清理临时目录失败: %s, 错误: %s", temp_dir, e)
+
+def zip_compression_for(arc_name):
+    """根据压缩策略决定ZIP条目使用存储还是deflate"""
+    policy = app.config['ZIP_COMPRESSION']
+    if policy == 'store':
+        return zipfile.ZIP_STORED
+    if policy == 'deflate':
+        return zipfile.ZIP_DEFLATED
+    # auto：已经压缩过的格式再deflate几乎没有收益，直接存储
+    ext = os.path.splitext(arc_name)[1].lstrip('.').lower()
+    return zipfile.ZIP_STORED if ext in PRECOMPRESSED_FORMATS else zipfile.ZIP_DEFLATED
+
+def iter_zip_entries(converted_files):
+    """按转换结果顺序生成(源文件路径, ZIP内文件名)，ZIP内文件名保证唯一"""
+    # 创建一个集合来跟踪已添加的文件名，避免重复
+    added_filenames = set()
+    
+    for file in converted_files:
+        if file['status'] == 'success':
+            # 使用转换后的文件名作为ZIP内的文件名
+            src_path = file['converted_path']
+            original_arc_name = file['converted_name']
             
-            # 创建临时输出文件
-            temp_output_file = os.path.join(temp_dir, unique_output_filename)
+            # 确保ZIP中的文件名唯一
+            arc_name = original_arc_name
+            counter = 1
             
-            # 调用Calibre的ebook-convert命令（使用完整路径）
-            # 首先尝试直接调用
-            cmd = [calibre_path, input_file, temp_output_file]
-            logger.debug(f"执行命令: {' '.join(cmd)}")
+            # 如果文件名已存在，添加编号后缀
+            while arc_name in added_filenames:
+                name_part, ext = os.path.splitext(original_arc_name)
+                arc_name = f"{name_part}_{counter}{ext}"
+                counter += 1
             
-            # 使用隔离的环境和更严格的超时
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                encoding='utf-8', 
-                errors='replace',
-                timeout=300,  # 5分钟超时
-                env=os.environ.copy()  # 使用隔离的环境变量
-            )
+            # 记录已添加的文件名
+            added_filenames.add(arc_name)
             
-            # 检查转换结果
-            if result.returncode == 0 and os.path.exists(temp_output_file):
-                # 检查临时输出文件是否有效
-                if os.path.getsize(temp_output_file) > 0:
-                    # 将临时文件移动到最终位置
-                    shutil.move(temp_output_file, output_file)
-                    logger.info(f"成功转换: {original_filename} -> {output_name}")
-                    logger.debug(f"输出文件大小: {os.path.getsize(output_file)} 字节")
-                    
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'converted_name': output_name,  # 使用用户可读的原始名称
-                        'converted_path': output_file,  # 实际存储路径使用唯一ID
-                        'status': 'success'
-                    })
-                else:
-                    logger.error(f"转换失败: 输出文件大小为零")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': '转换后的文件大小为零'
-                    })
-            else:
-                error_msg = result.stderr if result.stderr else '未知错误'
-                # 记录详细错误信息
-                logger.error(f"转换失败: {original_filename}")
-                logger.error(f"错误信息: {error_msg}")
-                
-                # 简化错误消息，取最后一行作为主要错误
-                if error_msg and len(error_msg) > 100:
-                    error_lines = error_msg.strip().split('\n')
-                    if error_lines:
-                        error_msg = error_lines[-1]
-                
-                converted_files.append({
-                    'original_name': original_filename,
-                    'status': 'failed',
-                    'error': error_msg
-                })
-        except subprocess.TimeoutExpired:
-            logger.error(f"转换超时: {original_filename}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '转换操作超时'
-            })
-        except Exception as e:
-            logger.exception(f"处理文件时发生异常: {original_filename}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': str(e)
-            })
-    
-    # 清理临时目录
-    for temp_dir in temp_files_to_remove:
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except Exception as e:
-            logger.error(f"清理临时目录失败: {temp_dir}, 错误: {str(e)}")
-    
-    return converted_files
+            # 检查源文件是否存在
+            if not os.path.exists(src_path):
+                logger.error(f"无法添加到ZIP，源文件不存在: {src_path}")
+                continue
+            
+            yield src_path, arc_name
 
 def create_zip_file(converted_files, batch_id):
     zip_filename = f"converted_{batch_id}.zip"
     zip_path = os.path.join(app.config['DOWNLOAD_FOLDER'], zip_filename)
     
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        # 创建一个集合来跟踪已添加的文件名，避免重复
-        added_filenames = set()
-        
-        for file in converted_files:
-            if file['status'] == 'success':
-                # 使用转换后的文件名作为ZIP内的文件名
-                src_path = file['converted_path']
-                original_arc_name = file['converted_name']
-                
-                # 确保ZIP中的文件名唯一
-                arc_name = original_arc_name
-                counter = 1
-                
-                # 如果文件名已存在，添加编号后缀
-                while arc_name in added_filenames:
-                    name_part, ext = os.path.splitext(original_arc_name)
-                    arc_name = f"{name_part}_{counter}{ext}"
-                    counter += 1
-                
-                # 记录已添加的文件名
-                added_filenames.add(arc_name)
-                
-                try:
-                    # 检查源文件是否存在
-                    if not os.path.exists(src_path):
-                        logger.error(f"无法添加到ZIP，源文件不存在: {src_path}")
-                        continue
-                        
-                    # 记录详细信息用于调试
-                    file_size = os.path.getsize(src_path)
-                    logger.debug(f"添加到ZIP - 源文件: {src_path} (大小: {file_size} 字节)")
-                    logger.debug(f"ZIP内文件名: {arc_name}")
-                    
-                    # 写入ZIP文件
-                    zipf.write(src_path, arc_name)
-                    logger.info(f"已添加到ZIP: {arc_name}")
-                except Exception as e:
-                    logger.error(f"添加文件到ZIP时出错: {e}")
+    with stage_timer('zip_write'), zipfile.ZipFile(zip_path, 'w') as zipf:
+        for src_path, arc_name in iter_zip_entries(converted_files):
+            try:
+                # 写入ZIP文件
+                zipf.write(src_path, arc_name, compress_type=zip_compression_for(arc_name))
+                logger.debug("已添加到ZIP: %s <- %s", arc_name, src_path)
+            except Exception as e:
+                logger.error(f"添加文件到ZIP时出错: {e}")
     
     # 验证ZIP文件
     try:
-        with zipfile.ZipFile(zip_path, 'r') as check_zip:
+        with stage_timer('zip_verify'), zipfile.ZipFile(zip_path, 'r') as check_zip:
             file_list = check_zip.namelist()
-            logger.info(f"ZIP文件创建成功，包含 {len(file_list)} 个文件")
-            logger.debug(f"ZIP文件内容: {', '.join(file_list)}")
+            logger.info("ZIP文件创建成功，包含 %d 个文件", len(file_list))
     except Exception as e:
         logger.error(f"ZIP文件验证失败: {e}")
     
     return zip_path
 
+class _ZipStreamBuffer(io.RawIOBase):
+    """只支持追加写入的缓冲区，zipfile会因为无法seek而改用数据描述符逐条写出"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self._position
+    
+    def pop(self):
+        """取出并清空已写入的数据"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip_file(entries):
+    """边读取转换结果边生成ZIP数据块，不在磁盘上落地归档文件"""
+    buffer = _ZipStreamBuffer()
+    chunk_size = app.config['ZIP_STREAM_CHUNK_SIZE']
+    
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zipf:
+        for src_path, arc_name in entries:
+            try:
+                # 预先写入文件大小，超过4GB时zipfile会自动使用ZIP64头
+                zinfo = zipfile.ZipInfo.from_file(src_path, arc_name)
+                zinfo.compress_type = zip_compression_for(arc_name)
+                with open(src_path, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        dest.write(chunk)
+                        data = buffer.pop()
+                        if data:
+                            yield data
+            except OSError as e:
+                logger.error(f"添加文件到ZIP流时出错: {e}")
+            data = buffer.pop()
+            if data:
+                yield data
+    
+    # 关闭时写出中央目录
+    yield buffer.pop()
+
 @app.route('/download/<batch_id>', methods=['GET'])
 def download_file(batch_id):
+    if app.config['ZIP_MODE'] == 'stream':
+        return stream_download(batch_id)
+    
+    download_start = time.perf_counter()
+    
     zip_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"converted_{batch_id}.zip")
     
-    if not os.path.exists(zip_path):
+    batch = load_batch(batch_id)
+    if batch is None or not batch['zip_bytes']:
         return jsonify({'error': 'Download not found'}), 404
     
-    # 记录 ZIP 文件路径用于下载后删除
-    response = send_file(
-        zip_path,
-        mimetype='application/zip',
-        as_attachment=True,
-        download_name=f"converted_ebooks.zip"
-    )
+    def on_close():
+        observe_stage('download', time.perf_counter() - download_start)
+        mark_batch_downloaded(batch_id)
     
-    # 在返回文件之前，启动异步清理过程
-    # 因为我们不能立即删除zip文件(正在下载)，所以仅清理上传和转换目录
-    cleanup_batch_files(batch_id)
+    # ZIP文件保留到批次到期，中断的下载可以用Range请求继续
+    try:
+        return send_data_file(zip_path, 'converted_ebooks.zip', mimetype='application/zip', on_close=on_close)
+    except FileNotFoundError:
+        # 文件被手动删除等原因与存储中的记录不一致
+        update_batch(batch_id, zip_bytes=0)
+        return jsonify({'error': 'Download not found'}), 404
+
+def stream_download(batch_id):
+    """流式下载：直接从转换结果生成ZIP；数据流没有固定长度，不支持Range请求"""
+    download_start = time.perf_counter()
+    job = find_job(batch_id)
+    if job is None or job['status'] != 'completed':
+        return jsonify({'error': 'Download not found'}), 404
+    
+    # 批次文件已被清理时视为不存在；全部转换失败时与文件模式一样返回空ZIP
+    batch = load_batch(batch_id)
+    if batch is None or batch['state'] in ('cleaned', 'removed'):
+        return jsonify({'error': 'Download not found'}), 404
+    converted_files = [f for f in job['result']['files'] if f.get('status') == 'success']
+    
+    entries = list(iter_zip_entries(converted_files))
+    response = Response(stream_zip_file(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=converted_ebooks.zip'
     
-    # 添加回调函数，在响应发送完毕后删除 ZIP 文件
     @response.call_on_close
     def on_close():
+        observe_stage('download', time.perf_counter() - download_start)
+        mark_batch_downloaded(batch_id)
+    
+    return response
+
+@app.route('/download/<batch_id>/files/<int:index>', methods=['GET'])
+def download_batch_file(batch_id, index):
+    """下载单个转换结果，index为结果中文件的序号（按 输出格式×文件 排列）；支持Range、If-Range和ETag"""
+    batch = load_batch(batch_id)
+    converted = load_batch_file(batch_id, index)
+    if (batch is None or batch['state'] in ('cleaned', 'removed') or converted is None
+            or converted['status'] != 'success' or not converted['converted_path']):
+        return jsonify({'error': 'Download not found'}), 404
+    try:
+        return send_data_file(converted['converted_path'], converted['converted_name'],
+                              on_close=lambda: mark_batch_downloaded(batch_id))
+    except FileNotFoundError:
+        return jsonify({'error': 'Download not found'}), 404
+
+def send_data_file(path, download_name, mimetype=None, on_close=None):
+    """发送数据目录中的文件，由send_file处理Range、If-Range和ETag等条件请求；
+    配置了 BOOKFORGE_SENDFILE 时只返回响应头，文件内容（包括Range请求）由前端代理读取和发送。
+    on_close 在响应发送完毕或客户端断开后调用"""
+    mode = app.config['SENDFILE_MODE']
+    if mode not in ('x-accel-redirect', 'x-sendfile'):
+        response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                             conditional=True, etag=True)
+        # werkzeug只在Range响应中带上该头，完整响应也声明支持，客户端中断后才会尝试续传
+        response.headers.setdefault('Accept-Ranges', 'bytes')
+        if on_close is not None:
+            # send_file的响应体由服务器直接迭代和关闭（以便使用sendfile），不会调用Response.close，
+            # call_on_close注册的回调不会执行，因此把回调挂到文件包装对象的close上
+            wrapper = response.response
+            close_file = wrapper.close
+            
+            def close():
+                try:
+                    close_file()
+                finally:
+                    on_close()
+            wrapper.close = close
+        return response
+    response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                         conditional=False, etag=True)
+    response.close()
+    response.set_data(b'')
+    # 响应体已替换为空，按普通响应发送，关闭时才会执行call_on_close注册的回调
+    response.direct_passthrough = False
+    if on_close is not None:
+        response.call_on_close(on_close)
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(path, DATA_FOLDER).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative)
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+def mark_batch_downloaded(batch_id):
+    """批次被下载后按下载后的保留时间到期，到期前可以重复下载或续传"""
+    retention = app.config['DOWNLOADED_RETENTION_SECONDS']
+    if retention <= 0:
+        return
+    try:
+        update_batch(batch_id, state='downloaded', retention=retention)
+    except sqlite3.Error:
+        logger.exception(f"更新批次 {batch_id} 的下载状态失败")
+
+@app.route('/jobs/<batch_id>', methods=['GET'])
+def job_status(batch_id):
+    """查询批次任务状态和每个文件的转换进度"""
+    job = find_job(batch_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    with _jobs_lock:
+        job['last_seen'] = time.time()
+        files = [dict(f) for f in job['files']]
+        snapshot = {
+            'batch_id': batch_id,
+            'status': job['status'],
+            'output_format': job['output_format'],
+            'output_formats': job['output_formats'],
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'error': job['error']
+        }
+    
+    for index, entry in enumerate(files):
+        if entry['status'] == 'success':
+            entry['download_url'] = url_for('download_batch_file', batch_id=batch_id, index=index)
+    snapshot.update({
+        'total': len(files),
+        'completed': len([f for f in files if f['status'] in ('success', 'failed')]),
+        'succeeded': len([f for f in files if f['status'] == 'success']),
+        'failed': len([f for f in files if f['status'] == 'failed']),
+        'files': job['upload_failures'] + files,
+        'result_url': url_for('job_result', batch_id=batch_id)
+    })
+    if snapshot['status'] in ('queued', 'running'):
+        snapshot['estimated_wait_seconds'] = estimate_job_wait(job)
+    if snapshot['status'] == 'completed':
+        snapshot['download_url'] = job['download_url']
+    return jsonify(snapshot)
+
+def _acquire_sse_stream():
+    """占用一个进度推送名额，已达上限时返回False"""
+    global _sse_streams
+    with _metrics_lock:
+        if _sse_streams >= app.config['SSE_MAX_STREAMS']:
+            return False
+        _sse_streams += 1
+        return True
+
+def _release_sse_stream():
+    global _sse_streams
+    with _metrics_lock:
+        _sse_streams -= 1
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _job_progress_changes(job, sent_files):
+    """找出自上次推送以来状态或进度有变化的文件，调用方需持有 _jobs_lock"""
+    changes = []
+    for index, entry in enumerate(job['files']):
+        state = (entry['status'], entry.get('progress'))
+        if sent_files.get(index) != state:
+            sent_files[index] = state
+            changes.append((index, dict(entry)))
+    return changes, job['status']
+
+@app.route('/progress/<batch_id>', methods=['GET'])
+def progress_stream(batch_id):
+    """以Server-Sent Events推送每个文件的状态变化和转换进度，批次结束后关闭连接"""
+    job = get_job(batch_id)
+    if job is None and load_job(batch_id) is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if not _acquire_sse_stream():
+        # 推送连接占满请求线程后轮询和下载请求都会排队；浏览器收到非200响应后不再重连，页面改为轮询状态
+        increment_counter('bookforge_progress_streams_rejected_total')
+        response = jsonify({'error': '进度推送连接数已满，请轮询任务状态',
+                            'status_url': url_for('job_status', batch_id=batch_id)})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    result_url = url_for('job_result', batch_id=batch_id)
+    
+    def generate():
+        with _jobs_lock:
+            job['watchers'] += 1
         try:
-            if os.path.exists(zip_path):
-                logger.info(f"下载完成后删除 ZIP 文件: {zip_path}")
-                os.remove(zip_path)
-        except Exception as e:
-            logger.error(f"删除 ZIP 文件失败: {str(e)}")
+            # 断线后浏览器1秒后重连，重连时会重新收到全部文件的当前状态
+            yield 'retry: 1000\n\n'
+            yield from stream_events()
+        finally:
+            # 客户端断开（或批次结束）时减少订阅数，全部断开后等待一段时间再决定是否取消
+            with _jobs_lock:
+                job['watchers'] -= 1
+                abandoned = job['watchers'] == 0 and job['status'] in ('queued', 'running')
+            grace = app.config['DISCONNECT_CANCEL_SECONDS']
+            if abandoned and grace > 0:
+                timer = threading.Timer(grace, _cancel_if_abandoned, args=(batch_id,))
+                timer.daemon = True
+                timer.start()
+    
+    def stream_events():
+        sent_files = {}
+        sent_status = None
+        while True:
+            with _job_events:
+                changes, status = _job_progress_changes(job, sent_files)
+                if not changes and status == sent_status:
+                    _job_events.wait(timeout=15)
+                    changes, status = _job_progress_changes(job, sent_files)
+                error = job['error']
+            
+            if not changes and status == sent_status:
+                # 定期发送注释行，避免代理因长时间无数据断开连接
+                yield ': keep-alive\n\n'
+                continue
+            for index, entry in changes:
+                yield _sse_event('file', {'index': index, **entry})
+            if status != sent_status:
+                sent_status = status
+                yield _sse_event('job', {'status': status, 'error': error})
+            if status == 'completed':
+                yield _sse_event('zip-ready', {'download_url': job['download_url'], 'result_url': result_url})
+                return
+            if status in ('failed', 'cancelled'):
+                return
     
+    def poll_stored():
+        """其他进程处理的批次：每秒从存储中读取一次文件状态，不包含实时的转换百分比"""
+        yield 'retry: 1000\n\n'
+        sent_files = {}
+        sent_status = None
+        idle = 0
+        while True:
+            stored = load_job(batch_id)
+            if stored is None:
+                return
+            changes, status = _job_progress_changes(stored, sent_files)
+            if not changes and status == sent_status:
+                idle += 1
+                if idle % 15 == 0:
+                    yield ': keep-alive\n\n'
+                time.sleep(1)
+                continue
+            idle = 0
+            for index, entry in changes:
+                yield _sse_event('file', {'index': index, **entry})
+            if status != sent_status:
+                sent_status = status
+                yield _sse_event('job', {'status': status, 'error': stored['error']})
+            if status == 'completed':
+                yield _sse_event('zip-ready', {'download_url': stored['download_url'], 'result_url': result_url})
+                return
+            if status in ('failed', 'cancelled'):
+                return
+    
+    response = Response(generate() if job is not None else poll_stored(), mimetype='text/event-stream')
+    # 客户端在推送开始前断开时生成器不会执行，名额在响应关闭时归还
+    response.call_on_close(_release_sse_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 关闭nginx对该响应的缓冲
     return response
 
+@app.route('/jobs/<batch_id>', methods=['DELETE'])
+def cancel_job_request(batch_id):
+    """取消排队或转换中的批次"""
+    job = find_job(batch_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if get_job(batch_id) is None and job['status'] in ('queued', 'running'):
+        # 由转换工作进程执行的批次，通过共享队列取消
+        if not get_task_broker().cancel(batch_id):
+            return jsonify({'error': '任务由其他进程处理，无法在当前进程中取消', 'status': job['status']}), 409
+        increment_counter('bookforge_jobs_cancelled_total', reason='request')
+        return jsonify({'success': True, 'batch_id': batch_id, 'status': find_job(batch_id)['status']}), 202
+    if not cancel_job(batch_id):
+        return jsonify({'error': '任务已结束，无法取消', 'status': job['status']}), 409
+    increment_counter('bookforge_jobs_cancelled_total', reason='request')
+    return jsonify({'success': True, 'batch_id': batch_id, 'status': job['status']}), 202
+
+def _cancel_if_abandoned(batch_id):
+    """进度推送的订阅者全部断开、没有重连且客户端也没有轮询状态时取消批次"""
+    job = get_job(batch_id)
+    if job is None or job['watchers'] > 0:
+        return
+    # 改为轮询的客户端仍在等待结果，从最后一次查询起重新计时
+    remaining = job['last_seen'] + app.config['DISCONNECT_CANCEL_SECONDS'] - time.time()
+    if remaining > 0:
+        timer = threading.Timer(remaining, _cancel_if_abandoned, args=(batch_id,))
+        timer.daemon = True
+        timer.start()
+        return
+    if cancel_job(batch_id):
+        logger.info("客户端已断开，自动取消批次: %s", batch_id)
+        increment_counter('bookforge_jobs_cancelled_total', reason='client_disconnected')
+
+@app.route('/jobs/<batch_id>/result', methods=['GET'])
+def job_result(batch_id):
+    """获取批次任务的最终结果，格式与原同步接口的响应相同"""
+    job = find_job(batch_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    with _jobs_lock:
+        job['last_seen'] = time.time()
+        status = job['status']
+        result = job['result']
+        error = job['error']
+    
+    if status == 'completed':
+        return jsonify(result)
+    if status == 'failed':
+        return jsonify({'success': False, 'status': status, 'error': error}), 500
+    if status == 'cancelled':
+        return jsonify({'success': False, 'status': status, 'error': '任务已取消'}), 409
+    return jsonify({
+        'success': False,
+        'status': status,
+        'message': '任务尚未完成',
+        'status_url': url_for('job_status', batch_id=batch_id)
+    }), 202
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """转换缓存的命中统计"""
+    return jsonify(conversion_cache_stats())
+
+@app.route('/admission/status', methods=['GET'])
+def get_admission_status():
+    """磁盘剩余空间和进行中批次的预留情况"""
+    return jsonify(admission_status())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus文本格式的运行指标"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/formats', methods=['GET'])
 def get_formats():
+    registry = get_calibre_registry()
+    input_formats = ALLOWED_INPUT_EXTENSIONS
+    output_formats = ALLOWED_OUTPUT_FORMATS
+    # Calibre可用时只列出实际有插件支持的格式
+    if registry['installed']:
+        input_formats = input_formats & registry['input_formats']
+        output_formats = output_formats & registry['output_formats']
     return jsonify({
-        'input_formats': list(ALLOWED_INPUT_EXTENSIONS),
-        'output_formats': list(ALLOWED_OUTPUT_FORMATS)
+        'input_formats': sorted(input_formats),
+        'output_formats': sorted(output_formats),
+        'calibre': {
+            'installed': registry['installed'],
+            'version': registry['version'],
+            'path': registry['path']
+        }
     })
 
 @app.route('/options/<output_format>', methods=['GET'])
@@ -505,352 +3498,303 @@ def get_format_options(output_format):
     if output_format in format_specific_options:
         options.extend(format_specific_options[output_format])
     
-    return jsonify({'options': options})
+    # 根据注册表中该格式实际支持的选项过滤，避免传入Calibre不认识的参数；指定输入格式时同时返回该输入插件的选项
+    registry = get_calibre_registry()
+    calibre_options = registry['format_options'].get(output_format)
+    input_format = request.args.get('input_format', '').lower()
+    if calibre_options is not None and input_format:
+        calibre_options = registry['input_options'].get(input_format, []) + calibre_options
+    if calibre_options is not None:
+        supported = {option['name'] for option in calibre_options}
+        options = [option for option in options if option['name'] in supported]
+    
+    return jsonify({'options': options, 'calibre_options': calibre_options or []})
 
 @app.route('/advanced-conversion', methods=['POST'])
 def advanced_conversion():
-    if 'files[]' not in request.files:
-        return jsonify({'error': 'No files part'}), 400
-    
-    files = request.files.getlist('files[]')
-    output_format = request.form.get('output_format')
-    options = {}
-    
-    # 从表单中获取选项
-    for key, value in request.form.items():
-        if key != 'output_format' and key != 'files[]':
-            options[key] = value
-    
-    if not output_format or output_format not in ALLOWED_OUTPUT_FORMATS:
-        return jsonify({'error': 'Invalid output format'}), 400
-    
-    if not files or files[0].filename == '':
-        return jsonify({'error': 'No selected files'}), 400
-    
     # 为这批文件创建一个唯一的ID
     batch_id = str(uuid.uuid4())
+    rejected = admit_batch(batch_id, request.content_length or app.config['MAX_CONTENT_LENGTH'])
+    if rejected is not None:
+        return rejected
     batch_folder = os.path.join(app.config['UPLOAD_FOLDER'], batch_id)
     os.makedirs(batch_folder, exist_ok=True)
     os.makedirs(os.path.join(app.config['CONVERTED_FOLDER'], batch_id), exist_ok=True)
+    register_batch(batch_id)
     
-    file_info = []
+    try:
+        with stage_timer('upload_ingest'):
+            form, file_info, has_file_part = ingest_multipart_upload(batch_folder, safe_storage_name)
+    except ValueError as e:
+        return _reject_upload(batch_id, {'error': f'Invalid form data: {e}'})
+    except Exception:
+        cleanup_batch_files(batch_id)
+        raise
     
-    for file in files:
-        if file and file.filename:
-            # 保存原始文件名
-            original_filename = file.filename
-            logger.debug(f"高级模式处理上传文件: {original_filename}")
-            
-            # 检查文件是否有扩展名
-            if '.' not in original_filename:
-                file_info.append({
-                    'filename': original_filename,
-                    'status': 'failed',
-                    'error': '文件必须有扩展名'
-                })
-                continue
-                
-            # 检查扩展名是否在允许列表中
-            if not allowed_file(original_filename, ALLOWED_INPUT_EXTENSIONS):
-                file_info.append({
-                    'filename': original_filename,
-                    'status': 'failed',
-                    'error': f'不支持的文件格式。支持的格式：{", ".join(ALLOWED_INPUT_EXTENSIONS)}'
-                })
-                continue
-                
-            # 提取原始扩展名
-            original_ext = original_filename.rsplit('.', 1)[1].lower()
-            
-            # 生成安全的文件名，但保留原始扩展名
-            name_part = secure_filename(os.path.splitext(original_filename)[0])
-            safe_filename = f"{name_part}.{original_ext}"
-            
-            # 确保文件名不为空
-            if not name_part:
-                name_part = "unnamed_file"
-                safe_filename = f"{name_part}.{original_ext}"
-                
-            file_path = os.path.join(batch_folder, safe_filename)
-            
-            # 记录详细信息用于调试
-            logger.debug(f"原始文件名: {original_filename}")
-            logger.debug(f"安全文件名: {safe_filename}")
-            logger.debug(f"保存路径: {file_path}")
-            
-            # 保存文件
-            file.save(file_path)
-            file_info.append({
-                'filename': original_filename,  # 使用原始文件名
-                'path': file_path,
-                'status': 'uploaded'
-            })
+    if not has_file_part:
+        return _reject_upload(batch_id, {'error': 'No files part'})
     
-    if not file_info:
-        return jsonify({'error': 'No valid files uploaded'}), 400
+    output_formats = parse_output_formats(form.getlist('output_format') + form.getlist('output_formats'))
+    options = {}
     
-    # 开始转换过程，传入高级选项
-    converted_files = advanced_convert_files(file_info, output_format, batch_id, options)
+    # 从表单中获取选项
+    for key, value in form.items():
+        if key not in ('output_format', 'output_formats', 'files[]'):
+            options[key] = value
     
-    # 创建ZIP文件
-    zip_path = create_zip_file(converted_files, batch_id)
+    if not output_formats:
+        return _reject_upload(batch_id, {'error': 'Invalid output format'})
     
-    return jsonify({
-        'success': True,
-        'message': f'成功转换 {len([f for f in converted_files if f.get("status") == "success"])} 个文件',
-        'download_url': url_for('download_file', batch_id=batch_id),
-        'files': converted_files
-    })
-
-def advanced_convert_files(file_info, output_format, batch_id, options):
-    converted_files = []
-    # 用于跟踪已创建的输出文件名，避免冲突
-    used_output_names = set()
+    if not file_info:
+        return _reject_upload(batch_id, {'error': 'No selected files'})
     
-    # 标记是否需要清理临时文件
-    temp_files_to_remove = []
+    valid_files = [f for f in file_info if f['status'] == 'uploaded']
+    if not valid_files:
+        return _reject_upload(batch_id, {'error': 'No valid files uploaded', 'files': file_info})
     
-    # 使用与普通转换相同的Calibre路径
-    calibre_path = 'ebook-convert'
+    # 转换过程交给后台任务，传入高级选项
+    failed_uploads = [f for f in file_info if f['status'] == 'failed']
+    job = create_job(batch_id, valid_files, failed_uploads, output_formats, options)
+    enqueue_job(job)
     
-    for file in file_info:
-        input_file = file['path']
-        original_filename = file['filename']
-        
-        # 保留原始文件名，仅改变扩展名
-        original_name_without_ext = os.path.splitext(original_filename)[0]
-        base_output_name = f"{original_name_without_ext}.{output_format}"
-        
-        # 确保输出文件名唯一，但尽量保留原始名称
-        output_name = base_output_name
-        counter = 1
-        while output_name in used_output_names:
-            output_name = f"{original_name_without_ext}_{counter}.{output_format}"
-            counter += 1
-        
-        # 添加到已使用名称集合
-        used_output_names.add(output_name)
-        
-        # 构建完整输出路径 - 为存储生成唯一文件名，但记录原始输出名
-        unique_output_filename = f"{uuid.uuid4().hex}.{output_format}"
-        output_file = os.path.join(app.config['CONVERTED_FOLDER'], batch_id, unique_output_filename)
-        
-        # 详细记录文件信息，用于调试
-        logger.debug(f"高级转换 - 处理文件: {original_filename}")
-        logger.debug(f"输入文件路径: {input_file}")
-        logger.debug(f"输入文件是否存在: {os.path.exists(input_file)}")
-        logger.debug(f"输入文件大小: {os.path.getsize(input_file) if os.path.exists(input_file) else 'N/A'}")
-        logger.debug(f"输入文件扩展名: {os.path.splitext(input_file)[1]}")
-        logger.debug(f"原始输出文件名: {output_name}")
-        logger.debug(f"存储输出文件名: {unique_output_filename}")
-        logger.debug(f"输出文件路径: {output_file}")
-        
-        # 检查文件是否存在
-        if not os.path.exists(input_file):
-            logger.error(f"文件不存在: {input_file}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '找不到上传的文件'
-            })
+    return job_accepted_response(job)
+
+# 清理函数 - 定期运行以清理旧文件
+# 批次生命周期索引：记录每个批次的状态、占用的磁盘空间和到期时间，
+# 后台清理线程按到期时间从小顶堆中依次取出批次删除，不再需要周期性地扫描整个目录
+BATCHES = {}
+_batches_cond = threading.Condition()
+# (检查时间, 批次ID)；批次的到期时间延后时，条目被取出后按新的时间重新放回；
+# 到期时间提前（例如下载之后）时另外放入一个条目，批次删除后多余的条目在取出时跳过
+_batch_expiry_heap = []
+_batch_reaper_thread = None
+# 排队或转换中的批次不会被删除；上传中的批次只会在长时间没有完成时到期，不参与配额淘汰
+ACTIVE_BATCH_STATES = {'queued', 'running'}
+
+def _batch_bytes(batch):
+    return batch['upload_bytes'] + batch['converted_bytes'] + batch['zip_bytes']
+
+def _index_batch(batch):
+    with _batches_cond:
+        BATCHES[batch['batch_id']] = batch
+        heapq.heappush(_batch_expiry_heap, (batch['expires_at'], batch['batch_id']))
+        _batches_cond.notify()
+
+def register_batch(batch_id, state='uploading', expires_at=None, upload_bytes=0, converted_bytes=0, zip_bytes=0):
+    """在生命周期索引和状态存储中登记一个批次，到期后由后台清理线程删除"""
+    now = time.time()
+    batch = {
+        'batch_id': batch_id,
+        'state': state,
+        'created_at': now,
+        'expires_at': expires_at or now + app.config['BATCH_RETENTION_SECONDS'],
+        'upload_bytes': upload_bytes,
+        'converted_bytes': converted_bytes,
+        'zip_bytes': zip_bytes
+    }
+    store_batch(batch_id, **{key: value for key, value in batch.items() if key != 'batch_id'})
+    _index_batch(batch)
+
+def update_batch(batch_id, state=None, retention=None, **sizes):
+    """更新批次的状态和占用空间；状态变化时把到期时间设为 retention 秒后（默认按批次保留时间顺延），
+    只更新占用空间时保留原来的到期时间（例如下载之后较短的保留时间）；批次文件全部删除后从索引中移除"""
+    fields = dict(sizes)
+    if state is not None or retention is not None:
+        if retention is None:
+            retention = app.config['BATCH_RETENTION_SECONDS']
+        fields['expires_at'] = time.time() + retention
+    if state is not None:
+        fields['state'] = state
+    if not fields:
+        return
+    # 存储中的记录由所有进程共享，即使本进程的索引中没有该批次也要更新
+    with state_transaction() as conn:
+        conn.execute(f"UPDATE batches SET {', '.join(f'{key} = ?' for key in fields)} WHERE batch_id = ?",
+                     list(fields.values()) + [batch_id])
+    with _batches_cond:
+        batch = BATCHES.get(batch_id)
+        if batch is None:
+            return
+        previous_expiry = batch['expires_at']
+        batch.update(fields)
+        if _batch_bytes(batch) == 0 and batch['state'] not in ACTIVE_BATCH_STATES | {'uploading'}:
+            del BATCHES[batch_id]
+        elif batch['expires_at'] < previous_expiry:
+            heapq.heappush(_batch_expiry_heap, (batch['expires_at'], batch_id))
+            _batches_cond.notify()
+        elif sizes and app.config['BATCH_DISK_QUOTA_BYTES']:
+            _batches_cond.notify()
+
+def batch_disk_usage():
+    with _batches_cond:
+        return len(BATCHES), sum(_batch_bytes(b) for b in BATCHES.values())
+
+def _take_due_batches(now):
+    """取出已到期和需要为磁盘配额让出空间的批次，调用方需持有 _batches_cond"""
+    due = []
+    skipped = []
+    quota = app.config['BATCH_DISK_QUOTA_BYTES']
+    excess = sum(_batch_bytes(b) for b in BATCHES.values()) - quota if quota else 0
+    while _batch_expiry_heap and (_batch_expiry_heap[0][0] <= now or excess > 0):
+        check_at, batch_id = heapq.heappop(_batch_expiry_heap)
+        batch = BATCHES.get(batch_id)
+        if batch is None:
             continue
-        
-        # 确保输入文件有正确的扩展名
-        file_ext = os.path.splitext(input_file)[1].lower()
-        if not file_ext:
-            # 文件没有扩展名，尝试从原始文件名推断扩展名
-            if '.' in original_filename:
-                orig_ext = original_filename.rsplit('.', 1)[1].lower()
-                if orig_ext in ALLOWED_INPUT_EXTENSIONS:
-                    new_input_file = f"{input_file}.{orig_ext}"
-                    logger.debug(f"文件缺少扩展名，重命名为: {new_input_file}")
-                    try:
-                        os.rename(input_file, new_input_file)
-                        input_file = new_input_file
-                        # 增加重命名成功的日志
-                        logger.info(f"文件已成功重命名: {input_file}")
-                    except Exception as e:
-                        logger.error(f"重命名文件失败: {str(e)}")
-                        converted_files.append({
-                            'original_name': original_filename,
-                            'status': 'failed',
-                            'error': f'文件重命名失败: {str(e)}'
-                        })
-                        continue
-                else:
-                    logger.warning(f"原始文件扩展名不被支持: {orig_ext}")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': f'不支持的文件格式：{orig_ext}'
-                    })
-                    continue
-            else:
-                # 如果无法确定扩展名，尝试添加默认扩展名
-                default_ext = 'txt'  # 使用默认扩展名
-                new_input_file = f"{input_file}.{default_ext}"
-                logger.warning(f"文件没有扩展名，添加默认扩展名: {default_ext}")
-                try:
-                    os.rename(input_file, new_input_file)
-                    input_file = new_input_file
-                    logger.info(f"文件已添加默认扩展名: {input_file}")
-                except Exception as e:
-                    logger.error(f"添加默认扩展名失败: {str(e)}")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': f'添加文件扩展名失败: {str(e)}'
-                    })
-                    continue
-        
-        # 额外检查 - 确保文件路径中包含扩展名
-        if '.' not in os.path.basename(input_file):
-            logger.error(f"文件路径不包含扩展名: {input_file}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '文件必须有扩展名'
-            })
+        expired = batch['expires_at'] <= now
+        if batch['state'] in ACTIVE_BATCH_STATES or (not expired and (excess <= 0 or batch['state'] == 'uploading')):
+            # 未到期或仍在使用：按当前的到期时间放回堆中
+            skipped.append((max(batch['expires_at'], check_at), batch_id))
             continue
-        
-        try:
-            # 创建每个文件专用的临时目录以避免并发问题
-            temp_dir = os.path.join(app.config['CONVERTED_FOLDER'], batch_id, f"temp_{uuid.uuid4().hex}")
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_files_to_remove.append(temp_dir)
-            
-            # 创建临时输出文件
-            temp_output_file = os.path.join(temp_dir, unique_output_filename)
-            
-            # 调用Calibre的ebook-convert命令
-            cmd = [calibre_path, input_file, temp_output_file]
-            
-            # 添加选项
-            for key, value in options.items():
-                if value:  # 只添加有值的选项
-                    cmd.append(f'--{key.replace("_", "-")}={value}')
-            
-            logger.debug(f"执行命令: {' '.join(cmd)}")
-            
-            # 使用隔离的环境和更严格的超时
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                encoding='utf-8', 
-                errors='replace',
-                timeout=300,  # 5分钟超时
-                env=os.environ.copy()  # 使用隔离的环境变量
-            )
-            
-            # 检查转换结果
-            if result.returncode == 0 and os.path.exists(temp_output_file):
-                # 检查临时输出文件是否有效
-                if os.path.getsize(temp_output_file) > 0:
-                    # 将临时文件移动到最终位置
-                    shutil.move(temp_output_file, output_file)
-                    logger.info(f"成功转换: {original_filename} -> {output_name}")
-                    logger.debug(f"输出文件大小: {os.path.getsize(output_file)} 字节")
-                    
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'converted_name': output_name,  # 使用用户可读的原始名称
-                        'converted_path': output_file,  # 实际存储路径使用唯一ID
-                        'status': 'success'
-                    })
-                else:
-                    logger.error(f"转换失败: 输出文件大小为零")
-                    converted_files.append({
-                        'original_name': original_filename,
-                        'status': 'failed',
-                        'error': '转换后的文件大小为零'
-                    })
-            else:
-                error_msg = result.stderr if result.stderr else '未知错误'
-                # 记录详细错误信息
-                logger.error(f"转换失败: {original_filename}")
-                logger.error(f"错误信息: {error_msg}")
-                
-                # 简化错误消息，取最后一行作为主要错误
-                if error_msg and len(error_msg) > 100:
-                    error_lines = error_msg.strip().split('\n')
-                    if error_lines:
-                        error_msg = error_lines[-1]
-                
-                converted_files.append({
-                    'original_name': original_filename,
-                    'status': 'failed',
-                    'error': error_msg
-                })
-        except subprocess.TimeoutExpired:
-            logger.error(f"转换超时: {original_filename}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': '转换操作超时'
-            })
-        except Exception as e:
-            logger.exception(f"处理文件时发生异常: {original_filename}")
-            converted_files.append({
-                'original_name': original_filename,
-                'status': 'failed',
-                'error': str(e)
-            })
-    
-    # 清理临时目录
-    for temp_dir in temp_files_to_remove:
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except Exception as e:
-            logger.error(f"清理临时目录失败: {temp_dir}, 错误: {str(e)}")
-    
-    return converted_files
+        del BATCHES[batch_id]
+        due.append((batch_id, 'expired' if expired else 'quota'))
+        excess -= _batch_bytes(batch)
+    for item in skipped:
+        if item[0] <= now:
+            # 使用中的批次稍后再检查
+            item = (now + 60, item[1])
+        heapq.heappush(_batch_expiry_heap, item)
+    return due
+
+def _sync_batches_from_store():
+    """批次由转换工作进程执行时，本进程索引中排队或转换中的批次按存储中的记录更新，结束后释放预留空间"""
+    with _batches_cond:
+        active = [batch_id for batch_id, batch in BATCHES.items() if batch['state'] in ACTIVE_BATCH_STATES]
+    if not active:
+        return
+    rows = state_db().execute(
+        'SELECT batch_id, state, expires_at, upload_bytes, converted_bytes, zip_bytes FROM batches '
+        f"WHERE batch_id IN ({', '.join('?' for _ in active)})", active).fetchall()
+    finished = []
+    with _batches_cond:
+        for row in rows:
+            batch = BATCHES.get(row['batch_id'])
+            if batch is None:
+                continue
+            batch.update(dict(row))
+            if batch['state'] not in ACTIVE_BATCH_STATES:
+                finished.append(row['batch_id'])
+    for batch_id in finished:
+        release_reservation(batch_id)
+
+# 批次由转换工作进程执行时同步批次状态的间隔（秒）
+BATCH_SYNC_INTERVAL = 30
+
+def _batch_reaper_loop():
+    remote = not get_task_broker().in_process
+    while True:
+        if remote:
+            try:
+                _sync_batches_from_store()
+            except sqlite3.Error:
+                logger.exception("同步批次状态失败")
+        with _batches_cond:
+            due = _take_due_batches(time.time())
+            if not due:
+                timeout = _batch_expiry_heap[0][0] - time.time() if _batch_expiry_heap else None
+                if remote:
+                    timeout = BATCH_SYNC_INTERVAL if timeout is None else min(timeout, BATCH_SYNC_INTERVAL)
+                _batches_cond.wait(timeout)
+                continue
+        for batch_id, reason in due:
+            logger.info(f"批次 {batch_id} {'已到期' if reason == 'expired' else '因磁盘配额不足被淘汰'}")
+            try:
+                remove_batch_files(batch_id)
+                increment_counter('bookforge_batches_reaped_total', reason=reason)
+            except Exception:
+                logger.exception(f"清理批次 {batch_id} 时发生异常")
+
+@app.before_request
+def _ensure_batch_reaper():
+    """在处理请求的进程中按需启动后台清理线程（gunicorn主进程中不启动，避免fork时持有锁）"""
+    global _batch_reaper_thread
+    if _batch_reaper_thread is not None and _batch_reaper_thread.is_alive():
+        return
+    with _batches_cond:
+        if _batch_reaper_thread is None or not _batch_reaper_thread.is_alive():
+            _batch_reaper_thread = threading.Thread(target=_batch_reaper_loop, name='batch-reaper', daemon=True)
+            _batch_reaper_thread.start()
+
+def remove_batch_files(batch_id):
+    """删除批次的全部文件，包括打包好的ZIP"""
+    logger.info(f"删除批次 {batch_id} 的全部文件")
+    for path in (os.path.join(UPLOAD_FOLDER, batch_id), os.path.join(CONVERTED_FOLDER, batch_id)):
+        shutil.rmtree(path, ignore_errors=True)
+    zip_path = os.path.join(DOWNLOAD_FOLDER, f"converted_{batch_id}.zip")
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    update_batch(batch_id, state='removed', upload_bytes=0, converted_bytes=0, zip_bytes=0)
+    release_reservation(batch_id)
+
+def _tree_usage(path):
+    """目录的最后修改时间和总大小"""
+    latest = os.path.getmtime(path)
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.stat(os.path.join(root, filename))
+            latest = max(latest, st.st_mtime)
+            total += st.st_size
+    return latest, total
 
-# 清理函数 - 定期运行以清理旧文件
 def cleanup_old_files(max_age_hours=24):
-    """清理超过一定时间的临时文件和目录"""
+    """启动时清理超过一定时间的临时文件，并把其余遗留的批次登记到生命周期索引中"""
     logger.info(f"开始清理超过 {max_age_hours} 小时的临时文件...")
     
-    current_time = time.time()
-    max_age_seconds = max_age_hours * 3600
-    
-    # 清理上传目录中的旧批次文件夹
-    try:
-        for batch_id in os.listdir(UPLOAD_FOLDER):
-            batch_path = os.path.join(UPLOAD_FOLDER, batch_id)
-            if os.path.isdir(batch_path):
-                # 检查目录的修改时间
-                mod_time = os.path.getmtime(batch_path)
-                if (current_time - mod_time) > max_age_seconds:
-                    logger.info(f"清理旧上传目录: {batch_id}")
-                    shutil.rmtree(batch_path, ignore_errors=True)
-    except Exception as e:
-        logger.error(f"清理上传目录时出错: {str(e)}")
-    
-    # 清理转换目录中的旧批次文件夹
-    try:
-        for batch_id in os.listdir(CONVERTED_FOLDER):
-            batch_path = os.path.join(CONVERTED_FOLDER, batch_id)
-            if os.path.isdir(batch_path):
-                mod_time = os.path.getmtime(batch_path)
-                if (current_time - mod_time) > max_age_seconds:
-                    logger.info(f"清理旧转换目录: {batch_id}")
-                    shutil.rmtree(batch_path, ignore_errors=True)
-    except Exception as e:
-        logger.error(f"清理转换目录时出错: {str(e)}")
+    # 状态存储中的批次按记录的到期时间和占用空间恢复，不需要扫描目录
+    prune_stored_batches()
+    now = time.time()
+    stored = {}  # batch_id -> 存储中记录的状态
+    for batch in recover_stored_batches():
+        stored[batch['batch_id']] = batch['state']
+        if _batch_bytes(batch) == 0:
+            continue
+        if batch['expires_at'] is not None and batch['expires_at'] <= now:
+            logger.info(f"清理到期批次: {batch['batch_id']}")
+            remove_batch_files(batch['batch_id'])
+        else:
+            _index_batch({key: batch[key] for key in ('batch_id', 'state', 'created_at', 'expires_at',
+                                                      'upload_bytes', 'converted_bytes', 'zip_bytes')})
     
-    # 清理下载目录中的旧ZIP文件
+    # 上次运行遗留的批次：{batch_id: [最后修改时间, 上传字节数, 转换结果字节数, ZIP字节数]}
+    found = {}
+    for folder, column in ((UPLOAD_FOLDER, 1), (CONVERTED_FOLDER, 2)):
+        try:
+            for batch_id in os.listdir(folder):
+                batch_path = os.path.join(folder, batch_id)
+                if os.path.isdir(batch_path):
+                    mod_time, size = _tree_usage(batch_path)
+                    entry = found.setdefault(batch_id, [0, 0, 0, 0])
+                    entry[0] = max(entry[0], mod_time)
+                    entry[column] = size
+        except Exception as e:
+            logger.error(f"扫描目录 {folder} 时出错: {str(e)}")
     try:
         for filename in os.listdir(DOWNLOAD_FOLDER):
             if filename.startswith("converted_") and filename.endswith(".zip"):
-                file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-                mod_time = os.path.getmtime(file_path)
-                if (current_time - mod_time) > max_age_seconds:
-                    logger.info(f"清理旧ZIP文件: {filename}")
-                    os.remove(file_path)
+                st = os.stat(os.path.join(DOWNLOAD_FOLDER, filename))
+                entry = found.setdefault(filename[len("converted_"):-len(".zip")], [0, 0, 0, 0])
+                entry[0] = max(entry[0], st.st_mtime)
+                entry[3] = st.st_size
     except Exception as e:
-        logger.error(f"清理下载目录时出错: {str(e)}")
+        logger.error(f"扫描下载目录时出错: {str(e)}")
+    
+    expire_before = time.time() - max_age_hours * 3600
+    # 其余目录没有批次记录（存储启用之前或记录已被删除），按最后修改时间处理
+    for batch_id, (mod_time, upload_bytes, converted_bytes, zip_bytes) in found.items():
+        if batch_id in BATCHES:
+            continue
+        if batch_id in stored:
+            # 有记录但没有占用空间（例如没有收到任何分块的上传会话），不能按遗留批次重新登记而覆盖原有记录
+            if stored[batch_id] not in ACTIVE_BATCH_STATES | {'uploading'}:
+                remove_batch_files(batch_id)
+            continue
+        if mod_time < expire_before:
+            logger.info(f"清理旧批次: {batch_id}")
+            remove_batch_files(batch_id)
+        else:
+            # 遗留批次没有任务记录，按最后修改时间计算到期时间，由后台清理线程删除
+            register_batch(batch_id, state='orphaned', expires_at=mod_time + max_age_hours * 3600,
+                           upload_bytes=upload_bytes, converted_bytes=converted_bytes, zip_bytes=zip_bytes)
     
     logger.info("清理完成")
 
@@ -862,7 +3806,7 @@ def cleanup_batch_files(batch_id):
     batch_upload_path = os.path.join(UPLOAD_FOLDER, batch_id)
     if os.path.exists(batch_upload_path):
         try:
-            logger.debug(f"删除上传目录: {batch_upload_path}")
+            logger.debug("删除上传目录: %s", batch_upload_path)
             shutil.rmtree(batch_upload_path, ignore_errors=True)
         except Exception as e:
             logger.error(f"删除上传目录时出错: {str(e)}")
@@ -871,12 +3815,14 @@ def cleanup_batch_files(batch_id):
     batch_converted_path = os.path.join(CONVERTED_FOLDER, batch_id)
     if os.path.exists(batch_converted_path):
         try:
-            logger.debug(f"删除转换目录: {batch_converted_path}")
+            logger.debug("删除转换目录: %s", batch_converted_path)
             shutil.rmtree(batch_converted_path, ignore_errors=True)
         except Exception as e:
             logger.error(f"删除转换目录时出错: {str(e)}")
     
     # 注意：这里不删除ZIP文件，因为用户可能需要再次下载
+    update_batch(batch_id, state='cleaned', upload_bytes=0, converted_bytes=0)
+    release_reservation(batch_id)
     logger.info(f"批次 {batch_id} 清理完成")
 
 @app.route('/clean-zip/<batch_id>', methods=['POST'])
@@ -885,9 +3831,14 @@ def clean_zip_file(batch_id):
     zip_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"converted_{batch_id}.zip")
     
     try:
-        if os.path.exists(zip_path):
+        batch = load_batch(batch_id)
+        if batch is not None and batch['zip_bytes']:
             logger.info(f"手动清理ZIP文件: {zip_path}")
-            os.remove(zip_path)
+            try:
+                os.remove(zip_path)
+            except FileNotFoundError:
+                pass
+            update_batch(batch_id, zip_bytes=0)
             return jsonify({'success': True, 'message': '文件已清理'})
         else:
             return jsonify({'success': False, 'message': '文件不存在'}), 404
@@ -895,7 +3846,8 @@ def clean_zip_file(batch_id):
         logger.error(f"清理ZIP文件失败: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-if __name__ == '__main__':
+def run_startup_checks():
+    """启动时执行一次的检查和清理，多进程部署时只在主进程中调用"""
     # 检查Calibre是否已安装
     if not check_calibre_installed():
         print("警告: Calibre未安装或ebook-convert不在PATH中")
@@ -903,6 +3855,10 @@ if __name__ == '__main__':
         print("继续启动应用，但转换功能可能无法正常工作")
     
     # 清理旧文件
-    cleanup_old_files()
+    cleanup_old_files(app.config['BATCH_RETENTION_SECONDS'] / 3600)
+
+if __name__ == '__main__':
+    # 开发服务器，生产环境请使用 gunicorn -c gunicorn.conf.py app:app
+    run_startup_checks()
     
     app.run(host='0.0.0.0', port=5000, debug=False) 
\ No newline at end of file
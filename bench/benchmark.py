@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""BookForge请求路径基准测试
+
+在子进程中启动BookForge，并把 bench/fake_ebook_convert.py 作为 ebook-convert 放到PATH中，
+用合成的批次驱动 /upload、/advanced-conversion 和 /download/<batch_id>，
+报告吞吐量、p50/p99延迟、服务进程的峰值内存和磁盘写入量。
+这样可以在没有安装Calibre的环境中发现请求路径上的性能回退。
+
+示例：
+    python bench/benchmark.py --files 1,10,40 --size-kb 64,1024 --iterations 5 --concurrency 2
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CALIBRE = os.path.join(ROOT, 'bench', 'fake_ebook_convert.py')
+
+SERVER_SCRIPT = """
+import logging
+import sys
+sys.path.insert(0, {root!r})
+import app
+logging.getLogger().setLevel(logging.WARNING)
+app.check_calibre_installed()
+app.app.run(host='127.0.0.1', port={port}, threaded=True)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, args):
+    """在子进程中启动应用，数据目录和ebook-convert都指向临时目录"""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    fake = os.path.join(bin_dir, 'ebook-convert')
+    with open(fake, 'w') as f:
+        f.write(f'#!/bin/sh\nexec {sys.executable} {FAKE_CALIBRE} "$@"\n')
+    os.chmod(fake, 0o755)
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'BOOKFORGE_DATA_DIR': os.path.join(workdir, 'data'),
+        'FAKE_CALIBRE_LATENCY': args.latency,
+        'FAKE_CALIBRE_OUTPUT_RATIO': str(args.output_ratio),
+        'FAKE_CALIBRE_FAILURE_RATE': str(args.failure_rate)
+    })
+    if args.workers:
+        env['BOOKFORGE_CONVERSION_WORKERS'] = str(args.workers)
+
+    port = free_port()
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT.format(root=ROOT, port=port)],
+                               env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'服务进程启动失败，日志见 {log.name}')
+        try:
+            urllib.request.urlopen(base_url + '/formats', timeout=1).read()
+            return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('等待服务启动超时')
+
+
+def process_stats(pid):
+    """读取服务进程的峰值常驻内存和实际写入磁盘的字节数（仅Linux）"""
+    stats = {'peak_rss_bytes': None, 'write_bytes': None}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    stats['peak_rss_bytes'] = int(line.split()[1]) * 1024
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    stats['write_bytes'] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def multipart_body(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def request_json(url, data=None, content_type=None):
+    req = urllib.request.Request(url, data=data, method='POST' if data is not None else 'GET')
+    if content_type:
+        req.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=600) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def run_batch(base_url, endpoint, file_count, file_size, args):
+    """上传一个批次、等待转换完成并下载ZIP，返回各阶段耗时"""
+    # 每个文件内容随机，避免命中转换缓存
+    files = [('files[]', f'book_{i}.{args.input_format}', os.urandom(file_size)) for i in range(file_count)]
+    fields = {'output_format': args.output_format}
+    if endpoint == '/advanced-conversion':
+        fields['base_font_size'] = '12'
+    body, content_type = multipart_body(fields, files)
+
+    start = time.perf_counter()
+    status, data = request_json(base_url + endpoint, body, content_type)
+    upload_latency = time.perf_counter() - start
+    if status != 202:
+        raise RuntimeError(f'上传失败: {status} {data}')
+
+    while True:
+        status, job = request_json(base_url + data['status_url'])
+        if job.get('status') in ('completed', 'failed'):
+            break
+        time.sleep(args.poll_interval)
+    convert_latency = time.perf_counter() - start
+
+    zip_bytes = 0
+    if job['status'] == 'completed':
+        with urllib.request.urlopen(base_url + job['download_url'], timeout=600) as response:
+            while True:
+                chunk = response.read(1024 * 1024)
+                if not chunk:
+                    break
+                zip_bytes += len(chunk)
+    total_latency = time.perf_counter() - start
+
+    return {
+        'upload_latency': upload_latency,
+        'convert_latency': convert_latency,
+        'total_latency': total_latency,
+        'files': file_count,
+        'succeeded': job.get('succeeded', 0),
+        'zip_bytes': zip_bytes
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_scenario(process, base_url, endpoint, file_count, file_size, args):
+    before = process_stats(process.pid)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_batch, base_url, endpoint, file_count, file_size, args)
+                   for _ in range(args.iterations)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    after = process_stats(process.pid)
+
+    totals = [r['total_latency'] for r in results]
+    uploads = [r['upload_latency'] for r in results]
+    files = sum(r['files'] for r in results)
+    written = None
+    if before['write_bytes'] is not None and after['write_bytes'] is not None:
+        written = after['write_bytes'] - before['write_bytes']
+    return {
+        'endpoint': endpoint,
+        'files_per_batch': file_count,
+        'file_size_bytes': file_size,
+        'batches': len(results),
+        'files': files,
+        'succeeded': sum(r['succeeded'] for r in results),
+        'elapsed_seconds': elapsed,
+        'files_per_second': files / elapsed if elapsed else 0.0,
+        'batch_latency_p50': percentile(totals, 50),
+        'batch_latency_p99': percentile(totals, 99),
+        'upload_latency_p50': percentile(uploads, 50),
+        'upload_latency_p99': percentile(uploads, 99),
+        'peak_rss_bytes': after['peak_rss_bytes'],
+        'disk_bytes_written': written
+    }
+
+
+def print_report(results):
+    header = (f"{'endpoint':<22}{'files':>6}{'size':>10}{'files/s':>10}{'p50(s)':>9}{'p99(s)':>9}"
+              f"{'up p50':>9}{'up p99':>9}{'rss(MB)':>9}{'disk(MB)':>10}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        rss = f"{r['peak_rss_bytes'] / 1048576:.1f}" if r['peak_rss_bytes'] is not None else '-'
+        disk = f"{r['disk_bytes_written'] / 1048576:.1f}" if r['disk_bytes_written'] is not None else '-'
+        print(f"{r['endpoint']:<22}{r['files_per_batch']:>6}{r['file_size_bytes'] // 1024:>8}KB"
+              f"{r['files_per_second']:>10.2f}{r['batch_latency_p50']:>9.3f}{r['batch_latency_p99']:>9.3f}"
+              f"{r['upload_latency_p50']:>9.3f}{r['upload_latency_p99']:>9.3f}{rss:>9}{disk:>10}")
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BookForge请求路径基准测试（使用模拟的ebook-convert）')
+    parser.add_argument('--endpoints', default='/upload,/advanced-conversion',
+                        help='要测试的上传接口，逗号分隔')
+    parser.add_argument('--files', type=parse_int_list, default=[1, 10, 40], help='每个批次的文件数，逗号分隔')
+    parser.add_argument('--size-kb', type=parse_int_list, default=[64, 1024], help='单个文件大小（KB），逗号分隔')
+    parser.add_argument('--iterations', type=int, default=5, help='每个场景提交的批次数')
+    parser.add_argument('--concurrency', type=int, default=2, help='同时提交的批次数')
+    parser.add_argument('--workers', type=int, default=0, help='服务端转换并发数，默认使用服务端配置')
+    parser.add_argument('--latency', default='0.05', help='模拟的单次转换耗时（秒），可写成"最小值:最大值"')
+    parser.add_argument('--output-ratio', type=float, default=1.0, help='输出文件与输入文件的大小比例')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='模拟转换失败的概率')
+    parser.add_argument('--input-format', default='txt')
+    parser.add_argument('--output-format', default='epub')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='查询任务状态的间隔（秒）')
+    parser.add_argument('--json', dest='json_path', help='把结果另存为JSON文件')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录和服务日志')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bookforge-bench-')
+    process, base_url = start_server(workdir, args)
+    results = []
+    try:
+        for endpoint in [e for e in args.endpoints.split(',') if e]:
+            for file_count in args.files:
+                for size_kb in args.size_kb:
+                    results.append(run_scenario(process, base_url, endpoint, file_count, size_kb * 1024, args))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        if args.keep:
+            print(f'临时目录: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
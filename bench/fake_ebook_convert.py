@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""ebook-convert的替身，用于在没有Calibre的环境中测量BookForge自身的开销
+
+通过环境变量控制行为：
+    FAKE_CALIBRE_LATENCY       每次转换的模拟耗时（秒），可写成"最小值:最大值"表示均匀随机
+    FAKE_CALIBRE_OUTPUT_RATIO  输出文件大小与输入文件大小的比例
+    FAKE_CALIBRE_FAILURE_RATE  转换失败的概率（0~1）
+"""
+import os
+import random
+import sys
+import time
+
+VERSION = 'ebook-convert (calibre 7.0.0 [BookForge fake])'
+
+HELP_TEMPLATE = """Usage: ebook-convert input_file output_file [options]
+
+Convert an e-book from one format to another.
+
+Options:
+  --version             show program's version number and exit
+  -h, --help            show this help message and exit
+
+INPUT OPTIONS:
+  Options to control the processing of the input {input_format} file
+
+  --input-encoding=INPUT_ENCODING
+                        Specify the character encoding of the input document.
+{input_specific}
+OUTPUT OPTIONS:
+  Options to control the processing of the output {output_format}
+
+  --epub-version=EPUB_VERSION
+                        The version of the EPUB file to generate.
+  --paper-size=PAPER_SIZE
+                        The size of the paper.
+  --pdf-page-margin-left=PDF_PAGE_MARGIN_LEFT
+                        The size of the left page margin, in pts.
+  --pdf-page-margin-right=PDF_PAGE_MARGIN_RIGHT
+                        The size of the right page margin, in pts.
+
+LOOK AND FEEL:
+  Options to control the look and feel of the output
+
+  --base-font-size=BASE_FONT_SIZE
+                        The base font size in pts.
+  --line-height=LINE_HEIGHT
+                        The line height in pts.
+"""
+
+# 只有部分输入插件才有的选项
+INPUT_SPECIFIC_HELP = {
+    'txt': """  --formatting-type=FORMATTING_TYPE
+                        Formatting used within the document.
+""",
+}
+
+
+def _latency():
+    value = os.environ.get('FAKE_CALIBRE_LATENCY', '0.05')
+    if ':' in value:
+        low, high = value.split(':', 1)
+        return random.uniform(float(low), float(high))
+    return float(value)
+
+
+def main(argv):
+    if '--version' in argv:
+        print(VERSION)
+        return 0
+
+    positional = [arg for arg in argv if not arg.startswith('-')]
+    if '-h' in argv or '--help' in argv:
+        input_format = positional[0].rsplit('.', 1)[-1] if positional else 'epub'
+        output_format = positional[1].rsplit('.', 1)[-1] if len(positional) > 1 else 'epub'
+        print(HELP_TEMPLATE.format(input_format=input_format, output_format=output_format,
+                                   input_specific=INPUT_SPECIFIC_HELP.get(input_format, '')))
+        return 0
+
+    if len(positional) < 2:
+        print('Usage: ebook-convert input_file output_file [options]', file=sys.stderr)
+        return 1
+    input_file, output_file = positional[0], positional[1]
+
+    # 模拟Calibre的进度输出
+    latency = _latency()
+    steps = 4
+    for step in range(1, steps + 1):
+        time.sleep(latency / steps)
+        print(f'{step * 100 // steps}% Converting', flush=True)
+
+    if random.random() < float(os.environ.get('FAKE_CALIBRE_FAILURE_RATE', '0')):
+        print('Traceback (most recent call last):', file=sys.stderr)
+        print('ValueError: simulated conversion failure', file=sys.stderr)
+        return 1
+
+    ratio = float(os.environ.get('FAKE_CALIBRE_OUTPUT_RATIO', '1.0'))
+    output_size = max(1, int(os.path.getsize(input_file) * ratio))
+    with open(output_file, 'wb') as f:
+        remaining = output_size
+        block = os.urandom(min(remaining, 1024 * 1024))
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+    print(f'Output saved to   {output_file}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,91 @@
+"""常驻的Calibre转换进程
+
+由BookForge通过 calibre-debug -e calibre_worker.py 启动，运行在Calibre自带的Python环境中。
+Calibre的模块只在启动时加载一次，之后从标准输入逐行读取JSON格式的转换请求：
+    {"args": ["输入文件", "输出文件", "--选项", ...]}
+每完成一次转换，向标准输出写入一行JSON应答：
+    {"returncode": 0, "stdout": "...", "stderr": "...", "rss": 当前常驻内存字节数, "cpu": 累计CPU秒数}
+转换过程中Calibre自身的输出被重定向到临时文件，不会混入应答通道。
+"""
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+
+def rss_bytes():
+    """当前进程的常驻内存（字节），无法读取时返回0"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # macOS上ru_maxrss以字节为单位，Linux上以KB为单位
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except (ImportError, OSError):
+        return 0
+
+
+def cpu_seconds():
+    """当前进程及已回收子进程累计的CPU时间（秒）"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def convert(convert_main, args):
+    """在当前进程内执行一次ebook-convert，返回(退出码, 标准输出, 标准错误)"""
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try:
+            returncode = convert_main(['ebook-convert'] + list(args))
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+        out.seek(0)
+        err.seek(0)
+        return (returncode or 0,
+                out.read().decode('utf-8', 'replace'),
+                err.read().decode('utf-8', 'replace'))
+
+
+def main():
+    # 复制一份原始的标准输出作为应答通道，此后文件描述符1只用于承接Calibre的输出
+    reply = os.fdopen(os.dup(1), 'w', encoding='utf-8', buffering=1)
+    from calibre.ebooks.conversion.cli import main as convert_main
+
+    reply.write(json.dumps({'ready': True, 'pid': os.getpid(), 'rss': rss_bytes(), 'cpu': cpu_seconds()}) + '\n')
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        returncode, stdout, stderr = convert(convert_main, job['args'])
+        reply.write(json.dumps({'returncode': returncode, 'stdout': stdout,
+                                'stderr': stderr, 'rss': rss_bytes(), 'cpu': cpu_seconds()}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""BookForge转换工作进程
+
+设置 BOOKFORGE_CONVERSION_BROKER=sqlite 后，Web进程只负责接收上传并把批次放入状态数据库中的共享队列，
+由本进程领取批次并执行转换，转换结果写回共享的数据目录和状态数据库。
+可以启动任意数量的工作进程，与Web前端分开扩展；所有进程需要使用同一个
+BOOKFORGE_DATA_DIR 和 BOOKFORGE_STATE_DB，并且运行在同一台机器上：
+状态数据库使用SQLite的WAL模式，不能放在NFS等网络文件系统上供多台机器共享。
+
+启动方式: python conversion_worker.py
+
+    BOOKFORGE_JOB_RUNNERS         每个工作进程同时处理的批次数，默认 8
+    BOOKFORGE_CONVERSION_WORKERS  每个工作进程同时运行的ebook-convert数量，默认 CPU核心数
+    BOOKFORGE_GRACEFUL_TIMEOUT    退出时等待进行中转换的秒数，默认 330
+"""
+import os
+
+import app
+
+
+def main():
+    app.run_conversion_worker(graceful_timeout=int(os.environ.get('BOOKFORGE_GRACEFUL_TIMEOUT', '330')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""BookForge的gunicorn配置
+
+启动方式: gunicorn -c gunicorn.conf.py app:app
+
+所有参数都可以通过环境变量调整：
+    BOOKFORGE_BIND              监听地址，默认 0.0.0.0:5000
+    BOOKFORGE_WEB_WORKERS       工作进程数，默认 1
+    BOOKFORGE_WEB_THREADS       每个工作进程的请求线程数，默认 8
+    BOOKFORGE_GRACEFUL_TIMEOUT  退出时等待进行中转换的秒数，默认 330
+
+批次和文件的状态写入共享的SQLite数据库（BOOKFORGE_STATE_DB），任意工作进程都能查询和下载；
+分块上传的会话仍保存在接收init请求的进程中，增加工作进程数时分块上传需要按批次ID做会话保持。
+"""
+import os
+
+bind = os.environ.get('BOOKFORGE_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('BOOKFORGE_WEB_WORKERS', '1'))
+threads = int(os.environ.get('BOOKFORGE_WEB_THREADS', '8'))
+worker_class = 'gthread'
+
+# 上传和ZIP下载可能持续较长时间，gthread的心跳不受请求阻塞，这里只需覆盖慢客户端
+timeout = 120
+keepalive = 5
+
+# 单个文件的默认转换超时是300秒，退出前留出足够时间让进行中的批次完成
+graceful_timeout = int(os.environ.get('BOOKFORGE_GRACEFUL_TIMEOUT', '330'))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('BOOKFORGE_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """在主进程中检查Calibre并清理旧文件，工作进程fork后直接复用检查结果"""
+    import app
+    app.run_startup_checks()
+
+
+def post_worker_init(worker):
+    """SIGTERM到达时先停止接收新批次，再交给gunicorn关闭监听
+
+    worker_exit要等请求线程全部结束后才调用，那时已不会再有请求到达；
+    已经接受连接、正在等待空闲线程的请求需要在这里就开始返回503
+    """
+    import signal
+    import app
+    handle_exit = worker.handle_exit
+
+    def handle_term(signum, frame):
+        app.stop_accepting_jobs()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    """工作进程退出前停止接收新批次，并等待已入队的批次转换完成"""
+    import app
+    # 比主进程强制结束工作进程的时间略早返回，保证日志能够写出
+    app.drain_jobs(timeout=max(1, server.cfg.graceful_timeout - 5))
@@ -12,6 +12,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const conversionResults = document.getElementById('conversion-results');
     const resultsTable = document.getElementById('results-table');
     const downloadLink = document.getElementById('download-link');
+    const conversionProgress = document.getElementById('conversion-progress');
 
     // 监听文件选择
     filesInput.addEventListener('change', function(e) {
@@ -372,36 +373,230 @@ document.addEventListener('DOMContentLoaded', function() {
         // 创建表单数据
         const formData = new FormData(this);
         
-        // 根据是否显示高级选项决定使用哪个端点
-        const endpoint = showAdvancedCheckbox.checked ? '/advanced-conversion' : '/upload';
+        // 主输出格式加上勾选的其他格式，同一批文件一次转换为多个格式
+        const outputFormats = [outputFormat].concat(
+            formData.getAll('extra_formats').filter(format => format !== outputFormat));
         
-        // 发送请求
-        fetch(endpoint, {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => response.json())
+        // 高级选项：除文件、输出格式和界面开关之外的表单字段
+        const advanced = showAdvancedCheckbox.checked;
+        const options = {};
+        if (advanced) {
+            for (const [key, value] of formData.entries()) {
+                if (key !== 'files[]' && key !== 'output_format' && key !== 'extra_formats' && key !== 'show-advanced') {
+                    options[key] = value;
+                }
+            }
+        }
+        
+        // 分块上传，断线时只需重传失败的分块
+        resumableUpload(Array.from(filesInput.files), outputFormats, advanced, options)
         .then(data => {
-            // 隐藏加载状态
-            convertBtn.disabled = false;
-            loadingSpinner.classList.add('d-none');
-            
-            if (data.success) {
-                // 显示转换结果
-                displayConversionResults(data);
-                showAlert('转换完成！', 'success');
+            if (data.success && data.status_url) {
+                // 文件已上传，转换在后台进行，订阅进度推送（不支持时轮询任务状态）
+                showAlert(data.message || '文件已上传，正在转换...', 'info');
+                watchJobProgress(data);
             } else {
+                finishConversion();
                 showAlert('转换失败: ' + (data.error || '未知错误'), 'danger');
             }
         })
         .catch(error => {
             console.error('转换请求出错:', error);
-            showAlert('转换请求出错，请查看控制台获取详细信息', 'danger');
-            convertBtn.disabled = false;
-            loadingSpinner.classList.add('d-none');
+            showAlert('转换请求出错: ' + error.message, 'danger');
+            finishConversion();
         });
     });
 
+    // 分块上传的并发数和单个分块的重试次数
+    const UPLOAD_CONCURRENCY = 4;
+    const CHUNK_RETRIES = 3;
+
+    // 可续传的分块上传：登记文件 -> 并行上传分块 -> 提交转换
+    function resumableUpload(files, outputFormats, advanced, options) {
+        return fetch('/uploads/init', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                output_formats: outputFormats,
+                advanced: advanced,
+                options: options,
+                files: files.map(file => ({ name: file.name, size: file.size }))
+            })
+        })
+        .then(response => response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || '上传初始化失败');
+            }
+            return data;
+        }))
+        .then(session => {
+            // 按文件名对应本地文件，服务端已拒绝的文件不会出现在列表中
+            const pending = files.slice();
+            const chunks = [];
+            session.files.forEach(info => {
+                const index = pending.findIndex(file => file.name === info.filename && file.size === info.size);
+                const file = pending.splice(index, 1)[0];
+                for (let offset = 0; offset < info.size; offset += session.chunk_size) {
+                    chunks.push({ file: file, fileId: info.file_id, offset: offset,
+                                  end: Math.min(offset + session.chunk_size, info.size) });
+                }
+            });
+            
+            const totalBytes = chunks.reduce((sum, chunk) => sum + chunk.end - chunk.offset, 0);
+            let uploadedBytes = 0;
+            const uploadChunk = (chunk, attempt) => fetch(
+                `/uploads/${session.batch_id}/files/${chunk.fileId}?offset=${chunk.offset}`,
+                { method: 'PUT', body: chunk.file.slice(chunk.offset, chunk.end) }
+            ).then(response => {
+                if (!response.ok) {
+                    throw new Error(`分块上传失败: ${response.status}`);
+                }
+                uploadedBytes += chunk.end - chunk.offset;
+                updateUploadProgress(uploadedBytes, totalBytes);
+            }).catch(error => {
+                if (attempt >= CHUNK_RETRIES) {
+                    throw error;
+                }
+                console.warn('分块上传失败，准备重试:', error);
+                return new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)))
+                    .then(() => uploadChunk(chunk, attempt + 1));
+            });
+            
+            // 多个上传通道并行消费分块队列
+            const queue = chunks.slice();
+            const lanes = [];
+            for (let i = 0; i < Math.min(UPLOAD_CONCURRENCY, queue.length); i++) {
+                lanes.push((function next() {
+                    const chunk = queue.shift();
+                    return chunk ? uploadChunk(chunk, 0).then(next) : Promise.resolve();
+                })());
+            }
+            
+            return Promise.all(lanes)
+                .then(() => fetch(`/uploads/${session.batch_id}/finalize`, { method: 'POST' }))
+                .then(response => response.json());
+        });
+    }
+
+    // 显示上传进度
+    function updateUploadProgress(uploadedBytes, totalBytes) {
+        if (!conversionProgress) return;
+        const percent = totalBytes ? Math.floor(uploadedBytes * 100 / totalBytes) : 100;
+        conversionProgress.textContent = `正在上传：${percent}%`;
+        conversionProgress.classList.remove('d-none');
+    }
+
+    // 恢复按钮和加载状态
+    function finishConversion() {
+        convertBtn.disabled = false;
+        loadingSpinner.classList.add('d-none');
+        if (conversionProgress) {
+            conversionProgress.classList.add('d-none');
+        }
+    }
+
+    // 显示后台任务进度
+    function updateProgress(job) {
+        if (!conversionProgress) return;
+        const text = job.status === 'queued' ?
+            '排队中，请稍候...' :
+            `正在转换：已完成 ${job.completed} / ${job.total} 个文件`;
+        conversionProgress.textContent = text;
+        conversionProgress.classList.remove('d-none');
+    }
+
+    // 通过Server-Sent Events接收每个文件的状态和转换百分比
+    function watchJobProgress(job) {
+        if (!window.EventSource || !job.progress_url) {
+            pollJobStatus(job.status_url, job.result_url);
+            return;
+        }
+        
+        const files = {};
+        const source = new EventSource(job.progress_url);
+        let finished = false;
+        
+        source.addEventListener('file', event => {
+            const file = JSON.parse(event.data);
+            files[file.index] = file;
+            const entries = Object.values(files);
+            const done = entries.filter(f => f.status === 'success' || f.status === 'failed').length;
+            const percent = Math.floor(entries.reduce((sum, f) =>
+                sum + (f.status === 'success' || f.status === 'failed' ? 100 : (f.progress || 0)), 0) / entries.length);
+            if (conversionProgress) {
+                conversionProgress.textContent = `正在转换：已完成 ${done} / ${entries.length} 个文件（${percent}%）`;
+                conversionProgress.classList.remove('d-none');
+            }
+        });
+        
+        source.addEventListener('job', event => {
+            const state = JSON.parse(event.data);
+            if (state.status === 'queued') {
+                updateProgress(state);
+            } else if (state.status === 'failed' || state.status === 'cancelled') {
+                finished = true;
+                source.close();
+                finishConversion();
+                showAlert(state.status === 'cancelled' ? '转换已取消' : '转换失败: ' + (state.error || '未知错误'), 'danger');
+            }
+        });
+        
+        source.addEventListener('zip-ready', event => {
+            finished = true;
+            source.close();
+            const ready = JSON.parse(event.data);
+            fetch(ready.result_url)
+                .then(response => response.json())
+                .then(data => {
+                    finishConversion();
+                    displayConversionResults(data);
+                    showAlert('转换完成！', 'success');
+                });
+        });
+        
+        // 连接中断时由浏览器按服务端的retry间隔自动重连，重连后会重新收到全部文件的当前状态；
+        // 服务端拒绝连接（如推送连接数已满）时不会重连，改为轮询，避免用户以为页面卡住而重复提交
+        source.onerror = () => {
+            if (finished || source.readyState !== EventSource.CLOSED) return;
+            finished = true;
+            pollJobStatus(job.status_url, job.result_url);
+        };
+    }
+    
+    // 轮询后台任务状态，完成后获取最终结果
+    function pollJobStatus(statusUrl, resultUrl) {
+        fetch(statusUrl)
+            .then(response => response.json())
+            .then(job => {
+                if (job.status === 'completed') {
+                    return fetch(resultUrl)
+                        .then(response => response.json())
+                        .then(data => {
+                            finishConversion();
+                            displayConversionResults(data);
+                            showAlert('转换完成！', 'success');
+                        });
+                }
+                if (job.status === 'cancelled') {
+                    finishConversion();
+                    showAlert('转换已取消', 'danger');
+                    return;
+                }
+                if (job.status === 'failed' || job.error) {
+                    finishConversion();
+                    showAlert('转换失败: ' + (job.error || '未知错误'), 'danger');
+                    return;
+                }
+                updateProgress(job);
+                setTimeout(() => pollJobStatus(statusUrl, resultUrl), 1000);
+            })
+            .catch(error => {
+                console.error('查询转换进度出错:', error);
+                showAlert('查询转换进度出错，请查看控制台获取详细信息', 'danger');
+                finishConversion();
+            });
+    }
+
     // 显示转换结果
     function displayConversionResults(data) {
         // 清空结果表格
@@ -418,42 +613,17 @@ document.addEventListener('DOMContentLoaded', function() {
             const statusText = file.status === 'success' ? '成功' : '失败';
             
             row.innerHTML = `
-                <td><i class="bi bi-file-earmark me-2"></i>${file.original_name}</td>
+                <td><i class="bi bi-file-earmark me-2"></i>${file.original_name}${file.output_format ? ` <small class="text-muted">→ ${file.output_format.toUpperCase()}</small>` : ''}</td>
                 <td class="${statusClass}">${statusIcon}${statusText} ${file.error ? `<small>(${file.error})</small>` : ''}</td>
-                <td>${file.status === 'success' ? `<i class="bi bi-file-earmark-text me-2"></i>${file.converted_name}` : '-'}</td>
+                <td>${file.status === 'success' ? `<i class="bi bi-file-earmark-text me-2"></i>${file.download_url ? `<a href="${file.download_url}">${file.converted_name}</a>` : file.converted_name}` : '-'}</td>
             `;
             
             resultsTable.appendChild(row);
         });
         
-        // 更新下载链接
+        // 更新下载链接；批次文件在最后一次下载后保留一段时间，由服务端按批次生命周期清理
         downloadLink.href = data.download_url;
         
-        // 添加下载完成后的清理功能
-        const batchId = data.download_url.split('/').pop();
-        downloadLink.setAttribute('data-batch-id', batchId);
-        
-        // 监听下载链接的点击事件
-        downloadLink.addEventListener('click', function(e) {
-            // 捕获批次ID
-            const batchId = this.getAttribute('data-batch-id');
-            
-            // 设置一个延时调用清理接口（给用户足够时间下载）
-            setTimeout(() => {
-                // 调用清理接口
-                fetch(`/clean-zip/${batchId}`, {
-                    method: 'POST'
-                })
-                .then(response => response.json())
-                .then(data => {
-                    console.log('清理结果:', data);
-                })
-                .catch(error => {
-                    console.error('清理请求出错:', error);
-                });
-            }, 3000); // 3秒延时，给用户足够时间开始下载
-        }, { once: true }); // 使用 {once: true} 确保事件只触发一次
-        
         // 显示结果区域
         conversionResults.style.display = 'block';
         
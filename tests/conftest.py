@@ -0,0 +1,74 @@
+"""测试环境：数据目录指向临时目录，ebook-convert 使用 bench/fake_ebook_convert.py
+
+环境变量必须在导入app之前设置，配置在模块导入时读取。
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CALIBRE = os.path.join(ROOT, 'bench', 'fake_ebook_convert.py')
+
+WORKDIR = tempfile.mkdtemp(prefix='bookforge-test-')
+BIN_DIR = os.path.join(WORKDIR, 'bin')
+os.makedirs(BIN_DIR)
+with open(os.path.join(BIN_DIR, 'ebook-convert'), 'w') as f:
+    f.write(f'#!/bin/sh\nexec {sys.executable} {FAKE_CALIBRE} "$@"\n')
+os.chmod(os.path.join(BIN_DIR, 'ebook-convert'), 0o755)
+
+os.environ['PATH'] = BIN_DIR + os.pathsep + os.environ.get('PATH', '')
+os.environ['BOOKFORGE_DATA_DIR'] = os.path.join(WORKDIR, 'data')
+os.environ.setdefault('FAKE_CALIBRE_LATENCY', '0.05')
+os.environ.setdefault('FAKE_CALIBRE_FAILURE_RATE', '0')
+sys.path.insert(0, ROOT)
+
+import app as bookforge  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    bookforge.check_calibre_installed()
+    return bookforge
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config['TESTING'] = True
+    with app_module.app.test_client() as client:
+        yield client
+
+
+@pytest.fixture(scope='session')
+def project_root():
+    return ROOT
+
+
+@pytest.fixture
+def upload(client):
+    """上传文件并返回入队响应，每个文件内容都不同，避免命中转换缓存"""
+    def upload(*names, output_format='epub'):
+        files = [(io.BytesIO(f'{name} {uuid.uuid4()}'.encode()), name) for name in names]
+        response = client.post('/upload', data={'output_format': output_format, 'files[]': files},
+                               content_type='multipart/form-data')
+        assert response.status_code == 202, response.get_json()
+        return response.get_json()
+    return upload
+
+
+@pytest.fixture
+def wait_for(client):
+    """轮询任务状态直到进入指定状态之一，返回最后一次的状态"""
+    def wait_for(job, statuses, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = client.get(job['status_url']).get_json()
+            if status['status'] in statuses:
+                return status
+            time.sleep(0.05)
+        pytest.fail(f"任务 {job['batch_id']} 未在 {timeout} 秒内进入 {statuses}")
+    return wait_for
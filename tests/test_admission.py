@@ -0,0 +1,83 @@
+import io
+import shutil
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def admit(app_module):
+    admitted = []
+
+    def admit(input_bytes, output_formats=('epub',), filenames=('book.txt',)):
+        batch_id = uuid.uuid4().hex
+        with app.app.app_context():
+            response = app.admit_batch(batch_id, input_bytes, list(output_formats), filenames)
+        if response is None:
+            admitted.append(batch_id)
+        return batch_id, response
+
+    yield admit
+    for batch_id in admitted:
+        app.release_reservation(batch_id)
+
+
+def test_admits_and_reserves(admit, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MIN_FREE_BYTES', 0)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 0)
+    batch_id, response = admit(1000)
+    assert response is None
+    assert app._reservations[batch_id] >= 1000
+    app.release_reservation(batch_id)
+    assert batch_id not in app._reservations
+
+
+def test_busy_when_reservations_fill_disk(admit, monkeypatch):
+    free = shutil.disk_usage(app.DATA_FOLDER).free
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MIN_FREE_BYTES', 0)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 0)
+    monkeypatch.setitem(app._reservations, 'other-batch', free)
+    _, response = admit(1000)
+    assert response.status_code == 429
+    assert response.get_json()['reason'] == 'busy'
+    assert response.headers['Retry-After'] == '30'
+
+
+def test_disk_full_when_batch_exceeds_free_space(admit, monkeypatch):
+    free = shutil.disk_usage(app.DATA_FOLDER).free
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MIN_FREE_BYTES', free)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 0)
+    _, response = admit(1000)
+    assert response.status_code == 503
+    assert response.get_json()['reason'] == 'disk_full'
+    assert response.headers['Retry-After'] == '300'
+
+
+def test_reservation_cap_is_not_retryable(admit, monkeypatch):
+    # 磁盘空间充足，但单个批次超过预留上限：不能报告为磁盘空间不足
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MIN_FREE_BYTES', 0)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 1000)
+    _, response = admit(1000)
+    assert response.status_code == 413
+    payload = response.get_json()
+    assert payload['reason'] == 'reservation_cap'
+    assert '磁盘' not in payload['error']
+    assert 'Retry-After' not in response.headers
+
+
+def test_cap_counts_other_reservations_as_busy(admit, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MIN_FREE_BYTES', 0)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 1024 * 1024)
+    monkeypatch.setitem(app._reservations, 'other-batch', 1024 * 1024)
+    _, response = admit(1000)
+    assert response.status_code == 429
+
+
+def test_upload_rejected_over_cap(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'ADMISSION_MAX_RESERVED_BYTES', 1)
+    response = client.post('/upload', data={'output_format': 'epub', 'files[]': [(io.BytesIO(b'text'), 'a.txt')]},
+                           content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert response.get_json()['reason'] == 'reservation_cap'
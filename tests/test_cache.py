@@ -0,0 +1,97 @@
+import io
+import os
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+import app
+
+
+def test_cache_key_normalizes_options(app_module):
+    key = app.make_cache_key('abc', '.txt', 'epub', {'epub_version': '3', 'base_font_size': ' 12 '})
+    assert key == app.make_cache_key('abc', '.txt', 'epub', {'base-font-size': '12', 'epub_version': '3'})
+    # 空值的选项不会出现在命令行中，与不传相同
+    assert app.make_cache_key('abc', '.txt', 'epub', {'line_height': ''}) == app.make_cache_key('abc', '.txt', 'epub')
+    assert app.make_cache_key('abc', '.txt', 'epub', {}) == app.make_cache_key('abc', '.txt', 'epub', None)
+
+
+@pytest.mark.parametrize('changed', [
+    ('abd', '.txt', 'epub', None),
+    ('abc', '.html', 'epub', None),
+    ('abc', '.txt', 'pdf', None),
+    ('abc', '.txt', 'epub', {'epub_version': '2'}),
+])
+def test_cache_key_distinguishes_inputs(app_module, changed):
+    assert app.make_cache_key(*changed) != app.make_cache_key('abc', '.txt', 'epub', None)
+
+
+def test_cache_key_includes_calibre_version(app_module, monkeypatch):
+    key = app.make_cache_key('abc', '.txt', 'epub')
+    monkeypatch.setattr(app, 'get_calibre_version', lambda: 'calibre 99')
+    assert app.make_cache_key('abc', '.txt', 'epub') != key
+
+
+def test_repeated_upload_hits_cache_with_hardlink(client, wait_for, monkeypatch):
+    outputs = []
+    monkeypatch.setattr(app, 'CONVERSION_STAGE_HOOKS',
+                        [lambda stage, ctx, seconds: outputs.append((stage, ctx['output_file']))])
+    data = f'cached {uuid.uuid4()}'.encode()
+    statuses = []
+    for _ in range(2):
+        before = app.conversion_cache_stats()
+        response = client.post('/upload', data={'output_format': 'epub', 'files[]': [(io.BytesIO(data), 'cached.txt')]},
+                               content_type='multipart/form-data')
+        assert response.status_code == 202
+        statuses.append(wait_for(response.get_json(), ('completed', 'failed')))
+        after = app.conversion_cache_stats()
+        statuses[-1]['cache_delta'] = {name: after[name] - before[name] for name in ('hits', 'misses', 'stores')}
+
+    assert [status['status'] for status in statuses] == ['completed', 'completed']
+    assert statuses[0]['cache_delta'] == {'hits': 0, 'misses': 1, 'stores': 1}
+    assert statuses[1]['cache_delta'] == {'hits': 1, 'misses': 0, 'stores': 0}
+    # 命中缓存的文件在prepare阶段完成，不再调用Calibre
+    assert [stage for stage, _ in outputs] == list(app.ConversionPipeline.STAGES) + ['validate', 'prepare']
+    first, second = outputs[0][1], outputs[-1][1]
+    assert os.path.samefile(first, second)
+    assert os.stat(second).st_nlink >= 3  # 两个批次的结果加上缓存文件
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """使用独立的缓存目录和索引"""
+    monkeypatch.setitem(app.app.config, 'CACHE_FOLDER', str(tmp_path / 'cache'))
+    monkeypatch.setattr(app, '_cache_index', OrderedDict())
+    monkeypatch.setattr(app, '_cache_loaded', False)
+    return tmp_path
+
+
+def store(tmp_path, key, size):
+    path = tmp_path / f'{key}.epub'
+    path.write_bytes(b'x' * size)
+    app.cache_store(key, 'epub', str(path))
+    return app._cache_path(key, 'epub')
+
+
+def test_lru_eviction(cache_dir, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_CACHE_MAX_BYTES', 250)
+    paths = {key: store(cache_dir, key, 100) for key in ('aa', 'bb')}
+    # 读取aa后bb成为最久未使用的条目
+    assert app.cache_lookup('aa', str(cache_dir / 'hit.epub'))
+    paths['cc'] = store(cache_dir, 'cc', 100)
+    assert list(app._cache_index) == ['aa', 'cc']
+    assert not os.path.exists(paths['bb'])
+    assert os.path.exists(paths['aa']) and os.path.exists(paths['cc'])
+    assert not app.cache_lookup('bb', str(cache_dir / 'miss.epub'))
+
+
+def test_index_rebuilt_in_lru_order(cache_dir):
+    for age, key in enumerate(('new', 'mid', 'old')):
+        path = app._cache_path(key, 'epub')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        os.utime(path, (1000 - age, 1000 - age))
+    with app._cache_lock:
+        app._load_cache_index()
+    assert list(app._cache_index) == ['old', 'mid', 'new']
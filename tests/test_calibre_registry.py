@@ -0,0 +1,58 @@
+import os
+
+import app
+
+HELP = """Usage: ebook-convert input_file output_file [options]
+
+Options:
+  --version             show program's version number and exit
+  -h, --help            show this help message and exit
+
+INPUT OPTIONS:
+  --input-encoding=INPUT_ENCODING
+                        Specify the character encoding
+                        of the input document.
+
+LOOK AND FEEL:
+  --line-height=LINE_HEIGHT
+                        The line height in pts.
+  --linearize-tables    Some badly designed documents use tables.
+"""
+
+
+def test_parse_calibre_help():
+    options = app.parse_calibre_help(HELP)
+    assert [(o['name'], o['section'], o['value']) for o in options] == [
+        ('input_encoding', 'input options', 'INPUT_ENCODING'),
+        ('line_height', 'look and feel', 'LINE_HEIGHT'),
+        ('linearize_tables', 'look and feel', None),
+    ]
+    assert options[0]['help'] == 'Specify the character encoding of the input document.'
+
+
+def test_registry_probed_once(app_module, monkeypatch):
+    registry = app.get_calibre_registry()
+    assert registry['installed']
+    assert {'epub', 'pdf'} <= registry['output_formats']
+    assert 'txt' in registry['input_formats']
+    probes = []
+    monkeypatch.setattr(app, 'build_calibre_registry', lambda: probes.append(1))
+    assert app.get_calibre_registry() is registry
+    assert probes == []
+
+
+def test_registry_reprobed_when_calibre_replaced(app_module):
+    registry = app.get_calibre_registry()
+    path = registry['path']
+    stat = os.stat(path)
+    try:
+        # 升级或替换ebook-convert后修改时间变化，下次使用时重新探测
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        reprobed = app.get_calibre_registry()
+        assert reprobed is not registry
+        assert reprobed['mtime'] == stat.st_mtime + 10
+        assert reprobed['version'] == registry['version']
+        assert app.get_calibre_registry() is reprobed
+    finally:
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+    assert app.get_calibre_registry()['mtime'] == stat.st_mtime
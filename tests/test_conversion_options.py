@@ -0,0 +1,113 @@
+import io
+import logging
+import uuid
+
+import pytest
+
+import app
+
+
+def test_registry_records_input_options_per_format(app_module):
+    registry = app.get_calibre_registry()
+    txt = {option['name'] for option in registry['input_options']['txt']}
+    assert {'input_encoding', 'formatting_type'} <= txt
+    assert 'formatting_type' not in {option['name'] for option in registry['input_options']['pdf']}
+    # 输出格式的选项中不包含探测时使用的EPUB输入插件的选项
+    assert 'input_encoding' not in {option['name'] for option in registry['format_options']['epub']}
+
+
+@pytest.mark.parametrize('input_format, output_format, expected', [
+    ('txt', 'epub', {'input_encoding', 'formatting_type', 'epub_version'}),
+    ('pdf', 'epub', {'input_encoding', 'epub_version'}),
+    ('txt', 'pdf', {'input_encoding', 'formatting_type', 'paper_size'}),
+])
+def test_filter_by_format_pair(app_module, input_format, output_format, expected):
+    options = {'input_encoding': 'gbk', 'formatting_type': 'markdown', 'epub_version': '3',
+               'paper_size': 'a4', 'bogus': 'x', 'Bad-Key': 'x'}
+    filtered = app.filter_conversion_options(options, input_format, output_format)
+    # 纸张大小等输出选项在假的ebook-convert中对所有输出格式都可用
+    assert expected <= set(filtered)
+    assert 'bogus' not in filtered and 'Bad-Key' not in filtered
+    assert all(filtered[key] == options[key] for key in filtered)
+
+
+def test_options_route_includes_input_options(client):
+    names = {option['name'] for option in client.get('/options/epub').get_json()['calibre_options']}
+    assert 'input_encoding' not in names
+    names = {option['name'] for option in client.get('/options/epub?input_format=txt').get_json()['calibre_options']}
+    assert {'input_encoding', 'formatting_type', 'epub_version'} <= names
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    """通过阶段钩子记录每个文件经过的阶段和生成的命令"""
+    calls = []
+    monkeypatch.setattr(app, 'CONVERSION_STAGE_HOOKS', [lambda stage, ctx, seconds: calls.append((stage, dict(ctx)))])
+    return calls
+
+
+def content(name):
+    data = f'{name} {uuid.uuid4()}\n'.encode()
+    if name.endswith('.pdf'):
+        data = b'%PDF-1.4\n1 0 obj\n<<>>\nendobj\n' + data + b'trailer\n%%EOF\n'
+    return data
+
+
+def advanced(client, files, output_formats, **options):
+    data = {'output_formats': ','.join(output_formats), **options,
+            'files[]': [(io.BytesIO(content(name)), name) for name in files]}
+    response = client.post('/advanced-conversion', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202, response.get_json()
+    return response.get_json()
+
+
+def commands(stages):
+    return {ctx['original_filename']: ctx['cmd'] for stage, ctx in stages if stage == 'prepare' and 'cmd' in ctx}
+
+
+def test_advanced_conversion_passes_input_options(client, wait_for, stages, caplog):
+    caplog.set_level(logging.WARNING, logger='app')
+    job = advanced(client, ['novel.txt', 'scan.pdf'], ['epub'],
+                   input_encoding='gbk', formatting_type='markdown', epub_version='3', bogus='x')
+    assert wait_for(job, ('completed', 'failed'))['status'] == 'completed'
+
+    cmds = commands(stages)
+    assert '--input-encoding=gbk' in cmds['novel.txt']
+    assert '--formatting-type=markdown' in cmds['novel.txt']
+    assert '--epub-version=3' in cmds['novel.txt']
+    assert '--input-encoding=gbk' in cmds['scan.pdf']
+    assert not any(arg.startswith('--formatting-type') for arg in cmds['scan.pdf'])
+    assert not any(arg.startswith('--bogus') for cmd in cmds.values() for arg in cmd)
+
+    # 每个文件都经过全部阶段，钩子按阶段顺序调用
+    for name in ('novel.txt', 'scan.pdf'):
+        assert [stage for stage, ctx in stages if ctx['original_filename'] == name] == list(app.ConversionPipeline.STAGES)
+
+    # 被忽略的选项每个批次只记录一次
+    warnings = [r.getMessage() for r in caplog.records if '忽略不支持的转换选项' in r.getMessage()]
+    assert warnings == ['忽略不支持的转换选项: bogus']
+
+
+def test_input_options_apply_to_intermediate_conversion(client, wait_for, stages, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'FANOUT_INTERMEDIATE', 'epub')
+    job = advanced(client, ['fanout.txt'], ['pdf', 'mobi'], input_encoding='gbk', paper_size='a4')
+    assert wait_for(job, ('completed', 'failed'))['status'] == 'completed'
+
+    prepared = [ctx for stage, ctx in stages if stage == 'prepare' and 'cmd' in ctx]
+    by_output = {ctx['cmd'][2].rsplit('.', 1)[-1]: ctx['cmd'] for ctx in prepared}
+    assert set(by_output) == {'epub', 'pdf', 'mobi'}
+    # 输入选项只在原始文件转换为中间格式时传入，输出选项只在生成最终格式时传入
+    assert '--input-encoding=gbk' in by_output['epub']
+    assert '--paper-size=a4' not in by_output['epub']
+    assert '--paper-size=a4' in by_output['pdf']
+    assert '--input-encoding=gbk' not in by_output['pdf']
+
+
+def test_failing_hook_does_not_fail_conversion(client, upload, wait_for, monkeypatch):
+    def broken(stage, ctx, seconds):
+        raise RuntimeError('hook failure')
+    monkeypatch.setattr(app, 'CONVERSION_STAGE_HOOKS', [broken])
+    job = upload('hooked.txt')
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+    assert status['files'][0]['status'] == 'success'
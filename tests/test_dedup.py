@@ -0,0 +1,51 @@
+import io
+import os
+import uuid
+
+import app
+
+
+def pipeline():
+    return app.ConversionPipeline(uuid.uuid4().hex, 'epub')
+
+
+def test_group_duplicates_by_content_and_format(app_module):
+    files = [
+        {'filename': 'a.txt', 'path': '/u/1.txt', 'sha256': 'same'},
+        {'filename': 'b.txt', 'path': '/u/2.txt', 'sha256': 'same'},
+        {'filename': 'c.html', 'path': '/u/3.html', 'sha256': 'same'},
+        {'filename': 'd.txt', 'path': '/u/4.txt', 'sha256': 'other'},
+        {'filename': 'e.txt', 'path': '/u/5.txt'},
+        {'filename': 'f.txt', 'path': '/u/6.txt'},
+        # 由不同原始格式生成的中间结果不能互相复用
+        {'filename': 'g.txt', 'path': '/u/7.txt', 'sha256': 'same', 'source_format': 'docx'},
+    ]
+    p = pipeline()
+    tasks = p.plan(files)
+    unique = p.group_duplicates(tasks)
+    assert [ctx['original_filename'] for ctx in unique] == ['a.txt', 'c.html', 'd.txt', 'e.txt', 'f.txt', 'g.txt']
+    assert [d['original_filename'] for d in unique[0]['duplicates']] == ['b.txt']
+    assert all(ctx['duplicates'] == [] for ctx in unique[1:])
+
+
+def test_duplicate_files_converted_once(client, wait_for, monkeypatch):
+    runs = []
+    monkeypatch.setattr(app, 'CONVERSION_STAGE_HOOKS',
+                        [lambda stage, ctx, seconds: stage == 'run' and runs.append(ctx['original_filename'])])
+    # 关闭转换缓存，确认复用来自批次内的去重
+    monkeypatch.setitem(app.app.config, 'CONVERSION_CACHE_MAX_BYTES', 0)
+    data = f'duplicate {uuid.uuid4()}'.encode()
+    files = [(io.BytesIO(data), 'first.txt'), (io.BytesIO(data), 'second.txt'),
+             (io.BytesIO(data + b'!'), 'third.txt')]
+    response = client.post('/upload', data={'output_format': 'epub', 'files[]': files},
+                           content_type='multipart/form-data')
+    assert response.status_code == 202
+    job = response.get_json()
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+    assert [f['status'] for f in status['files']] == ['success'] * 3
+    assert sorted(runs) == ['first.txt', 'third.txt']
+
+    paths = [f['converted_path'] for f in app.load_batch_files(job['batch_id'])]
+    assert os.path.samefile(paths[0], paths[1])
+    assert not os.path.samefile(paths[0], paths[2])
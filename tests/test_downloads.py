@@ -0,0 +1,86 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def converted(client, upload, wait_for):
+    job = upload('ranged.txt')
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+    url = status['files'][0]['download_url']
+    full = client.get(url, buffered=True)
+    assert full.status_code == 200
+    return url, full
+
+
+def test_full_download_headers(converted):
+    url, full = converted
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    assert full.headers['ETag']
+    assert 'attachment' in full.headers['Content-Disposition']
+    assert int(full.headers['Content-Length']) == len(full.data) > 0
+
+
+def test_range_request(client, converted):
+    url, full = converted
+    response = client.get(url, headers={'Range': 'bytes=2-9'})
+    assert response.status_code == 206
+    assert response.data == full.data[2:10]
+    assert response.headers['Content-Range'] == f'bytes 2-9/{len(full.data)}'
+
+    response = client.get(url, headers={'Range': 'bytes=-4'})
+    assert response.status_code == 206
+    assert response.data == full.data[-4:]
+
+    response = client.get(url, headers={'Range': f'bytes={len(full.data) + 10}-'})
+    assert response.status_code == 416
+
+
+def test_etag_conditional_requests(client, converted):
+    url, full = converted
+    etag = full.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    # If-Range与当前版本一致时按Range返回，不一致时返回完整文件
+    response = client.get(url, headers={'Range': 'bytes=0-3', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == full.data[:4]
+    response = client.get(url, headers={'Range': 'bytes=0-3', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == full.data
+
+
+@pytest.mark.parametrize('headers', [{}, {'Range': 'bytes=0-3'}, {'If-None-Match': '*'}])
+def test_download_marks_batch_downloaded(client, converted, monkeypatch, headers):
+    url, _ = converted
+    batch_id = url.split('/')[2]
+    calls = []
+    monkeypatch.setattr(app, 'mark_batch_downloaded', calls.append)
+    # 下载状态在响应关闭时更新，send_file的响应体由服务器直接关闭
+    client.get(url, headers=headers, buffered=True)
+    assert calls == [batch_id]
+
+
+def test_download_extends_retention(converted):
+    url, _ = converted
+    # fixture中的完整下载已经关闭
+    assert app.load_batch(url.split('/')[2])['state'] == 'downloaded'
+
+
+def test_missing_file(client, converted):
+    url, _ = converted
+    assert client.get(url.rsplit('/', 1)[0] + '/5').status_code == 404
+    assert client.get('/download/does-not-exist/files/0').status_code == 404
+
+
+def test_sendfile_headers(client, converted, monkeypatch):
+    url, _ = converted
+    monkeypatch.setitem(app.app.config, 'SENDFILE_MODE', 'x-accel-redirect')
+    calls = []
+    monkeypatch.setattr(app, 'mark_batch_downloaded', calls.append)
+    response = client.get(url, buffered=True)
+    assert response.status_code == 200
+    assert response.data == b''
+    assert calls == [url.split('/')[2]]
+    assert response.headers['X-Accel-Redirect'].startswith(app.app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/') + '/converted/')
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+
+
+def test_upload_convert_and_fetch_result(client, upload, wait_for):
+    job = upload('a.txt', 'b.txt')
+    assert job['status'] in ('queued', 'running')
+    assert job['progress_url'].endswith(job['batch_id'])
+
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+    assert status['succeeded'] == 2
+    assert all(f['download_url'] for f in status['files'])
+
+    result = client.get(job['result_url'])
+    assert result.status_code == 200
+    assert [f['status'] for f in result.get_json()['files']] == ['success', 'success']
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/does-not-exist').status_code == 404
+    assert client.delete('/jobs/does-not-exist').status_code == 404
+    assert client.get('/jobs/does-not-exist/result').status_code == 404
+
+
+def test_cancel_running_job(client, monkeypatch, upload, wait_for):
+    monkeypatch.setenv('FAKE_CALIBRE_LATENCY', '30')
+    job = upload('slow.txt')
+    wait_for(job, ('running',))
+
+    response = client.delete(f"/jobs/{job['batch_id']}")
+    assert response.status_code == 202
+
+    # 运行中的批次在转换进程结束后才进入cancelled状态
+    status = wait_for(job, ('cancelled',))
+    assert status['status'] == 'cancelled'
+    result = client.get(job['result_url'])
+    assert result.status_code == 409
+    assert result.get_json()['status'] == 'cancelled'
+    # 已结束的批次不能再次取消
+    assert client.delete(f"/jobs/{job['batch_id']}").status_code == 409
+
+
+def test_result_pending_while_running(client, monkeypatch, upload, wait_for):
+    monkeypatch.setenv('FAKE_CALIBRE_LATENCY', '30')
+    job = upload('pending.txt')
+    try:
+        wait_for(job, ('running',))
+        result = client.get(job['result_url'])
+        assert result.status_code == 202
+        assert result.get_json()['status'] == 'running'
+    finally:
+        client.delete(f"/jobs/{job['batch_id']}")
+
+
+def test_polling_client_keeps_job_alive(client, app_module, monkeypatch, upload, wait_for):
+    monkeypatch.setenv('FAKE_CALIBRE_LATENCY', '30')
+    monkeypatch.setitem(app_module.app.config, 'DISCONNECT_CANCEL_SECONDS', 30)
+    job = upload('polled.txt')
+    try:
+        wait_for(job, ('running',))
+        # 进度推送已断开，但客户端刚刚轮询过状态
+        app_module._cancel_if_abandoned(job['batch_id'])
+        assert client.get(job['status_url']).get_json()['status'] == 'running'
+
+        app_module.get_job(job['batch_id'])['last_seen'] -= 60
+        app_module._cancel_if_abandoned(job['batch_id'])
+        assert app_module.get_job(job['batch_id'])['cancelled']
+    finally:
+        client.delete(f"/jobs/{job['batch_id']}")
+
+
+SHARED_QUEUE_SCRIPT = """
+import io, sys
+sys.path.insert(0, {root!r})
+import app
+client = app.app.test_client()
+response = client.post('/upload', data={{'output_format': 'epub', 'files[]': [(io.BytesIO(b'shared'), 'a.txt')]}},
+                       content_type='multipart/form-data')
+assert response.status_code == 202, response.get_json()
+assert response.get_json()['estimated_wait_seconds'] is None
+assert client.get(response.get_json()['status_url']).get_json()['status'] == 'queued'
+assert client.get('/metrics').status_code == 200
+assert app._conversion_scheduler is None
+assert not app._job_runner_threads
+"""
+
+
+def test_shared_queue_web_process_does_not_convert(tmp_path, project_root):
+    # 全局的批次队列在首次使用时创建，需要在单独的进程中切换到共享队列
+    env = dict(os.environ, BOOKFORGE_CONVERSION_BROKER='sqlite', BOOKFORGE_DATA_DIR=str(tmp_path))
+    subprocess.run([sys.executable, '-c', SHARED_QUEUE_SCRIPT.format(root=project_root)], env=env, check=True,
+                   stdout=subprocess.DEVNULL, timeout=60)
+
+
+def test_progress_streams_are_capped(client, app_module, monkeypatch, upload):
+    monkeypatch.setenv('FAKE_CALIBRE_LATENCY', '30')
+    monkeypatch.setitem(app_module.app.config, 'SSE_MAX_STREAMS', 1)
+    monkeypatch.setitem(app_module.app.config, 'DISCONNECT_CANCEL_SECONDS', 0)
+    job = upload('streamed.txt')
+    try:
+        stream = client.get(job['progress_url'], buffered=False)
+        assert stream.status_code == 200
+        assert next(stream.response).startswith(b'retry:')
+
+        rejected = client.get(job['progress_url'])
+        assert rejected.status_code == 503
+        assert rejected.headers['Retry-After']
+        assert rejected.get_json()['status_url'] == job['status_url']
+
+        stream.close()
+        reopened = client.get(job['progress_url'], buffered=False)
+        assert reopened.status_code == 200
+        reopened.close()
+        assert app_module._sse_streams == 0
+    finally:
+        client.delete(f"/jobs/{job['batch_id']}")
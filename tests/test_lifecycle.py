@@ -0,0 +1,71 @@
+import time
+import uuid
+
+import pytest
+
+import app
+
+
+def take_due(now):
+    with app._batches_cond:
+        return dict(app._take_due_batches(now))
+
+
+def test_clean_zip_keeps_download_retention(client, upload, wait_for, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'ZIP_MODE', 'file')
+    job = upload('retained.txt')
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+    batch_id = job['batch_id']
+    assert app.load_batch(batch_id)['zip_bytes'] > 0
+
+    response = client.get(status['download_url'], buffered=True)
+    assert response.status_code == 200
+    batch = app.load_batch(batch_id)
+    assert batch['state'] == 'downloaded'
+    expires_at = batch['expires_at']
+    assert expires_at == pytest.approx(time.time() + app.app.config['DOWNLOADED_RETENTION_SECONDS'], abs=30)
+
+    # 清理ZIP只改变占用空间，不能把下载后的保留时间顺延回批次保留时间
+    assert client.post(f'/clean-zip/{batch_id}').status_code == 200
+    batch = app.load_batch(batch_id)
+    assert batch['zip_bytes'] == 0
+    assert batch['expires_at'] == expires_at
+    assert app.BATCHES[batch_id]['expires_at'] == expires_at
+
+    assert batch_id not in take_due(expires_at - 1)
+    assert take_due(expires_at + 1)[batch_id] == 'expired'
+    app.remove_batch_files(batch_id)
+    assert app.load_batch(batch_id)['state'] == 'removed'
+
+
+def test_size_update_keeps_expiry():
+    batch_id = uuid.uuid4().hex
+    expires_at = time.time() + 600
+    app.register_batch(batch_id, state='converted', expires_at=expires_at, converted_bytes=10)
+    app.update_batch(batch_id, converted_bytes=5)
+    assert app.load_batch(batch_id)['expires_at'] == expires_at
+
+    app.update_batch(batch_id, state='downloaded', retention=60)
+    assert app.load_batch(batch_id)['expires_at'] == pytest.approx(time.time() + 60, abs=5)
+    app.remove_batch_files(batch_id)
+
+
+def test_quota_evicts_oldest_finished_batch(monkeypatch):
+    now = time.time()
+    old, new, active = (uuid.uuid4().hex for _ in range(3))
+    app.register_batch(old, state='converted', expires_at=now + 600, converted_bytes=100)
+    app.register_batch(new, state='converted', expires_at=now + 1200, converted_bytes=100)
+    app.register_batch(active, state='running', expires_at=now + 300, upload_bytes=100)
+    with app._batches_cond:
+        others = sum(app._batch_bytes(b) for key, b in app.BATCHES.items() if key not in (old, new, active))
+    # 配额只够保留一个已完成的批次，转换中的批次不能被淘汰
+    monkeypatch.setitem(app.app.config, 'BATCH_DISK_QUOTA_BYTES', others + 200)
+
+    due = take_due(now)
+    assert due.get(old) == 'quota'
+    assert new not in due and active not in due
+    for batch_id in due:
+        app.remove_batch_files(batch_id)
+    for batch_id in (new, active):
+        app.remove_batch_files(batch_id)
@@ -0,0 +1,47 @@
+import re
+
+import app
+
+# Prometheus文本格式的样本行：指标名、可选的标签和数值
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*",?)*\})? (\S+)$')
+
+
+def test_format_labels_escapes_values():
+    assert app._format_labels([]) == ''
+    assert app._format_labels([('stage', 'run'), ('le', 0.5)]) == '{stage="run",le="0.5"}'
+    assert app._format_labels([('name', 'a"b\\c\nd')]) == '{name="a\\"b\\\\c\\nd"}'
+
+
+def test_metrics_after_conversion(client, upload, wait_for, monkeypatch):
+    monkeypatch.setattr(app, '_counters', dict(app._counters))
+    job = upload('metrics.txt')
+    assert wait_for(job, ('completed', 'failed'))['status'] == 'completed'
+    app.increment_counter('bookforge_test_events_total', client='say "hi"\\now')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.get_data(as_text=True).splitlines()
+    samples = {}
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        match = SAMPLE_RE.match(line)
+        assert match, line
+        float(match.group(3))
+        samples[match.group(1) + (match.group(2) or '')] = float(match.group(3))
+
+    assert '# TYPE bookforge_stage_duration_seconds histogram' in lines
+    labels = '{stage="calibre_run",input_format="txt",output_format="epub",size_bucket="lt_1mb"'
+    inf = samples[f'bookforge_stage_duration_seconds_bucket{labels},le="+Inf"}}']
+    assert inf >= 1
+    assert samples[f'bookforge_stage_duration_seconds_count{labels}}}'] == inf
+    buckets = [value for key, value in samples.items()
+               if key.startswith(f'bookforge_stage_duration_seconds_bucket{labels}')]
+    assert buckets == sorted(buckets)
+
+    assert samples['bookforge_test_events_total{client="say \\"hi\\"\\\\now"}'] == 1
+    assert '# TYPE bookforge_test_events_total counter' in lines
+    for gauge in ('bookforge_job_queue_depth', 'bookforge_conversion_workers', 'bookforge_disk_free_bytes'):
+        assert f'# TYPE {gauge} gauge' in lines
+        assert gauge in samples
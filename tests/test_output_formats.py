@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('values, expected', [
+    (['epub'], ['epub']),
+    (['EPUB', ' pdf '], ['epub', 'pdf']),
+    (['epub,pdf', 'mobi'], ['epub', 'pdf', 'mobi']),
+    (['epub', 'epub,EPUB'], ['epub']),
+    (['pdf,,epub,'], ['pdf', 'epub']),
+    ([], None),
+    ([''], None),
+    ([None], None),
+    (['epub', 'exe'], None),
+    (['epub,doc'], None),
+])
+def test_parse_output_formats(values, expected):
+    assert app.parse_output_formats(values) == expected
+
+
+def test_upload_to_several_formats(upload, wait_for):
+    job = upload('multi.txt', output_format='epub,pdf')
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['output_formats'] == ['epub', 'pdf']
+    assert [(f['output_format'], f['status']) for f in status['files']] == [('epub', 'success'), ('pdf', 'success')]
+
+
+def test_upload_rejects_unknown_format(client):
+    response = client.post('/upload', data={'output_format': 'epub,exe', 'files[]': [(io.BytesIO(b'x'), 'a.txt')]},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '无效的输出格式'
@@ -0,0 +1,89 @@
+import zipfile
+
+import pytest
+
+import app
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_sniff_pdf(tmp_path):
+    path = write(tmp_path, 'a.pdf', b'%PDF-1.4\n1 0 obj\n<<>>\nendobj\ntrailer\n%%EOF\n')
+    assert app.sniff_format(path) == 'pdf'
+
+
+def test_sniff_truncated_pdf(tmp_path):
+    path = write(tmp_path, 'a.pdf', b'%PDF-1.4\n1 0 obj\n<<>>\n' + b'x' * 2048)
+    with pytest.raises(app.PreflightError):
+        app.sniff_format(path)
+
+
+def test_text_mentioning_pdf_marker_is_text(tmp_path):
+    path = write(tmp_path, 'notes.txt', '说明：输出文件以 %PDF-1.4 开头\n'.encode('utf-8') * 3)
+    assert app.sniff_format(path, 'txt') == 'txt'
+    assert app.preflight_format('txt', app.sniff_format(path, 'txt')) == 'txt'
+
+
+def test_html_mentioning_pdf_marker_is_html(tmp_path):
+    path = write(tmp_path, 'a.html', b'<!DOCTYPE html><html><body><pre>%PDF-1.7</pre></body></html>')
+    assert app.sniff_format(path, 'html') == 'html'
+
+
+def test_declared_pdf_tolerates_leading_garbage(tmp_path):
+    path = write(tmp_path, 'a.pdf', b'\x00\x00junk\n%PDF-1.4\n%%EOF\n')
+    assert app.sniff_format(path, 'pdf') == 'pdf'
+    assert app.sniff_format(path) == 'binary'
+
+
+def test_sniff_zip_containers(tmp_path):
+    path = str(tmp_path / 'book.epub')
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip')
+        zf.writestr('META-INF/container.xml', '<container/>')
+    assert app.sniff_format(path) == 'epub'
+
+    path = str(tmp_path / 'doc.docx')
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('word/document.xml', '<w:document/>')
+    assert app.sniff_format(path) == 'docx'
+
+
+def test_truncated_zip_is_rejected(tmp_path):
+    path = str(tmp_path / 'book.epub')
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip')
+        zf.writestr('OEBPS/content.opf', 'x' * 4096)
+    data = open(path, 'rb').read()
+    path = write(tmp_path, 'cut.epub', data[:len(data) // 2])
+    with pytest.raises(app.PreflightError):
+        app.sniff_format(path)
+
+
+def test_empty_file_is_rejected(tmp_path):
+    with pytest.raises(app.PreflightError):
+        app.sniff_format(write(tmp_path, 'empty.txt', b''))
+
+
+@pytest.mark.parametrize('declared, detected, expected', [
+    ('epub', 'epub', 'epub'),
+    ('mobi', 'prc', 'mobi'),
+    ('txt', 'html', 'txt'),
+    ('txt', 'binary', 'txt'),
+    ('mobi', 'epub', 'epub'),
+])
+def test_preflight_format(declared, detected, expected):
+    assert app.preflight_format(declared, detected) == expected
+
+
+@pytest.mark.parametrize('declared, detected', [
+    ('epub', 'txt'),
+    ('pdf', 'binary'),
+    ('epub', 'zip'),
+])
+def test_preflight_format_mismatch(declared, detected):
+    with pytest.raises(app.PreflightError):
+        app.preflight_format(declared, detected)
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+resource = pytest.importorskip('resource')
+pytestmark = pytest.mark.skipif(not hasattr(resource, 'prlimit'), reason='需要resource.prlimit')
+
+
+@pytest.mark.parametrize('setting, prefix', [
+    ('best-effort:7', ['/usr/bin/ionice', '-c', '2', '-n', '7']),
+    ('best-effort', ['/usr/bin/ionice', '-c', '2']),
+    ('idle', ['/usr/bin/ionice', '-c', '3']),
+    ('idle:7', ['/usr/bin/ionice', '-c', '3']),
+    ('', []),
+    ('realtime:0', []),
+])
+def test_sandboxed_command(monkeypatch, setting, prefix):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_IONICE', setting)
+    monkeypatch.setattr(app.shutil, 'which', lambda name: '/usr/bin/ionice')
+    assert app.sandboxed_command(['ebook-convert', 'a.txt', 'a.epub']) == prefix + ['ebook-convert', 'a.txt', 'a.epub']
+
+
+def test_sandboxed_command_without_ionice(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_IONICE', 'idle')
+    monkeypatch.setattr(app.shutil, 'which', lambda name: None)
+    assert app.sandboxed_command(['ebook-convert']) == ['ebook-convert']
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_MAX_MEMORY_BYTES', 4096 * 1024 * 1024)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_MAX_CPU_SECONDS', 30)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_MAX_OPEN_FILES', 64)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_NICE', 5)
+
+
+@pytest.fixture
+def child():
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    yield process
+    process.kill()
+    process.wait()
+
+
+def capped(soft, hard, which):
+    """普通用户的硬限制不能调高，期望值按当前的硬限制截断"""
+    current_hard = resource.getrlimit(which)[1]
+    if current_hard == resource.RLIM_INFINITY:
+        return soft, hard
+    return min(soft, current_hard), min(hard, current_hard)
+
+
+def test_apply_process_limits(limits, child):
+    app.apply_process_limits(child.pid)
+    assert resource.prlimit(child.pid, resource.RLIMIT_NOFILE) == capped(64, 64, resource.RLIMIT_NOFILE)
+    assert resource.prlimit(child.pid, resource.RLIMIT_CPU) == capped(30, 35, resource.RLIMIT_CPU)
+    assert resource.prlimit(child.pid, resource.RLIMIT_AS) == capped(4096 * 1024 * 1024, 4096 * 1024 * 1024,
+                                                                     resource.RLIMIT_AS)
+    assert os.getpriority(os.PRIO_PROCESS, child.pid) == min(19, os.getpriority(os.PRIO_PROCESS, 0) + 5)
+
+
+def test_warm_worker_keeps_cpu_unlimited(limits, child):
+    before = resource.prlimit(child.pid, resource.RLIMIT_CPU)
+    app.apply_process_limits(child.pid, limit_cpu=False)
+    assert resource.prlimit(child.pid, resource.RLIMIT_CPU) == before
+    assert resource.prlimit(child.pid, resource.RLIMIT_NOFILE) == capped(64, 64, resource.RLIMIT_NOFILE)
+
+
+def test_exited_process_does_not_raise(limits):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    app.apply_process_limits(process.pid)
+
+
+def test_oneshot_runs_with_limits_and_reports_usage(limits, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_IONICE', '')
+    script = ('import os, resource, time; time.sleep(0.5); '
+              'print(resource.getrlimit(resource.RLIMIT_NOFILE)[0], os.getpriority(os.PRIO_PROCESS, 0))')
+    result = app._run_oneshot([sys.executable, '-c', script], timeout=30)
+    assert result.returncode == 0
+    nofile, nice = map(int, result.stdout.split())
+    assert nofile == capped(64, 64, resource.RLIMIT_NOFILE)[0]
+    assert nice == min(19, os.getpriority(os.PRIO_PROCESS, 0) + 5)
+    assert result.usage['cpu_seconds'] >= 0
+    assert result.usage['peak_rss_bytes'] > 0
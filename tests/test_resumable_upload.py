@@ -0,0 +1,106 @@
+import os
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('ranges, start, end, expected', [
+    ([], 0, 10, [[0, 10]]),
+    ([[0, 10]], 10, 20, [[0, 20]]),
+    ([[0, 10]], 20, 30, [[0, 10], [20, 30]]),
+    ([[20, 30]], 0, 10, [[0, 10], [20, 30]]),
+    ([[0, 10], [20, 30]], 10, 20, [[0, 30]]),
+    ([[0, 10], [20, 30]], 5, 25, [[0, 30]]),
+    ([[0, 30]], 5, 10, [[0, 30]]),
+])
+def test_merge_range(ranges, start, end, expected):
+    assert app._merge_range(ranges, start, end) == expected
+
+
+def init(client, files, **payload):
+    return client.post('/uploads/init', json={'output_format': 'epub', 'files': files, **payload})
+
+
+@pytest.mark.parametrize('files', [
+    ['book.txt'],
+    [{'name': 'book.txt', 'size': 3}, 42],
+    {'name': 'book.txt', 'size': 3},
+    [{'name': 'book.txt', 'size': 'big'}],
+    [{'name': 'book.txt', 'size': -1}],
+    [{'name': 'book.txt'}],
+])
+def test_init_rejects_invalid_files(client, files):
+    response = init(client, files)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == '文件大小无效'
+
+
+def test_init_rejects_non_object_payload(client):
+    response = client.post('/uploads/init', json=[{'name': 'book.txt', 'size': 3}])
+    assert response.status_code == 400
+
+
+def test_init_ignores_non_object_options(client):
+    response = init(client, [{'name': 'book.txt', 'size': 3}], advanced=True, options=['x'])
+    assert response.status_code == 201
+
+
+def test_chunks_in_any_order(client):
+    data = f'resumable {uuid.uuid4()} '.encode() * 40
+    session = init(client, [{'name': 'book.txt', 'size': len(data)}]).get_json()
+    upload_file = session['files'][0]
+    assert upload_file['received'] == 0
+    url = f"/uploads/{session['batch_id']}/files/{upload_file['file_id']}"
+
+    assert client.put(f'{url}?offset=600', data=data[600:]).status_code == 200
+    # 重传与已接收区间重叠的分块不会重复计数
+    response = client.put(f'{url}?offset=500', data=data[500:800])
+    assert response.get_json()['received'] == len(data) - 500
+
+    status = client.get(f"/uploads/{session['batch_id']}").get_json()
+    assert status['files'][0]['ranges'] == [[500, len(data)]]
+    finalize = client.post(f"/uploads/{session['batch_id']}/finalize")
+    assert finalize.status_code == 409
+    assert finalize.get_json()['incomplete'] == ['book.txt']
+
+    assert client.put(f'{url}?offset=0', data=data[:500]).get_json()['received'] == len(data)
+    finalize = client.post(f"/uploads/{session['batch_id']}/finalize")
+    assert finalize.status_code == 202
+    with open(app.get_job(session['batch_id'])['input_files'][0]['path'], 'rb') as f:
+        assert f.read() == data
+
+
+def test_chunk_validation(client):
+    session = init(client, [{'name': 'book.txt', 'size': 10}]).get_json()
+    url = f"/uploads/{session['batch_id']}/files/{session['files'][0]['file_id']}"
+    assert client.put(f'{url}?offset=5', data=b'x' * 6).status_code == 416
+    assert client.put(url, data=b'x').status_code == 400
+    assert client.put(f"/uploads/{session['batch_id']}/files/missing?offset=0", data=b'x').status_code == 404
+
+
+def test_stale_session_is_removed(client, monkeypatch):
+    stale = init(client, [{'name': 'book.txt', 'size': 10}]).get_json()
+    batch_id = stale['batch_id']
+    path = app.UPLOAD_SESSIONS[batch_id]['files'][0]['path']
+    assert batch_id in app._reservations
+
+    app.UPLOAD_SESSIONS[batch_id]['updated_at'] -= app.app.config['JOB_RETENTION_SECONDS'] + 1
+    assert init(client, [{'name': 'other.txt', 'size': 10}]).status_code == 201
+
+    assert batch_id not in app.UPLOAD_SESSIONS
+    assert batch_id not in app._reservations
+    assert not os.path.exists(path)
+    assert app.load_batch(batch_id)['state'] == 'removed'
+    url = f"/uploads/{batch_id}/files/{stale['files'][0]['file_id']}?offset=0"
+    assert client.put(url, data=b'x').status_code == 404
+
+
+def test_chunk_after_batch_files_reaped(client):
+    session = init(client, [{'name': 'book.txt', 'size': 10}]).get_json()
+    # 批次到期后由后台清理线程删除文件，会话仍在
+    app.remove_batch_files(session['batch_id'])
+    url = f"/uploads/{session['batch_id']}/files/{session['files'][0]['file_id']}?offset=0"
+    assert client.put(url, data=b'x' * 10).status_code == 410
+    assert client.get(f"/uploads/{session['batch_id']}").status_code == 404
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+import app
+
+
+def run_queued(scheduler, tasks):
+    """先用一个阻塞任务占住唯一的转换线程，再一次性提交全部任务，返回实际执行顺序"""
+    gate = threading.Event()
+    order = []
+    blocker = scheduler.submit('ip:gate', 0, gate.wait)
+    futures = [scheduler.submit(client, size, lambda name=name: order.append(name))
+               for client, size, name in tasks]
+    gate.set()
+    blocker.result(timeout=5)
+    for future in futures:
+        future.result(timeout=5)
+    return order
+
+
+def test_clients_take_turns():
+    scheduler = app._FairScheduler(1)
+    tasks = [('ip:a', 0, f'a{i}') for i in range(3)] + [('ip:b', 0, f'b{i}') for i in range(3)]
+    assert run_queued(scheduler, tasks) == ['a0', 'b0', 'a1', 'b1', 'a2', 'b2']
+
+
+def test_small_files_first_within_client():
+    scheduler = app._FairScheduler(1)
+    tasks = [('ip:a', 300, 'large'), ('ip:a', 10, 'small'), ('ip:a', 100, 'medium')]
+    assert run_queued(scheduler, tasks) == ['small', 'medium', 'large']
+
+
+def test_weighted_client_gets_more_turns(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CLIENT_WEIGHTS', {'heavy': 2.0})
+    scheduler = app._FairScheduler(1)
+    tasks = [('key:heavy', 0, 'heavy')] * 6 + [('ip:light', 0, 'light')] * 6
+    order = run_queued(scheduler, tasks)
+    assert order[:6].count('heavy') == 4
+    assert order.count('light') == 6
+
+
+def test_task_exception_is_returned():
+    scheduler = app._FairScheduler(1)
+    future = scheduler.submit('ip:a', 0, lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result(timeout=5)
+    assert scheduler.submit('ip:a', 0, lambda: 'ok').result(timeout=5) == 'ok'
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({}, 'ip:10.0.0.1'),
+    ({'X-API-Key': 'issued'}, 'key:issued'),
+    # 服务端没有签发的密钥按IP调度
+    ({'X-API-Key': 'forged'}, 'ip:10.0.0.1'),
+    ({'X-API-Key': '10.0.0.2'}, 'ip:10.0.0.1'),
+])
+def test_scheduling_client(monkeypatch, headers, expected):
+    monkeypatch.setitem(app.app.config, 'API_KEYS', {'issued'})
+    with app.app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert app.scheduling_client() == expected
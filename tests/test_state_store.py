@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+import sys
+
+# 第一个进程：完成一个批次，让一个批次到期，留下一个未完成的上传会话，然后在转换过程中直接退出
+BEFORE_RESTART = """
+import io, json, os, sys, time
+sys.path.insert(0, {root!r})
+import app
+client = app.app.test_client()
+
+def upload(name):
+    response = client.post('/upload', data={{'output_format': 'epub', 'files[]': [(io.BytesIO(name.encode()), name)]}},
+                           content_type='multipart/form-data')
+    assert response.status_code == 202, response.get_json()
+    return response.get_json()['batch_id']
+
+def wait_for(batch_id, statuses):
+    deadline = time.time() + 20
+    while client.get(f'/jobs/{{batch_id}}').get_json()['status'] not in statuses:
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+ids = {{'completed': upload('kept.txt'), 'expired': upload('expired.txt')}}
+for batch_id in ids.values():
+    wait_for(batch_id, ('completed',))
+app.store_batch(ids['expired'], expires_at=time.time() - 1)
+response = client.post('/uploads/init', json={{'output_format': 'epub', 'files': [{{'name': 'a.txt', 'size': 3}}]}})
+ids['uploading'] = response.get_json()['batch_id']
+os.environ['FAKE_CALIBRE_LATENCY'] = '2'
+ids['interrupted'] = upload('interrupted.txt')
+wait_for(ids['interrupted'], ('running',))
+with open({ids_path!r}, 'w') as f:
+    json.dump(ids, f)
+os._exit(0)
+"""
+
+# 第二个进程：启动检查从状态存储中恢复批次
+AFTER_RESTART = """
+import json, os, sys
+sys.path.insert(0, {root!r})
+import app
+with open({ids_path!r}) as f:
+    ids = json.load(f)
+app.run_startup_checks()
+client = app.app.test_client()
+
+job = client.get(f"/jobs/{{ids['completed']}}").get_json()
+assert job['status'] == 'completed', job
+assert [f['status'] for f in job['files']] == ['success']
+assert app.BATCHES[ids['completed']]['state'] == 'converted'
+assert client.get(f"/download/{{ids['completed']}}/files/0", buffered=True).status_code == 200
+
+interrupted = client.get(f"/jobs/{{ids['interrupted']}}").get_json()
+assert interrupted['status'] == 'failed', interrupted
+assert interrupted['error'] == '服务重启，转换中断'
+assert [f['status'] for f in interrupted['files']] == ['failed']
+assert app.load_batch(ids['interrupted'])['state'] == 'failed'
+
+# 没有收到任何分块的上传会话无法继续，清理空的批次目录，记录不能被当作遗留批次覆盖
+assert app.load_batch(ids['uploading'])['state'] == 'removed'
+assert not os.path.exists(os.path.join(app.UPLOAD_FOLDER, ids['uploading']))
+
+assert app.load_batch(ids['expired'])['state'] == 'removed'
+assert ids['expired'] not in app.BATCHES
+assert not os.path.exists(os.path.join(app.CONVERTED_FOLDER, ids['expired']))
+"""
+
+
+def test_batches_recovered_after_restart(tmp_path, project_root):
+    env = dict(os.environ, BOOKFORGE_DATA_DIR=str(tmp_path / 'data'), BOOKFORGE_CONVERSION_BROKER='local')
+    ids_path = str(tmp_path / 'ids.json')
+    for script in (BEFORE_RESTART, AFTER_RESTART):
+        subprocess.run([sys.executable, '-c', script.format(root=project_root, ids_path=ids_path)], env=env,
+                       check=True, stdout=subprocess.DEVNULL, timeout=60)
+    with open(ids_path) as f:
+        assert set(json.load(f)) == {'completed', 'expired', 'uploading', 'interrupted'}
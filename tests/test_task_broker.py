@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Web进程使用共享队列接收上传，转换由单独启动的 conversion_worker.py 完成。
+# 第一个工作进程可以在转换过程中被强制结束，由第二个工作进程在租约到期后重新领取
+BROKER_SCRIPT = """
+import io, os, signal, subprocess, sys, time, zipfile
+sys.path.insert(0, {root!r})
+import app
+client = app.app.test_client()
+
+def start_worker(latency, log_name):
+    env = dict(os.environ, FAKE_CALIBRE_LATENCY=latency)
+    log = open(os.path.join(app.DATA_FOLDER, log_name), 'w')
+    return subprocess.Popen([sys.executable, os.path.join({root!r}, 'conversion_worker.py')], env=env,
+                            stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+def wait_for(batch_id, statuses, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        status = client.get(f'/jobs/{{batch_id}}').get_json()
+        if status['status'] in statuses:
+            return status
+        assert time.time() < deadline, status
+        time.sleep(0.1)
+
+def stop(worker):
+    os.killpg(worker.pid, signal.SIGTERM)
+    try:
+        worker.wait(timeout=20)
+    except subprocess.TimeoutExpired:
+        os.killpg(worker.pid, signal.SIGKILL)
+        worker.wait()
+
+files = [(io.BytesIO(b'shared queue'), 'one.txt'), (io.BytesIO(b'second file'), 'two.txt')]
+response = client.post('/upload', data={{'output_format': 'epub', 'files[]': files}}, content_type='multipart/form-data')
+assert response.status_code == 202, response.get_json()
+batch_id = response.get_json()['batch_id']
+assert wait_for(batch_id, ('queued',))['status'] == 'queued'
+
+if {crash!r}:
+    crashed = start_worker('5', 'crashed.log')
+    wait_for(batch_id, ('running',))
+    # 工作进程被强制结束，租约不再续约；ebook-convert在单独的进程组中，随后自行退出
+    os.killpg(crashed.pid, signal.SIGKILL)
+    crashed.wait()
+
+worker = start_worker('0.05', 'worker.log')
+try:
+    status = wait_for(batch_id, ('completed', 'failed'))
+finally:
+    stop(worker)
+with open(os.path.join(app.DATA_FOLDER, 'worker.log')) as f:
+    log = f.read()
+
+assert status['status'] == {expected!r}, status
+assert app.state_db().execute('SELECT COUNT(*) FROM tasks').fetchone()[0] == 0
+if status['status'] == 'completed':
+    assert [f['status'] for f in status['files']] == ['success', 'success']
+    archive = zipfile.ZipFile(io.BytesIO(client.get(status['download_url']).data))
+    assert sorted(archive.namelist()) == ['one.epub', 'two.epub']
+    assert ('开始第 2 次执行' in log) == {crash!r}, log
+else:
+    assert status['error'] == '转换进程多次异常退出，已放弃该批次'
+    assert '均未完成，不再重试' in log, log
+"""
+
+
+@pytest.mark.parametrize('crash, max_attempts, expected', [
+    (False, 3, 'completed'),
+    (True, 3, 'completed'),
+    (True, 1, 'failed'),
+], ids=['convert', 'retry-after-lease-expiry', 'give-up'])
+def test_sqlite_broker_with_worker(tmp_path, project_root, crash, max_attempts, expected):
+    env = dict(os.environ, BOOKFORGE_CONVERSION_BROKER='sqlite', BOOKFORGE_DATA_DIR=str(tmp_path),
+               BOOKFORGE_TASK_LEASE_SECONDS='2', BOOKFORGE_TASK_MAX_ATTEMPTS=str(max_attempts),
+               BOOKFORGE_JOB_RUNNERS='2', BOOKFORGE_GRACEFUL_TIMEOUT='10')
+    script = BROKER_SCRIPT.format(root=project_root, crash=crash, expected=expected)
+    subprocess.run([sys.executable, '-c', script], env=env, check=True, stdout=subprocess.DEVNULL, timeout=120)
@@ -0,0 +1,43 @@
+import io
+import os
+import zipfile
+
+import app
+
+
+def test_stream_zip_file_is_valid_archive(tmp_path):
+    contents = {
+        'book.txt': b'plain text ' * 5000,
+        'book.epub': os.urandom(300 * 1024),
+        'empty.html': b'',
+    }
+    entries = []
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+        entries.append((str(tmp_path / name), name))
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(app.stream_zip_file(entries))))
+    assert archive.testzip() is None
+    assert {name: archive.read(name) for name in archive.namelist()} == contents
+    # 已压缩的格式只存储，文本类格式压缩
+    assert archive.getinfo('book.epub').compress_type == app.zip_compression_for('book.epub')
+    assert archive.getinfo('book.txt').compress_size < len(contents['book.txt'])
+
+
+def test_stream_zip_file_without_entries():
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(app.stream_zip_file([]))))
+    assert archive.namelist() == []
+
+
+def test_download_streams_batch_zip(client, upload, wait_for):
+    job = upload('zipped.txt', 'zipped.txt')
+    status = wait_for(job, ('completed', 'failed'))
+    assert status['status'] == 'completed'
+
+    response = client.get(status['download_url'])
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    # 同名的转换结果在ZIP中改名，不会互相覆盖
+    assert len(set(archive.namelist())) == 2